@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+
+#
+# Run this script to measure how long drawing takes with different options.
+#
+
+import sys
+import math
+import time
+import random
+import tracemalloc
+
+import cartesius.main as cartesius
+import cartesius.elements as elements
+import cartesius.charts as charts
+import cartesius.colors as colors
+
+benchmarks = []
+
+def measure(function, repeat=5):
+    """ Best time (in milliseconds) of repeat calls """
+    result = None
+    for i in range(repeat):
+        start = time.time()
+        function()
+        duration = (time.time() - start) * 1000
+        if result is None or duration < result:
+            result = duration
+    return result
+
+def get_dashboard():
+    random.seed(1)
+
+    coordinate_system = cartesius.CoordinateSystem()
+
+    coordinate_system.add(elements.Grid(1, 1))
+    coordinate_system.add(charts.BarChart(
+        vertical=True,
+        data=[charts.data(x, random.random() * 5) for x in range(-10, 10)],
+        width=0.8,
+        color=(0, 0, 0)))
+    coordinate_system.add(charts.LineChart(
+        data=[charts.data(x / 10., 5 + 3 * math.sin(x / 20.)) for x in range(-100, 100)],
+        color=(200, 0, 0)))
+    coordinate_system.add(charts.Function(
+        lambda x: 2 + math.cos(x),
+        start=-10,
+        end=10,
+        step=0.05,
+        color=(0, 0, 200)))
+
+    return coordinate_system
+
+def benchmark_antialiasing():
+    """ Antialiasing cost by supersampling factor and downscale filter (800x600 image) """
+    coordinate_system = get_dashboard()
+
+    print('{0:>8} {1:>10} {2:>10}'.format('factor', 'filter', 'ms'))
+    print('{0:>8} {1:>10} {2:>10.1f}'.format(1, '-', measure(lambda: coordinate_system.draw(800, 600))))
+    for antialiasing in (1.5, 2, 3, 4):
+        for resample in (cartesius.RESAMPLE_BOX, cartesius.RESAMPLE_BILINEAR, cartesius.RESAMPLE_LANCZOS):
+            duration = measure(lambda: coordinate_system.draw(800, 600, antialiasing=antialiasing, resample=resample))
+            print('{0:>8} {1:>10} {2:>10.1f}'.format(antialiasing, resample, duration))
+
+benchmarks.append(benchmark_antialiasing)
+
+def benchmark_static_layers_cache():
+    """ Drawing with and without cached grid and axes layers (800x600 image) """
+    def get_coordinate_system():
+        coordinate_system = cartesius.CoordinateSystem(bounds=(-50, 50, -30, 30))
+        coordinate_system.add(elements.Grid(1, 1))
+        coordinate_system.add(elements.Grid(5, 5, color=(200, 200, 255)))
+        coordinate_system.add(elements.Axis(horizontal=True, labels=5, points=1))
+        coordinate_system.add(elements.Axis(vertical=True, labels=5, points=1))
+        coordinate_system.add(charts.LineChart(
+            data=[charts.data(x, random.random() * 20 - 10) for x in range(-50, 50)],
+            color=(200, 0, 0)))
+        return coordinate_system
+
+    print('{0:>12} {1:>10} {2:>10}'.format('antialiasing', 'cached', 'ms'))
+    for antialiasing in (None, True):
+        for cache_static_layers in (False, True):
+            duration = measure(lambda: get_coordinate_system().draw(
+                    800, 600, antialiasing=antialiasing, cache_static_layers=cache_static_layers))
+            print('{0:>12} {1:>10} {2:>10.1f}'.format(str(antialiasing), str(cache_static_layers), duration))
+
+benchmarks.append(benchmark_static_layers_cache)
+
+def benchmark_incremental_redraw():
+    """ Appending one point to a live line chart and drawing it again, full draw vs redraw (600x200 image) """
+    print('{0:>12} {1:>10} {2:>10}'.format('antialiasing', 'draw ms', 'redraw ms'))
+    for antialiasing in (None, True):
+        coordinate_system = cartesius.CoordinateSystem(bounds=(0, 1000, -2, 2))
+        coordinate_system.add(elements.Grid(100, 0.5))
+        line_chart = charts.LineChart(
+            data=[charts.data(x, math.sin(x / 5.)) for x in range(500)],
+            color=(0, 0, 200),
+            fill_color=(200, 200, 255))
+        coordinate_system.add(line_chart)
+
+        images = [coordinate_system.draw(600, 200, axis_units_equal_length=False, antialiasing=antialiasing)]
+        counter = [500]
+
+        def append():
+            x = counter[0]
+            coordinate_system.append(line_chart, charts.data(x, math.sin(x / 5.)))
+            counter[0] += 1
+
+        def draw():
+            append()
+            images[0] = coordinate_system.draw(600, 200, axis_units_equal_length=False, antialiasing=antialiasing)
+
+        def redraw():
+            append()
+            images[0] = coordinate_system.redraw(images[0], axis_units_equal_length=False, antialiasing=antialiasing)
+
+        print('{0:>12} {1:>10.1f} {2:>10.1f}'.format(str(antialiasing), measure(draw), measure(redraw)))
+
+benchmarks.append(benchmark_incremental_redraw)
+
+def benchmark_labels():
+    """ Drawing 200 axes labels with and without cached label bitmaps (1200x800 image) """
+    def get_coordinate_system():
+        coordinate_system = cartesius.CoordinateSystem(bounds=(-50, 50, -30, 30))
+        coordinate_system.add(elements.Axis(horizontal=True, labels=1, points=1, min_labels_distance=1))
+        coordinate_system.add(elements.Axis(vertical=True, labels=1, points=1, min_labels_distance=1))
+        return coordinate_system
+
+    print('{0:>14} {1:>10}'.format('label_bitmaps', 'ms'))
+    for label_bitmaps in (False, True):
+        duration = measure(lambda: get_coordinate_system().draw(1200, 800, label_bitmaps=label_bitmaps))
+        print('{0:>14} {1:>10.1f}'.format(str(label_bitmaps), duration))
+
+benchmarks.append(benchmark_labels)
+
+def benchmark_bands():
+    """ Drawing a 4000x2000 antialiased image in horizontal bands by a pool of threads """
+    coordinate_system = get_dashboard()
+
+    print('{0:>8} {1:>10} {2:>10}'.format('bands', 'ms', 'speedup'))
+    single = measure(lambda: coordinate_system.draw(4000, 2000, antialiasing=True), repeat=3)
+    print('{0:>8} {1:>10.1f} {2:>10.2f}'.format(1, single, 1))
+    for bands in (2, 4, 8):
+        duration = measure(lambda: coordinate_system.draw(4000, 2000, antialiasing=True, bands=bands), repeat=3)
+        print('{0:>8} {1:>10.1f} {2:>10.2f}'.format(bands, duration, single / duration))
+
+benchmarks.append(benchmark_bands)
+
+def benchmark_clipping():
+    """ Drawing a 100000 points line chart (800x600 image), whole and zoomed in (only visible segments drawn) """
+    random.seed(1)
+    keys = [x / 100. for x in range(100000)]
+    values = [math.sin(x / 1000.) + random.random() / 10. for x in range(100000)]
+
+    print('{0:>8} {1:>10}'.format('zoom', 'ms'))
+    for zoom in (1, 10, 100, 1000):
+        coordinate_system = cartesius.CoordinateSystem(bounds=(0, 1000. / zoom, -1.5, 1.5))
+        coordinate_system.add(charts.LineChart(data=charts.ChartSeries(keys, values), color=(0, 0, 200), fill_color=(200, 200, 255)))
+        duration = measure(lambda: coordinate_system.draw(800, 600, axis_units_equal_length=False), repeat=3)
+        print('{0:>8} {1:>10.1f}'.format(zoom, duration))
+
+benchmarks.append(benchmark_clipping)
+
+def benchmark_scatter():
+    """ Drawing scatter data (800x600 image) as Point elements and as a density raster ScatterChart """
+    random.seed(1)
+
+    print('{0:>10} {1:>10} {2:>10}'.format('points', 'Point ms', 'Scatter ms'))
+    for count in (10000, 100000, 1000000):
+        keys = [random.gauss(0, 1) for i in range(count)]
+        values = [random.gauss(0, 1) for i in range(count)]
+
+        points_duration = None
+        if count <= 100000:
+            coordinate_system = cartesius.CoordinateSystem(bounds=(-4, 4, -3, 3))
+            for key, value in zip(keys, values):
+                coordinate_system.add(elements.Point((key, value), style='.', color=(0, 0, 200)))
+            points_duration = measure(lambda: coordinate_system.draw(800, 600), repeat=1)
+
+        coordinate_system = cartesius.CoordinateSystem(bounds=(-4, 4, -3, 3))
+        coordinate_system.add(charts.ScatterChart(charts.ChartSeries(keys, values)))
+        scatter_duration = measure(lambda: coordinate_system.draw(800, 600), repeat=3)
+
+        print('{0:>10} {1:>10} {2:>10.1f}'.format(
+            count, '{0:.1f}'.format(points_duration) if points_duration else '-', scatter_duration))
+
+benchmarks.append(benchmark_scatter)
+
+def benchmark_points():
+    """ Drawing 100000 '+' markers (800x600 image) as Point elements and as one Points element """
+    random.seed(1)
+    xs = [random.gauss(0, 1) for i in range(100000)]
+    ys = [random.gauss(0, 1) for i in range(100000)]
+
+    coordinate_system = cartesius.CoordinateSystem(bounds=(-4, 4, -3, 3))
+    for x, y in zip(xs, ys):
+        coordinate_system.add(elements.Point((x, y), style='+', color=(0, 0, 200)))
+    print('{0:>10} {1:>10.1f}'.format('Point', measure(lambda: coordinate_system.draw(800, 600), repeat=1)))
+
+    coordinate_system = cartesius.CoordinateSystem(bounds=(-4, 4, -3, 3))
+    coordinate_system.add(elements.Points(xs, ys, style='+', color=(0, 0, 200)))
+    print('{0:>10} {1:>10.1f}'.format('Points', measure(lambda: coordinate_system.draw(800, 600), repeat=3)))
+
+benchmarks.append(benchmark_points)
+
+def benchmark_bar_aggregation():
+    """ Drawing 50000 bars (800x400 image), one by one and aggregated per pixel column """
+    random.seed(1)
+    keys, values, value = [], [], 0
+    for i in range(50000):
+        value += random.gauss(0, 1)
+        keys.append(i)
+        values.append(value)
+
+    print('{0:>12} {1:>10}'.format('aggregation', 'ms'))
+    for aggregation in (None, 'max', 'sum'):
+        coordinate_system = cartesius.CoordinateSystem()
+        coordinate_system.add(charts.BarChart(vertical=True, data=charts.ChartSeries(keys, values), width=1,
+                                              color=(0, 0, 0), aggregation=aggregation))
+        duration = measure(lambda: coordinate_system.draw(800, 400, axis_units_equal_length=False), repeat=1)
+        print('{0:>12} {1:>10.1f}'.format(str(aggregation), duration))
+
+benchmarks.append(benchmark_bar_aggregation)
+
+def benchmark_colormap():
+    """ Mapping 1000000 values to colors, one by one with get_color_between() and with map_colors() """
+    random.seed(1)
+    values = [random.random() for i in range(1000000)]
+    colormap = colors.get_colormap(colors.BLUES)
+
+    print('{0:>14} {1:>10}'.format('', 'ms'))
+    duration = measure(lambda: [colors.get_color_between(colors.BLUES[0], colors.BLUES[1], value) for value in values], repeat=1)
+    print('{0:>14} {1:>10.1f}'.format('one by one', duration))
+    print('{0:>14} {1:>10.1f}'.format('map_colors', measure(lambda: colors.map_colors(values, colormap), repeat=3)))
+
+benchmarks.append(benchmark_colormap)
+
+def benchmark_memory():
+    """ Memory used by 10000 elements (bytes per element, including their bounds) """
+    def get_elements(i):
+        return {
+            'Bounds': cartesius.Bounds(left=i, right=i + 1, bottom=i, top=i + 1),
+            'Point': elements.Point((i, i)),
+            'Line': elements.Line((i, i), (i + 1, i + 1)),
+            'Circle': elements.Circle((i, i), 1, color=(0, 0, 0)),
+        }
+
+    names = sorted(get_elements(0))
+    print('{0:>10} {1:>10}'.format('element', 'bytes'))
+    for name in names:
+        tracemalloc.start()
+        start = tracemalloc.get_traced_memory()[0]
+        items = [get_elements(i)[name] for i in range(10000)]
+        size = tracemalloc.get_traced_memory()[0] - start
+        tracemalloc.stop()
+        print('{0:>10} {1:>10.0f}'.format(name, size / float(len(items))))
+
+benchmarks.append(benchmark_memory)
+
+def benchmark_render_many():
+    """ Drawing 64 dashboards (400x300 PNG images) sequentially and with render_many() """
+    coordinate_systems = [get_dashboard() for i in range(64)]
+
+    def draw():
+        for coordinate_system in coordinate_systems:
+            cartesius.render(
+                (0, cartesius.get_pickled(coordinate_system), 400, 300, 'PNG', {'antialiasing': True}))
+
+    print('{0:>10} {1:>10}'.format('workers', 'ms'))
+    print('{0:>10} {1:>10.1f}'.format('-', measure(draw, repeat=1)))
+    for workers in (2, 4, 8):
+        duration = measure(lambda: list(cartesius.render_many(coordinate_systems, 400, 300, workers=workers,
+                                                              chunksize=4, antialiasing=True)), repeat=1)
+        print('{0:>10} {1:>10.1f}'.format(workers, duration))
+
+benchmarks.append(benchmark_render_many)
+
+if __name__ == '__main__':
+    names = sys.argv[1:]
+    for benchmark in benchmarks:
+        if names and benchmark.__name__ not in names:
+            continue
+        print(benchmark.__doc__.strip())
+        benchmark()
+        print('')
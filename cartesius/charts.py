@@ -3,19 +3,24 @@
 """ Charts are normal CoordinateSystemElements """
 
 import math as mod_math
+import bisect as mod_bisect
+import array as mod_array
 import collections as mod_collections
 import types as mod_types
 
 from . import main as mod_main
+from . import utils as mod_utils
 from . import colors as mod_colors
 
-# Default color palete from: http://www.colourlovers.com/pattern/2429885/Spring_flower_aerial
-DEFAULT_COLORS = (
-        (141, 198, 183),
-        (207, 249, 117),
-        (230, 193, 238),
-        (242, 229, 229),
-)
+# Moved to the colors module, kept here for backward compatibility:
+DEFAULT_COLORS = mod_colors.DEFAULT_COLORS
+
+# Default ScatterChart colors (gradient from the least to the most dense pixels):
+DEFAULT_DENSITY_COLORS = mod_colors.BLUES
+
+# LineChart decimation modes (for datasets much bigger than the image width):
+DECIMATION_MIN_MAX = 'minmax'
+DECIMATION_LTTB = 'lttb'
 
 ChartData = mod_collections.namedtuple(
         'ChartData',
@@ -27,8 +32,13 @@ def get_generator(data):
     cartesius as a generator function.
 
     In case data is callable and the result is a generator, then data is returned, oherwisea the
-    result is a function that returns a generator through data.
+    result is a function that returns an iterator through data.
     """
+    if isinstance(data, ChartSeries):
+        if not len(data):
+            raise Exception('Empty series: {0}'.format(data))
+        return data.__iter__
+
     if callable(data):
         if isinstance(data(), mod_types.GeneratorType):
             return data
@@ -36,10 +46,37 @@ def get_generator(data):
     if not data:
         raise Exception('Invalid or empty data: {0}'.format(data))
 
-    def generator():
-        for i in data:
-            yield i
-    return generator
+    # Unlike a local function, a bound method can be pickled (see main.render_many()):
+    return data.__iter__
+
+def get_series(data):
+    """
+    Returns data as a ChartSeries if it is (or can be converted without creating a Python object
+    per item to) one, None otherwise. Accepted are:
+
+     * ChartSeries
+     * NumPy arrays with shape (n, 2) or (n, 3) ((key, value) or (key, value, size) rows)
+     * memoryviews or array.array objects with interleaved keys and values (k0, v0, k1, v1, ...)
+     * tuples/lists of 2 or 3 buffers (NumPy arrays, memoryviews, array.array): keys, values and
+       (optionally) sizes columns
+
+    NumPy arrays and memoryviews are not copied.
+    """
+    if isinstance(data, ChartSeries):
+        return data
+
+    if mod_utils.is_buffer(data):
+        if mod_utils.mod_numpy is not None and isinstance(data, mod_utils.mod_numpy.ndarray) \
+                and data.ndim == 2 and data.shape[1] == 3:
+            keys, values, sizes = mod_utils.to_columns(data, 3)
+            return ChartSeries(keys, values, sizes)
+        keys, values = mod_utils.to_columns(data, 2)
+        return ChartSeries(keys, values)
+
+    if isinstance(data, (tuple, list)) and len(data) in (2, 3) and all(mod_utils.is_buffer(column) for column in data):
+        return ChartSeries(*data)
+
+    return None
 
 def data(key, value, size=None, label=None, label_position=None, color=None, fill_color=None):
     """
@@ -48,27 +85,287 @@ def data(key, value, size=None, label=None, label_position=None, color=None, fil
     return ChartData(key, value, size, label, label_position, mod_colors.get_color(color),
                      mod_colors.get_color(fill_color))
 
+class ChartSeries:
+    """
+    Columnar chart data, accepted by all charts instead of a list of data() items.
+
+    Keys, values and sizes are stored in parallel array('d') (or NumPy) columns and labels, label
+    positions and colors in sparse {index: value} dictionaries, so a point without label and colors
+    needs only ~16 bytes. Iterating over a series (or indexing it) returns ChartData items.
+    """
+
+    __slots__ = (
+        'keys',
+        'values',
+        'sizes',
+
+        'labels',
+        'label_positions',
+        'colors',
+        'fill_colors',
+    )
+
+    def __init__(self, keys=None, values=None, sizes=None):
+        mod_utils.init_slots(self)
+
+        self.keys = mod_utils.to_column(keys if keys is not None else ())
+        self.values = mod_utils.to_column(values if values is not None else ())
+        self.sizes = mod_utils.to_column(sizes) if sizes is not None else None
+
+        if len(self.keys) != len(self.values):
+            raise Exception('Keys ({0}) and values ({1}) must have the same length'.format(len(self.keys), len(self.values)))
+        if self.sizes is not None and len(self.sizes) != len(self.keys):
+            raise Exception('Sizes ({0}) and keys ({1}) must have the same length'.format(len(self.sizes), len(self.keys)))
+
+        self.labels = {}
+        self.label_positions = {}
+        self.colors = {}
+        self.fill_colors = {}
+
+    @classmethod
+    def from_data(cls, data):
+        """ Series with all items from a data() list or generator function """
+        result = cls()
+        if callable(data):
+            data = data()
+        for item in data:
+            result.append(*item)
+        return result
+
+    def append(self, key, value, size=None, label=None, label_position=None, color=None, fill_color=None):
+        # NumPy columns can't grow, they are copied the first time something is appended:
+        if not isinstance(self.keys, mod_array.array):
+            self.keys = mod_array.array('d', self.keys)
+            self.values = mod_array.array('d', self.values)
+        if self.sizes is not None and not isinstance(self.sizes, mod_array.array):
+            self.sizes = mod_array.array('d', self.sizes)
+
+        index = len(self.keys)
+
+        if size != None and self.sizes is None:
+            self.sizes = mod_array.array('d', [float('nan')] * index)
+
+        self.keys.append(key)
+        self.values.append(value)
+        if self.sizes is not None:
+            self.sizes.append(size if size != None else float('nan'))
+
+        if label:
+            self.labels[index] = label
+        if label_position:
+            self.label_positions[index] = label_position
+        if color:
+            self.colors[index] = mod_colors.get_color(color)
+        if fill_color:
+            self.fill_colors[index] = mod_colors.get_color(fill_color)
+
+    def has_colors(self):
+        return bool(self.colors) or bool(self.fill_colors)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, index):
+        size = None
+        if self.sizes is not None:
+            size = self.sizes[index]
+            if size != size:
+                # NaN => no size
+                size = None
+        return ChartData(self.keys[index], self.values[index], size, self.labels.get(index),
+                         self.label_positions.get(index), self.colors.get(index), self.fill_colors.get(index))
+
+    def __iter__(self):
+        for index in range(len(self.keys)):
+            yield self[index]
+
+def decimate_min_max(keys, values, left, right, columns):
+    """
+    Returns the sorted indexes of points to be kept so that for every pixel column only the first,
+    the minimum, the maximum and the last point remain. This keeps the drawn envelope of the line
+    identical while the number of points depends only on the image width. Keys must be sorted.
+    """
+    if not right > left or not columns > 0:
+        raise Exception('Invalid decimation bounds ({0}, {1}) or columns ({2})'.format(left, right, columns))
+
+    coef = columns / float(right - left)
+
+    if mod_utils.mod_numpy is not None and isinstance(keys, mod_utils.mod_numpy.ndarray):
+        return decimate_min_max_numpy(keys, values, left, coef)
+
+    result = []
+    current_column = None
+    first = minimum = maximum = last = None
+    for index, (key, value) in enumerate(zip(keys, values)):
+        column = int(mod_math.floor((key - left) * coef))
+        if column != current_column:
+            if current_column != None:
+                result.extend(sorted(set((first, minimum, maximum, last))))
+            current_column = column
+            first = minimum = maximum = index
+        else:
+            if value < values[minimum]:
+                minimum = index
+            if value > values[maximum]:
+                maximum = index
+        last = index
+
+    if current_column != None:
+        result.extend(sorted(set((first, minimum, maximum, last))))
+
+    return result
+
+def decimate_min_max_numpy(keys, values, left, coef):
+    """ decimate_min_max() for NumPy columns """
+    numpy = mod_utils.mod_numpy
+
+    length = len(keys)
+    if not length:
+        return []
+
+    values = numpy.asarray(values)
+    columns = numpy.floor((numpy.asarray(keys, dtype=float) - left) * coef)
+
+    starts = numpy.flatnonzero(columns[1:] != columns[:-1]) + 1
+    firsts = numpy.concatenate(([0], starts))
+    lasts = numpy.concatenate((starts - 1, [length - 1]))
+    lengths = lasts - firsts + 1
+
+    # The first index with the minimum/maximum value in every column:
+    indexes = numpy.arange(length)
+    minimums = numpy.repeat(numpy.minimum.reduceat(values, firsts), lengths)
+    maximums = numpy.repeat(numpy.maximum.reduceat(values, firsts), lengths)
+    minimum_indexes = numpy.minimum.reduceat(numpy.where(values == minimums, indexes, length), firsts)
+    maximum_indexes = numpy.minimum.reduceat(numpy.where(values == maximums, indexes, length), firsts)
+
+    # Columns with NaN values (never equal to their minimum/maximum):
+    minimum_indexes = numpy.where(minimum_indexes == length, firsts, minimum_indexes)
+    maximum_indexes = numpy.where(maximum_indexes == length, firsts, maximum_indexes)
+
+    # Columns don't overlap, so sorting all of them at once is the same as sorting every column:
+    return numpy.unique(numpy.concatenate((firsts, minimum_indexes, maximum_indexes, lasts))).tolist()
+
+def decimate_lttb(keys, values, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling. Returns the sorted indexes of (at most) threshold
+    points which best preserve the visual shape of the line.
+    """
+    length = len(keys)
+    if threshold >= length or threshold < 3:
+        return list(range(length))
+
+    if mod_utils.mod_numpy is not None and isinstance(keys, mod_utils.mod_numpy.ndarray):
+        return decimate_lttb_numpy(keys, values, threshold)
+
+    result = [0]
+
+    bucket_size = (length - 2) / float(threshold - 2)
+
+    a = 0
+    for i in range(threshold - 2):
+        # Average point of the next bucket:
+        next_start = int(mod_math.floor((i + 1) * bucket_size)) + 1
+        next_end = min(int(mod_math.floor((i + 2) * bucket_size)) + 1, length)
+        next_length = next_end - next_start
+        avg_x = sum(keys[next_start:next_end]) / float(next_length)
+        avg_y = sum(values[next_start:next_end]) / float(next_length)
+
+        # Point in this bucket with the largest triangle (a, point, average):
+        start = int(mod_math.floor(i * bucket_size)) + 1
+        end = int(mod_math.floor((i + 1) * bucket_size)) + 1
+
+        a_x, a_y = keys[a], values[a]
+        max_area = -1
+        max_index = start
+        for j in range(start, end):
+            area = abs((a_x - avg_x) * (values[j] - a_y) - (a_x - keys[j]) * (avg_y - a_y))
+            if area > max_area:
+                max_area = area
+                max_index = j
+
+        result.append(max_index)
+        a = max_index
+
+    result.append(length - 1)
+
+    return result
+
+def decimate_lttb_numpy(keys, values, threshold):
+    """ decimate_lttb() for NumPy columns """
+    numpy = mod_utils.mod_numpy
+
+    keys = numpy.asarray(keys, dtype=float)
+    values = numpy.asarray(values, dtype=float)
+    length = len(keys)
+
+    bucket_size = (length - 2) / float(threshold - 2)
+
+    # Bucket i is [starts[i], starts[i + 1]), the last bucket ends with the last point:
+    starts = (numpy.floor(numpy.arange(threshold - 1) * bucket_size) + 1).astype(int)
+    lengths = numpy.diff(numpy.concatenate((starts, [length])))
+    avg_xs = (numpy.add.reduceat(keys, starts) / lengths).tolist()
+    avg_ys = (numpy.add.reduceat(values, starts) / lengths).tolist()
+    starts = starts.tolist()
+
+    result = [0]
+
+    a = 0
+    for i in range(threshold - 2):
+        avg_x, avg_y = avg_xs[i + 1], avg_ys[i + 1]
+        start, end = starts[i], starts[i + 1]
+
+        a_x, a_y = keys[a], values[a]
+        areas = numpy.abs((a_x - avg_x) * (values[start:end] - a_y) - (a_x - keys[start:end]) * (avg_y - a_y))
+        a = start + int(numpy.argmax(areas))
+
+        result.append(a)
+
+    result.append(length - 1)
+
+    return result
+
+def get_key_label(key):
+    """ Key as shown in labels, integral float keys (from series columns) without ".0" """
+    if isinstance(key, float) and key.is_integer():
+        return int(key)
+    return key
+
 class BarChart(mod_main.CoordinateSystemElement):
 
-    horizontal = None
+    __slots__ = (
+        'horizontal',
+
+        'color',
 
-    color = None
+        'data_generator',
+        'series',
+        'width',
 
-    data_generator = None
-    width = None
+        # True if at least one item has a label (computed in reload_bounds()):
+        'has_labels',
+
+        # If set, bars are drawn in bulk as rectangles, bars narrower than a pixel aggregated per
+        # pixel column (see mod_utils.AGGREGATION_*), and outlines and labels of those bars skipped:
+        'aggregation',
+    )
 
     def __init__(self, data, horizontal=None, vertical=None, width=None, color=None, 
-                 transparency_mask=None):
+                 transparency_mask=None, aggregation=None):
         mod_main.CoordinateSystemElement.__init__(self, transparency_mask=transparency_mask)
 
         if bool(horizontal) == bool(vertical):
             raise Exception('Bar chart must be be horizontal or vertical')
-        if not data:
+        if data is None or (not mod_utils.is_buffer(data) and not data):
             raise Exception('Data must be set')
+        if aggregation not in (None, mod_utils.AGGREGATION_MAX, mod_utils.AGGREGATION_MIN, mod_utils.AGGREGATION_SUM):
+            raise Exception('Invalid aggregation: {0}'.format(aggregation))
+
+        self.aggregation = aggregation
 
         self.horizontal = horizontal
 
-        self.data_generator = get_generator(data)
+        self.series = get_series(data)
+        self.data_generator = get_generator(self.series if self.series is not None else data)
         self.width = width
         self.color = self.get_color(color)
 
@@ -86,28 +383,79 @@ class BarChart(mod_main.CoordinateSystemElement):
         else:
             return x, y
 
+    def materialize(self, bounds=None):
+        if self.series is None:
+            self.data_generator = get_generator(list(self.data_generator()))
+
     def reload_bounds(self):
+        if self.series is not None:
+            self.reload_series_bounds()
+            self.has_labels = bool(self.series.labels)
+            return
+
+        # Key and value bounds are computed first, and bounds updated only once:
+        self.has_labels = False
+        key_min, key_max, value_min, value_max = None, None, None, None
         for item in self.data_generator():
+            if item.label:
+                self.has_labels = True
             if self.width:
-                if self.horizontal:
-                    self.bounds.update(y=item.key)
-                    self.bounds.update(y=item.key + self.width)
-                    self.bounds.update(x=item.value)
-                else:
-                    self.bounds.update(x=item.key)
-                    self.bounds.update(x=item.key + self.width)
-                    self.bounds.update(y=item.value)
+                key_min, key_max = mod_utils.min_max(key_min, key_max, item.key, item.key + self.width)
+                value_min, value_max = mod_utils.min_max(value_min, value_max, item.value)
             else:
-                if self.horizontal:
-                    self.bounds.update(y=item.key)
-                    self.bounds.update(y=item.value)
-                    self.bounds.update(x=item.size)
-                else:
-                    self.bounds.update(x=item.key)
-                    self.bounds.update(x=item.value)
-                    self.bounds.update(y=item.size)
+                key_min, key_max = mod_utils.min_max(key_min, key_max, item.key, item.value)
+                value_min, value_max = mod_utils.min_max(value_min, value_max, item.size)
+
+        if key_min is None:
+            return
+
+        if self.horizontal:
+            self.bounds.update(x=value_min, y=key_min)
+            self.bounds.update(x=value_max, y=key_max)
+        else:
+            self.bounds.update(x=key_min, y=value_min)
+            self.bounds.update(x=key_max, y=value_max)
+
+    def reload_series_bounds(self):
+        """ Same as reload_bounds(), but computed on whole series columns """
+        keys_min, keys_max = mod_utils.column_min_max(self.series.keys)
+        values_min, values_max = mod_utils.column_min_max(self.series.values)
+
+        if self.width:
+            key_bounds = keys_min, keys_max + self.width
+            value_bounds = values_min, values_max
+        else:
+            if self.series.sizes is None:
+                raise Exception('Bar chart without width needs sizes')
+            key_bounds = min(keys_min, values_min), max(keys_max, values_max)
+            value_bounds = mod_utils.column_min_max(self.series.sizes)
+
+        if self.horizontal:
+            self.bounds.update(x=value_bounds[0], y=key_bounds[0])
+            self.bounds.update(x=value_bounds[1], y=key_bounds[1])
+        else:
+            self.bounds.update(x=key_bounds[0], y=value_bounds[0])
+            self.bounds.update(x=key_bounds[1], y=value_bounds[1])
+
+    def get_image_box(self, draw_handler):
+        if self.has_labels or not self.bounds.is_set():
+            return None
+
+        # Bars start on 0, which is not always within bounds:
+        if self.horizontal:
+            left, right = mod_utils.min_max(0, self.bounds.left, self.bounds.right)
+            bottom, top = self.bounds.bottom, self.bounds.top
+        else:
+            left, right = self.bounds.left, self.bounds.right
+            bottom, top = mod_utils.min_max(0, self.bounds.bottom, self.bounds.top)
+
+        return self.get_bounds_image_box(left, right, bottom, top, 1, draw_handler)
 
     def process_image(self, draw_handler):
+        if self.aggregation:
+            self.process_aggregated_image(draw_handler)
+            return
+
         for index, item in enumerate(self.data_generator()):
             if self.width:
                 start, end, value = item.key, item.key + self.width, item.value
@@ -123,51 +471,99 @@ class BarChart(mod_main.CoordinateSystemElement):
                 (self.get_point(start, 0), self.get_point(start, value), self.get_point(end, value), self.get_point(end, 0)),
                 fill_color = fill_color)
 
-            if item.label:
-                if self.horizontal:
-                    if item.label_position:
-                        label_position = item.label_position
-                    elif value > 0:
-                        label_position = mod_main.LEFT_CENTER
-                    else:
-                        label_position = mod_main.RIGHT_CENTER
-                    draw_handler.draw_text(0, (start + end) / 2., item.label, mod_main.DEFAULT_LABEL_COLOR, label_position)
+            self.draw_label_and_outline(draw_handler, item, start, end, value)
+
+    def process_aggregated_image(self, draw_handler):
+        """ Draw all bars with one draw_bars() call, see aggregation """
+        if self.series is not None:
+            starts, values = self.series.keys, self.series.values
+            if self.width:
+                if mod_utils.mod_numpy is not None:
+                    ends = mod_utils.mod_numpy.asarray(starts, dtype=float) + self.width
                 else:
-                    if item.label_position:
-                        label_position = item.label_position
-                    elif value > 0:
-                        label_position = mod_main.CENTER_DOWN
-                    else:
-                        label_position = mod_main.CENTER_UP
-                    draw_handler.draw_text((start + end) / 2., 0, item.label, mod_main.DEFAULT_LABEL_COLOR, label_position)
-
-            if self.color:
-                if self.horizontal:
-                    draw_handler.draw_line(0, start, value, start, self.color)
-                    draw_handler.draw_line(value, end, 0, end, self.color)
-                    draw_handler.draw_line(value, start, value, end, self.color)
+                    ends = mod_array.array('d', [start + self.width for start in starts])
+            else:
+                starts, ends, values = self.series.keys, self.series.values, self.series.sizes
+            fill_colors = [self.series.fill_colors.get(index) or DEFAULT_COLORS[index % len(DEFAULT_COLORS)]
+                           for index in range(len(starts))]
+            items = None
+        else:
+            items = list(self.data_generator())
+            if self.width:
+                starts = [item.key for item in items]
+                ends = [item.key + self.width for item in items]
+                values = [item.value for item in items]
+            else:
+                starts = [item.key for item in items]
+                ends = [item.value for item in items]
+                values = [item.size for item in items]
+            fill_colors = [item.fill_color or DEFAULT_COLORS[index % len(DEFAULT_COLORS)]
+                           for index, item in enumerate(items)]
+
+        draw_handler.draw_bars(starts, ends, values, fill_colors, horizontal=self.horizontal,
+                               aggregation=self.aggregation)
+
+        if not self.color and not self.has_labels:
+            return
+
+        # Outlines and labels only for bars at least one pixel wide:
+        key_scale = abs(draw_handler.transform.y_scale if self.horizontal else draw_handler.transform.x_scale)
+        for index in range(len(starts)):
+            if abs(ends[index] - starts[index]) * key_scale >= 1:
+                item = items[index] if items is not None else self.series[index]
+                self.draw_label_and_outline(draw_handler, item, starts[index], ends[index], values[index])
+
+    def draw_label_and_outline(self, draw_handler, item, start, end, value):
+        """ Label and (if color is set) outline of one bar """
+        if item.label:
+            if self.horizontal:
+                if item.label_position:
+                    label_position = item.label_position
+                elif value > 0:
+                    label_position = mod_main.LEFT_CENTER
+                else:
+                    label_position = mod_main.RIGHT_CENTER
+                draw_handler.draw_text(0, (start + end) / 2., item.label, mod_main.DEFAULT_LABEL_COLOR, label_position)
+            else:
+                if item.label_position:
+                    label_position = item.label_position
+                elif value > 0:
+                    label_position = mod_main.CENTER_DOWN
                 else:
-                    draw_handler.draw_line(start, 0, start, value, self.color)
-                    draw_handler.draw_line(end, value, end, 0, self.color)
-                    draw_handler.draw_line(start, value, end, value, self.color)
+                    label_position = mod_main.CENTER_UP
+                draw_handler.draw_text((start + end) / 2., 0, item.label, mod_main.DEFAULT_LABEL_COLOR, label_position)
+
+        if self.color:
+            if self.horizontal:
+                draw_handler.draw_line(0, start, value, start, self.color)
+                draw_handler.draw_line(value, end, 0, end, self.color)
+                draw_handler.draw_line(value, start, value, end, self.color)
+            else:
+                draw_handler.draw_line(start, 0, start, value, self.color)
+                draw_handler.draw_line(end, value, end, 0, self.color)
+                draw_handler.draw_line(start, value, end, value, self.color)
 
 
 class PieChart(mod_main.CoordinateSystemElement):
 
-    color = None
+    __slots__ = (
+        'color',
 
-    data_generator = None
-    center = None
-    radius = None
+        'data_generator',
+        'series',
+        'center',
+        'radius',
+    )
 
     def __init__(self, data, color=None, center=None, radius=None,
             transparency_mask=None):
         mod_main.CoordinateSystemElement.__init__(self, transparency_mask=transparency_mask)
 
-        if not data:
+        if data is None or (not mod_utils.is_buffer(data) and not data):
             raise Exception('Invalid data {0}'.format(data))
 
-        self.data_generator = get_generator(data)
+        self.series = get_series(data)
+        self.data_generator = get_generator(self.series if self.series is not None else data)
 
         self.color = self.get_color(color)
 
@@ -186,12 +582,19 @@ class PieChart(mod_main.CoordinateSystemElement):
         # If this element will resize the current bounds, execute:
         self.reload_bounds()
 
+    def materialize(self, bounds=None):
+        if self.series is None:
+            self.data_generator = get_generator(list(self.data_generator()))
+
     def reload_bounds(self):
         self.bounds.update(x=self.center[0] - self.radius * 1.25)
         self.bounds.update(x=self.center[0] + self.radius * 1.25)
         self.bounds.update(y=self.center[1] - self.radius * 1.25)
         self.bounds.update(y=self.center[1] + self.radius * 1.25)
 
+    def needs_antialiasing(self):
+        return True
+
     def draw_label(self, angle, label, draw_handler):
         assert label
         assert draw_handler
@@ -229,13 +632,16 @@ class PieChart(mod_main.CoordinateSystemElement):
     def process_image(self, draw_handler):
         sum_values = 0.
 
-        for item in self.data_generator():
-            sum_values += item.value
+        if self.series is not None:
+            sum_values = float(mod_utils.column_sum(self.series.values))
+        else:
+            for item in self.data_generator():
+                sum_values += item.value
 
         current_angle = 0
         for index, item in enumerate(self.data_generator()):
             if item.value > 0:
-                label = str(item.key)
+                label = str(item.label if item.label else get_key_label(item.key))
                 delta = 360 * item.value / sum_values
 
                 start_angle = current_angle
@@ -261,115 +667,566 @@ class PieChart(mod_main.CoordinateSystemElement):
 
 class LineChart(mod_main.CoordinateSystemElement):
 
-    color = None
-    fill_color = None
+    __slots__ = (
+        'color',
+        'fill_color',
 
-    data_generator = None
+        'data_generator',
+        'series',
 
-    def __init__(self, data, color=None, fill_color=False, transparency_mask=None):
+        # True if at least one point has a label (computed in reload_bounds()):
+        'has_labels',
+
+        # If set, big datasets are reduced to the image resolution before drawing:
+        'decimation',
+    )
+
+    def __init__(self, data, color=None, fill_color=False, transparency_mask=None, decimation=None):
+        """
+        decimation: None, DECIMATION_MIN_MAX (keep first/min/max/last point for every pixel column) or
+        DECIMATION_LTTB (Largest-Triangle-Three-Buckets with two points per pixel column)
+        """
         mod_main.CoordinateSystemElement.__init__(self, transparency_mask=transparency_mask)
 
-        if not data:
+        if data is None or (not mod_utils.is_buffer(data) and not data):
             raise Exception('Invalid data {0}'.format(data))
+        if decimation not in (None, DECIMATION_MIN_MAX, DECIMATION_LTTB):
+            raise Exception('Invalid decimation: {0}'.format(decimation))
+
+        self.decimation = decimation
 
         self.color = self.get_color(color)
         self.fill_color = self.get_color(fill_color)
 
-        prepared_data = data
-
-        self.data_generator = get_generator(prepared_data)
+        self.series = get_series(data)
+        self.data_generator = get_generator(self.series if self.series is not None else data)
 
         self.reload_bounds()
 
+    def materialize(self, bounds=None):
+        if self.series is None:
+            self.data_generator = get_generator(list(self.data_generator()))
+
     def reload_bounds(self):
+        if self.series is not None:
+            keys_min, keys_max = mod_utils.column_min_max(self.series.keys)
+            values_min, values_max = mod_utils.column_min_max(self.series.values)
+            self.bounds.update(x=keys_min, y=values_min)
+            self.bounds.update(x=keys_max, y=values_max)
+            self.has_labels = bool(self.series.labels)
+            return
+
+        self.has_labels = False
         for item in self.data_generator():
             self.bounds.update(point=(item.key, item.value))
+            if item.label:
+                self.has_labels = True
+
+    def needs_antialiasing(self):
+        return True
+
+    def append(self, item):
+        """ Append one data() item (see append_all()) """
+        self.append_all((item,))
+
+    def append_all(self, items):
+        """
+        Append data() items to the line. If the chart data is not a ChartSeries, it is converted to one
+        first. Note that the coordinate system bounds are updated only if appended with
+        CoordinateSystem.append_all().
+        """
+        if self.series is None:
+            self.series = ChartSeries.from_data(self.data_generator)
+            self.data_generator = get_generator(self.series)
+
+        for item in items:
+            self.series.append(*item)
+            self.bounds.update(x=item[0], y=item[1])
+            if len(item) > 3 and item[3]:
+                self.has_labels = True
+
+    def get_draw_state(self):
+        # Only appending changes the line:
+        return len(self.series) if self.series is not None else None
+
+    def get_dirty_image_box(self, draw_handler, previous_state):
+        if previous_state is None or previous_state > len(self.series) or self.decimation == DECIMATION_LTTB:
+            return mod_main.CoordinateSystemElement.get_dirty_image_box(self, draw_handler, previous_state)
+
+        # The new points and the segment connecting them with the last previous point:
+        first = max(previous_state - 1, 0)
+        keys = self.series.keys[first:]
+        values = self.series.values[first:]
+
+        if any(index >= first for index in self.series.labels):
+            return mod_main.CoordinateSystemElement.get_dirty_image_box(self, draw_handler, previous_state)
+
+        left, right = mod_utils.column_min_max(keys)
+        bottom, top = mod_utils.column_min_max(values)
+        if self.fill_color or self.series.fill_colors:
+            # Fill polygons go down to 0:
+            bottom, top = mod_utils.min_max(0, bottom, top)
+
+        if self.decimation == DECIMATION_MIN_MAX:
+            # Points kept in the last previous point's pixel column (and the segment coming to
+            # that column) may change, too:
+            column_width = (draw_handler.bounds.right - draw_handler.bounds.left) / float(draw_handler.bounds.image_width)
+            left = left - 2 * column_width
+            bottom, top = draw_handler.bounds.bottom, draw_handler.bounds.top
+
+        return self.get_bounds_image_box(left, right, bottom, top, 1, draw_handler)
+
+    def get_image_box(self, draw_handler):
+        if self.has_labels or not self.bounds.is_set():
+            return None
+
+        # Fill polygons go down to 0:
+        bottom, top = mod_utils.min_max(0, self.bounds.bottom, self.bounds.top)
+
+        return self.get_bounds_image_box(self.bounds.left, self.bounds.right, bottom, top, 1, draw_handler)
+
+    def get_decimated_indexes(self, keys, values, labeled_indexes, draw_handler):
+        left, right = draw_handler.bounds.left, draw_handler.bounds.right
+
+        # Only the visible points (and one more on each side) are decimated:
+        start, end = mod_utils.get_visible_range(keys, left, right)
+        keys, values = keys[start:end], values[start:end]
+
+        columns = int(draw_handler.bounds.image_width)
+        if self.decimation == DECIMATION_LTTB:
+            indexes = decimate_lttb(keys, values, 2 * columns)
+        else:
+            indexes = decimate_min_max(keys, values, left, right, columns)
+
+        # Labeled points are never removed:
+        indexes = set(start + index for index in indexes)
+        indexes.update(labeled_indexes)
+
+        return sorted(indexes)
+
+    def get_points(self, draw_handler):
+        """ Returns the points to be drawn, decimated to the image resolution if needed. """
+        if not self.decimation:
+            return self.data_generator()
+
+        if self.series is not None:
+            points = self.series
+            keys, values = self.series.keys, self.series.values
+            labeled_indexes = self.series.labels.keys()
+        else:
+            points = list(self.data_generator())
+            keys = [point.key for point in points]
+            values = [point.value for point in points]
+            labeled_indexes = [i for i, point in enumerate(points) if point.label]
+
+        indexes = self.get_decimated_indexes(keys, values, labeled_indexes, draw_handler)
+
+        return [points[i] for i in indexes]
+
+    def process_series_image(self, draw_handler):
+        """ Draw a series without per point colors directly from its columns """
+        keys, values = self.series.keys, self.series.values
+
+        if self.decimation:
+            indexes = self.get_decimated_indexes(keys, values, self.series.labels.keys(), draw_handler)
+            keys, values = mod_utils.take(keys, indexes), mod_utils.take(values, indexes)
+
+        color = self.get_color_with_transparency(self.color if self.color else mod_main.DEFAULT_ELEMENT_COLOR)
+        fill_color = self.get_color_with_transparency(self.fill_color) if self.fill_color else None
+
+        # Labels are drawn when their point is reached (i.e. before the rest of the line), so the
+        # line is split on labeled points:
+        start = 0
+        for index in sorted(self.series.labels):
+            position = mod_bisect.bisect_left(indexes, index) if self.decimation else index
+            draw_handler.draw_polyline_xy(keys[start:position + 1], values[start:position + 1], color, fill_color)
+            start = position
+
+            point = self.series[index]
+            label_position = point.label_position if point.label_position else mod_main.CENTER_UP
+            label_color = point.color if point.color else mod_main.DEFAULT_LABEL_COLOR
+
+            draw_handler.draw_text(point.key, point.value, point.label, label_color, label_position)
+
+        draw_handler.draw_polyline_xy(keys[start:], values[start:], color, fill_color)
 
     def process_image(self, draw_handler):
-        for i, point in enumerate(self.data_generator()):
-            if i > 0:
+        if self.series is not None and not self.series.has_colors():
+            self.process_series_image(draw_handler)
+            return
+
+        # Consecutive segments with the same colors are drawn as one polyline (a labeled point
+        # ends the polyline, because the label is drawn before the rest of the line):
+        run = []
+        run_colors = None
+        previous = None
+        for point in self.get_points(draw_handler):
+            if previous != None:
                 fill_color = point.fill_color if point.fill_color else self.fill_color
                 color = point.color if point.color else self.color
                 if not color:
                     color = mod_main.DEFAULT_ELEMENT_COLOR
 
-                x1, y1 = previous[0], previous[1]
-                x2, y2 = point[0], point[1]
-                if fill_color:
-                    draw_handler.draw_polygon(
-                        [(x1, 0), (x1, y1), (x2, y2), (x2, 0)],
-                        fill_color = self.get_color_with_transparency(fill_color)
-                   )
-                draw_handler.draw_line(x1, y1, x2, y2, self.get_color_with_transparency(color))
+                if (color, fill_color) != run_colors:
+                    self.draw_run(run, run_colors, draw_handler)
+                    run = [previous]
+                    run_colors = color, fill_color
+
+                run.append((point.key, point.value))
 
             if point.label:
+                self.draw_run(run, run_colors, draw_handler)
+                run = [(point.key, point.value)]
+
                 label_position = point.label_position if point.label_position else mod_main.CENTER_UP
                 label_color = point.color if point.color else mod_main.DEFAULT_LABEL_COLOR
 
                 draw_handler.draw_text(point.key, point.value, point.label, label_color, label_position)
 
-            previous = point
+            previous = (point.key, point.value)
 
-class Function(mod_main.CoordinateSystemElement):
+        self.draw_run(run, run_colors, draw_handler)
+
+    def draw_run(self, points, colors, draw_handler):
+        if len(points) < 2:
+            return
+
+        color, fill_color = colors
+        draw_handler.draw_polyline(
+            points,
+            self.get_color_with_transparency(color),
+            fill_color=self.get_color_with_transparency(fill_color) if fill_color else None)
+
+class ScatterChart(mod_main.CoordinateSystemElement):
+    """
+    Scatter chart for big datasets (millions of points). Points are not drawn one by one, but
+    counted per pixel, and the counts drawn (colored by density) as one image.
+    """
 
-    function = None
-    step = None
-    start = None
-    end = None
-    points = None
-    color = None
-    fill_color = None
+    __slots__ = (
+        'series',
 
-    def __init__(self, function, start=None, end=None, step=None, fill_color=False, color=None, transparency_mask=None):
+        # Gradient (two or more colors) from the least to the most dense pixels:
+        'colors',
+
+        # If True, colors are interpolated by the logarithm of the number of points in a pixel:
+        'log_scale',
+    )
+
+    def __init__(self, data, colors=None, log_scale=True, transparency_mask=None):
+        """
+        data: ChartSeries, buffers (see get_series()) or a list (or generator function) of data()
+        items. Point sizes, if given, are used as weights (instead of counting points).
+        """
+        mod_main.CoordinateSystemElement.__init__(self, transparency_mask=transparency_mask)
+
+        if data is None or (not mod_utils.is_buffer(data) and not data):
+            raise Exception('Invalid data {0}'.format(data))
+
+        self.colors = [self.get_color(color) for color in (colors if colors else DEFAULT_DENSITY_COLORS)]
+        if len(self.colors) < 2:
+            raise Exception('Invalid colors (at least two needed): {0}'.format(colors))
+
+        self.log_scale = log_scale
+
+        self.series = get_series(data)
+        if self.series is None:
+            self.series = ChartSeries.from_data(get_generator(data))
+
+        self.reload_bounds()
+
+    def reload_bounds(self):
+        if not len(self.series):
+            return
+
+        keys_min, keys_max = mod_utils.column_min_max(self.series.keys)
+        values_min, values_max = mod_utils.column_min_max(self.series.values)
+        self.bounds.update(x=keys_min, y=values_min)
+        self.bounds.update(x=keys_max, y=values_max)
+
+    def get_image_box(self, draw_handler):
+        if not self.bounds.is_set():
+            return None
+
+        return self.get_bounds_image_box(self.bounds.left, self.bounds.right, self.bounds.bottom,
+                                         self.bounds.top, 1, draw_handler)
+
+    def process_image(self, draw_handler):
+        if not len(self.series):
+            return
+
+        draw_handler.draw_density(self.series.keys, self.series.values, mod_colors.get_colormap(self.colors),
+                                  weights=self.series.sizes, log_scale=self.log_scale, alpha=self.transparency_mask)
+
+# Function samples are evaluated (and cached) in blocks of:
+FUNCTION_BLOCK_SIZE = 1024
+
+# Cache of evaluated function samples blocks, shared by all Function elements:
+FUNCTION_SAMPLES_CACHE = mod_utils.LRUCache(max_size=1024)
+
+class Function(mod_main.CoordinateSystemElement):
+    """
+    Function graph. The function is evaluated lazily, when drawn, and only on the part of [start, end]
+    visible in the image. Samples are computed in blocks of FUNCTION_BLOCK_SIZE on a fixed grid and
+    kept in FUNCTION_SAMPLES_CACHE, so the same function drawn again (panned, zoomed or with another
+    image size) reuses already computed values.
+    """
+
+    __slots__ = (
+        'function',
+        'step',
+        'start',
+        'end',
+        'color',
+        'fill_color',
+
+        # If True, function is called with a NumPy array of all x values (and must return an array):
+        'vectorized',
+
+        # If True, the function is sampled when drawn at the image resolution, and refined where the
+        # linear interpolation is more than tolerance pixels off:
+        'adaptive',
+        'tolerance',
+
+        # If False, FUNCTION_SAMPLES_CACHE is not used:
+        'cache',
+
+        # Given (or, after compute(), all computed) x and y columns:
+        'xs',
+        'ys',
+    )
+
+    def __init__(self, function, start=None, end=None, step=None, fill_color=False, color=None, transparency_mask=None,
+                 vectorized=False, adaptive=False, tolerance=None, cache=True):
+        """
+        function: a function of x, or already computed (x, y) samples in any form accepted by
+        get_series() (for example a NumPy array with shape (n, 2)).
+        vectorized: function accepts and returns NumPy arrays (needs NumPy)
+        adaptive: sample the function at the image resolution, with more samples where it is not
+        smooth. step is then used only to compute bounds.
+        tolerance: maximum error (in pixels) of adaptive sampling, default 0.5
+        cache: reuse samples from (and store them in) FUNCTION_SAMPLES_CACHE
+        """
         mod_main.CoordinateSystemElement.__init__(self, transparency_mask=transparency_mask)
 
-        if not function:
+        series = get_series(function) if not callable(function) else None
+
+        if series is None and not function:
             raise Exception('Invalid function: {0}'.format(function))
+        if vectorized and mod_utils.mod_numpy is None:
+            raise Exception('Vectorized functions need NumPy')
+        if adaptive and series is not None:
+            raise Exception('Adaptive sampling needs a function')
 
-        self.function = function
+        self.function = function if series is None else None
         self.step = float(step if step else 0.1)
         self.start = start if start != None else -1
         self.end = end if end != None else -1
 
+        self.vectorized = bool(vectorized)
+        self.adaptive = bool(adaptive)
+        self.tolerance = float(tolerance) if tolerance else 0.5
+        self.cache = bool(cache)
+
         self.fill_color = self.get_color(fill_color)
         self.color = self.get_color(color if color else mod_main.DEFAULT_ELEMENT_COLOR)
 
-        self.points = []
+        if series is not None:
+            if len(series) < 2:
+                raise Exception('Function needs at least two samples')
+            self.xs, self.ys = series.keys, series.values
+            self.start, self.end = mod_utils.column_min_max(self.xs)
+            return
 
         if not self.start < self.end:
             raise Exception('Invalid function start ({0}) and end ({1})'.format(self.start, self.end))
         if not self.step > 0:
             raise Exception('Invalid function step: {0}'.format(self.step))
 
+        # Nothing is computed until needed (for bounds, or when drawn)
+
+    @property
+    def points(self):
+        """ List of computed (x, y) points """
         self.compute()
+        return list(zip(self.xs, self.ys))
 
-    def compute(self):
-        self.points = []
+    def get_samples_count(self):
         # TODO: int or floor/ceil ?
-        for i in range(int((self.end - self.start) / self.step)):
-            x = self.start + i * self.step
-            y = self.function(x)
-            point = (x, y)
-            self.points.append(point)
+        return int((self.end - self.start) / self.step)
+
+    def evaluate(self, xs):
+        """ Returns the list of function values for all xs """
+        if self.vectorized:
+            return mod_utils.mod_numpy.asarray(self.function(mod_utils.mod_numpy.asarray(xs, dtype=float)), dtype=float).tolist()
+        return [self.function(x) for x in xs]
+
+    def get_grid_samples(self, origin, step, first, last, domain_first, domain_last):
+        """
+        Returns xs and ys columns for x = origin + i * step, first <= i <= last. Values are evaluated
+        in blocks of FUNCTION_BLOCK_SIZE (but never outside domain_first <= i <= domain_last) and
+        cached.
+        """
+        xs, ys = mod_array.array('d'), mod_array.array('d')
+
+        first, last = max(first, domain_first), min(last, domain_last)
+        if first > last:
+            return xs, ys
+
+        for block in range(first // FUNCTION_BLOCK_SIZE, last // FUNCTION_BLOCK_SIZE + 1):
+            block_first = max(domain_first, block * FUNCTION_BLOCK_SIZE)
+            block_last = min(domain_last, (block + 1) * FUNCTION_BLOCK_SIZE - 1)
+
+            key = (self.function, self.vectorized, origin, step, block_first, block_last)
+            samples = FUNCTION_SAMPLES_CACHE.get(key) if self.cache else None
+            if samples is None:
+                block_xs = [origin + i * step for i in range(block_first, block_last + 1)]
+                samples = mod_array.array('d', block_xs), mod_array.array('d', self.evaluate(block_xs))
+                if self.cache:
+                    FUNCTION_SAMPLES_CACHE.put(key, samples)
+
+            from_index = max(first, block_first) - block_first
+            to_index = min(last, block_last) - block_first + 1
+            xs.extend(samples[0][from_index:to_index])
+            ys.extend(samples[1][from_index:to_index])
+
+        return xs, ys
+
+    def compute(self):
+        """ Compute all samples on [start, end) """
+        if self.function is None or self.xs is not None:
+            return
+
+        count = self.get_samples_count()
+        self.xs, self.ys = self.get_grid_samples(self.start, self.step, 0, count - 1, 0, count - 1)
+
+    def refine(self, xs, ys, y_scale, max_depth=10):
+        """
+        Bisects (up to max_depth times) all segments where the function value in the middle is more
+        than tolerance pixels away from the line between the segment ends. y_scale is the number of
+        pixels per y unit.
+        """
+        xs, ys = list(xs), list(ys)
+
+        # Indexes of segments (xs[i], xs[i + 1]) which may need more samples:
+        active = range(len(xs) - 1)
+        for depth in range(max_depth):
+            middle_xs = [(xs[i] + xs[i + 1]) / 2. for i in active]
+            if not middle_xs:
+                break
+            middle_ys = self.evaluate(middle_xs)
+
+            refine = {}
+            for i, middle_x, middle_y in zip(active, middle_xs, middle_ys):
+                if abs(middle_y - (ys[i] + ys[i + 1]) / 2.) * y_scale > self.tolerance:
+                    refine[i] = middle_x, middle_y
+
+            if not refine:
+                break
+
+            new_xs, new_ys, active = [], [], []
+            for i in range(len(xs)):
+                new_xs.append(xs[i])
+                new_ys.append(ys[i])
+                if i in refine:
+                    active.append(len(new_xs) - 1)
+                    new_xs.append(refine[i][0])
+                    new_ys.append(refine[i][1])
+                    active.append(len(new_xs) - 1)
+            xs, ys = new_xs, new_ys
+
+        return xs, ys
+
+    def compute_adaptive(self, start, end, columns, y_scale, max_depth=10):
+        """
+        Samples the function on [start, end] at least once for every one of the pixel columns, and then
+        refines it (see refine()). To be reusable for other images the initial samples are on a grid
+        with a power of 2 step.
+        """
+        step = 2. ** mod_math.floor(mod_math.log((end - start) / float(columns), 2))
+
+        first = int(mod_math.ceil(start / step))
+        last = int(mod_math.floor(end / step))
+        grid_xs, grid_ys = self.get_grid_samples(0, step, first, last, first, last)
+
+        xs, ys = [start], self.evaluate([start])
+        for x, y in zip(grid_xs, grid_ys):
+            if start < x < end:
+                xs.append(x)
+                ys.append(y)
+        xs.append(end)
+        ys.extend(self.evaluate([end]))
+
+        return self.refine(xs, ys, y_scale, max_depth=max_depth)
+
+    def get_samples(self, draw_handler):
+        """ Returns the xs and ys columns to be drawn, only for the visible part of the function """
+        if self.function is None:
+            return self.xs, self.ys
+
+        left, right = draw_handler.bounds.left, draw_handler.bounds.right
+
+        if self.adaptive:
+            start = max(self.start, left)
+            end = min(self.end, right)
+            if not start < end:
+                return (), ()
+
+            columns = max(int(mod_math.ceil((end - start) * abs(draw_handler.transform.x_scale))), 1)
+
+            return self.compute_adaptive(start, end, columns, abs(draw_handler.transform.y_scale))
+
+        first, last = self.get_samples_range(left, right)
+
+        return self.get_grid_samples(self.start, self.step, first, last, 0, self.get_samples_count() - 1)
+
+    def get_samples_range(self, left, right):
+        """ (first, last) indexes of samples needed to draw the function between left and right """
+        # One more sample on every side, so that the line continues out of the image:
+        first = int(mod_math.floor((left - self.start) / self.step)) - 1
+        last = int(mod_math.ceil((right - self.start) / self.step)) + 1
+
+        return first, last
+
+    def materialize(self, bounds=None):
+        """
+        Compute all samples on [start, end) (or, if bounds are given, only those needed to draw the
+        function between bounds.left and bounds.right) and drop the function. Adaptive functions are
+        then drawn with samples on the step grid, without refinement.
+        """
+        if self.function is not None and self.xs is None and bounds is not None:
+            first, last = self.get_samples_range(bounds.left, bounds.right)
+            self.xs, self.ys = self.get_grid_samples(self.start, self.step, first, last, 0, self.get_samples_count() - 1)
+
+        self.compute()
+        self.function = None
+        self.adaptive = False
 
     def reload_bounds(self):
-        for point in self.points:
-            self.bounds.update(point=point)
+        self.compute()
 
-    def process_image(self, draw_handler):
+        xs_min, xs_max = mod_utils.column_min_max(self.xs)
+        ys_min, ys_max = mod_utils.column_min_max(self.ys)
+        self.bounds.update(x=xs_min, y=ys_min)
+        self.bounds.update(x=xs_max, y=ys_max)
+
+    def needs_antialiasing(self):
+        return True
 
-        for i, point in enumerate(self.points):
-            if i > 0:
-                previous = self.points[i - 1]
+    def get_image_box(self, draw_handler):
+        # Adaptive sampling may find values out of the bounds computed with step:
+        if self.adaptive or not self.bounds.is_set():
+            return None
 
-                x1, y1 = previous[0], previous[1]
-                x2, y2 = point[0], point[1]
+        bottom, top = mod_utils.min_max(0, self.bounds.bottom, self.bounds.top)
 
-                if self.fill_color:
-                    draw_handler.draw_polygon(
-                        [(x1, 0), (x1, y1), (x2, y2), (x2, 0)],
-                        fill_color = self.get_color_with_transparency(self.fill_color)
-                   )
-                draw_handler.draw_line(x1, y1, x2, y2, self.get_color_with_transparency(self.color))
+        return self.get_bounds_image_box(self.bounds.left, self.bounds.right, bottom, top, 1, draw_handler)
+
+    def process_image(self, draw_handler):
+        xs, ys = self.get_samples(draw_handler)
 
+        if len(xs) < 2:
+            return
 
+        fill_color = self.get_color_with_transparency(self.fill_color) if self.fill_color else None
+        draw_handler.draw_polyline_xy(xs, ys, self.get_color_with_transparency(self.color), fill_color)
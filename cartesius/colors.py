@@ -2,6 +2,37 @@
 
 """ Utility functions folr colors """
 
+from . import utils as mod_utils
+
+# Default color palete from: http://www.colourlovers.com/pattern/2429885/Spring_flower_aerial
+DEFAULT_COLORS = (
+        (141, 198, 183),
+        (207, 249, 117),
+        (230, 193, 238),
+        (242, 229, 229),
+)
+
+# Gradients (from the color of the lowest to the color of the highest value) for get_colormap():
+BLUES = (
+        (158, 202, 225),
+        (8, 48, 107),
+)
+GRAYS = (
+        (230, 230, 230),
+        (20, 20, 20),
+)
+HEAT = (
+        (255, 255, 178),
+        (253, 141, 60),
+        (189, 0, 38),
+)
+
+# Number of colors in colormap lookup tables:
+COLORMAP_SIZE = 256
+
+# Colormaps, by (gradient, size), see get_colormap():
+COLORMAPS_CACHE = mod_utils.LRUCache(max_size=64)
+
 def get_color(color):
     """ Can convert from integer to (r, g, b) """
     if not color:
@@ -39,3 +70,64 @@ def get_color_between(color1, color2, i):
     return (int(color1[0] + (color2[0] - color1[0]) * i),
             int(color1[1] + (color2[1] - color1[1]) * i),
             int(color1[2] + (color2[2] - color1[2]) * i))
+
+def get_colormap(gradient, size=COLORMAP_SIZE):
+    """
+    Lookup table (a tuple of size (r, g, b) colors) interpolated from gradient (two or more colors,
+    for example BLUES or DEFAULT_COLORS). The first color is gradient[0], the last gradient[-1].
+    """
+    gradient = tuple(tuple(get_color(color)) for color in gradient)
+    if len(gradient) < 2:
+        raise Exception('Invalid gradient (at least two colors needed): {0}'.format(gradient))
+
+    key = (gradient, size)
+
+    result = COLORMAPS_CACHE.get(key)
+    if result is None:
+        colors = []
+        for i in range(size):
+            position = i * (len(gradient) - 1) / float(size - 1)
+            index = min(int(position), len(gradient) - 2)
+            colors.append(get_color_between(gradient[index], gradient[index + 1], position - index))
+        result = tuple(colors)
+        COLORMAPS_CACHE.put(key, result)
+
+    return result
+
+def map_colors(values, colormap, min_value=None, max_value=None, alpha=None):
+    """
+    Colors of all values from the colormap (see get_colormap()): min_value gets colormap[0] and
+    max_value colormap[-1] (by default the min and max of values, if all values are equal they get
+    colormap[-1]), values out of that range the first or last color.
+
+    With NumPy the result is a uint8 array with shape (len(values), 3), or (len(values), 4) if alpha
+    is set. Without NumPy a list of (r, g, b) or (r, g, b, alpha) tuples.
+    """
+    if mod_utils.mod_numpy is not None:
+        values = mod_utils.mod_numpy.asarray(values, dtype=float)
+
+    if min_value is None or max_value is None:
+        values_min, values_max = mod_utils.column_min_max(values)
+        min_value = values_min if min_value is None else min_value
+        max_value = values_max if max_value is None else max_value
+
+    last = len(colormap) - 1
+    equal = max_value is None or max_value <= min_value
+
+    if mod_utils.mod_numpy is not None:
+        numpy = mod_utils.mod_numpy
+        if equal:
+            levels = numpy.full(len(values), last)
+        else:
+            levels = ((values - min_value) * (last / float(max_value - min_value))).round()
+            levels = numpy.clip(levels, 0, last).astype(int)
+        table = numpy.asarray(colormap, dtype=numpy.uint8)
+        if alpha is not None:
+            table = numpy.column_stack((table, numpy.full(len(table), alpha, dtype=numpy.uint8)))
+        return table[levels]
+
+    table = [tuple(color) + ((alpha,) if alpha is not None else ()) for color in colormap]
+    if equal:
+        return [table[last]] * len(values)
+    coef = last / float(max_value - min_value)
+    return [table[min(max(int(round((value - min_value) * coef)), 0), last)] for value in values]
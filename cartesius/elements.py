@@ -4,6 +4,7 @@ import re as mod_re
 import math as mod_math
 
 from . import main as mod_main
+from . import utils as mod_utils
 
 """
 # Element class template (use this for new elements):
@@ -11,6 +12,10 @@ from . import main as mod_main
 class MyElement(mod_main.CoordinateSystemElement):
     \"\"\" Abstract class, every subclass should detect bounds and have the code to draw this item \"\"\"
 
+    # Optional, less memory for scenes with many elements (all attributes are set to None in
+    # CoordinateSystemElement.__init__()):
+    __slots__ = ('...params...',)
+
     def __init__(self, ...params..., transparency_mask=None):
         mod_main.CoordinateSystemElement.__init__(self, transparency_mask=transparency_mask)
 
@@ -37,27 +42,42 @@ class Axis(mod_main.CoordinateSystemElement):
     Axis can, also, be default ((0,0) as center) or detached (if (0,0) if not the center).
     """
 
-    horizontal = None
-    color = None
-    label_color = None
+    __slots__ = (
+        'horizontal',
+        'color',
+        'label_color',
+
+        # If set, draw label every:
+        'labels',
+        'labels_suffix',
+        'labels_decorator',
+        'label_position',
+
+        # If set, draw point every:
+        'points',
 
-    # If set, draw label every:
-    labels = None
-    labels_suffix = None
+        # Minimal distance (in pixels, before antialiasing) between points. If the points step would
+        # be denser, a bigger "nice" multiple of it is used:
+        'min_points_distance',
 
-    # If set, draw point every:
-    points = None
+        # Minimal space (in pixels, before antialiasing) between two labels:
+        'min_labels_distance',
 
-    hide_positive = None
-    hide_negative = None
+        'hide_positive',
+        'hide_negative',
 
-    center = None
+        'center',
+    )
 
     def __init__(self, horizontal=False, vertical=False, color=None, labels=None, labels_decorator=None,
             label_color=None, label_position=None, points=None, transparency_mask=None, hide_positive=False,
-            hide_negative=False, hide=False, detached_center=None):
+            hide_negative=False, hide=False, detached_center=None, min_points_distance=None,
+            min_labels_distance=None):
         """
         labels: May be an integer, or string like '100m' or dict like {1000:'one km', 500:'half km'}
+        min_points_distance, min_labels_distance: the points and labels steps are automatically
+        increased if points would be closer than min_points_distance pixels or labels would be
+        closer than min_labels_distance pixels (plus the label size).
         """
         mod_main.CoordinateSystemElement.__init__(self, transparency_mask=transparency_mask)
 
@@ -85,6 +105,9 @@ class Axis(mod_main.CoordinateSystemElement):
 
         self.points = float(points) if points else 1
 
+        self.min_points_distance = min_points_distance if min_points_distance != None else 5
+        self.min_labels_distance = min_labels_distance if min_labels_distance != None else 5
+
         if self.horizontal:
             self.label_position = label_position if label_position else mod_main.CENTER_DOWN
         else:
@@ -113,6 +136,16 @@ class Axis(mod_main.CoordinateSystemElement):
     def is_detached(self):
         return self.center[0] != 0 or self.center[1] != 0
 
+    def get_cache_key(self):
+        if self.transparency_mask != 255:
+            # Transparent axes can't be drawn on a cached overlay
+            return None
+        labels = tuple(sorted(self.labels.items())) if isinstance(self.labels, dict) else self.labels
+        return (self.__class__.__name__, self.horizontal, self.color, self.label_color, labels,
+                self.labels_suffix, self.labels_decorator, self.points, self.label_position,
+                self.hide_positive, self.hide_negative, tuple(self.center), self.min_points_distance,
+                self.min_labels_distance, self.transparency_mask)
+
     def reload_bounds(self):
         # not important
         pass
@@ -139,25 +172,68 @@ class Axis(mod_main.CoordinateSystemElement):
 
         return start, end
 
+    def get_density_step(self, step, min_distance, draw_handler):
+        """
+        Returns step, or (if the given step is denser than min_distance pixels) the smallest "nice"
+        multiple of step with ticks at least min_distance pixels apart.
+        """
+        if self.horizontal:
+            pixels_per_unit = abs(draw_handler.transform.x_scale)
+        else:
+            pixels_per_unit = abs(draw_handler.transform.y_scale)
+
+        step_pixels = step * pixels_per_unit
+        if step_pixels >= min_distance:
+            return step
+
+        return step * mod_utils.get_nice_step(min_distance / float(step_pixels))
+
+    def get_labels_step(self, draw_handler):
+        """ Labels step, increased if labels would overlap. """
+        if self.horizontal:
+            lower_bound, higher_bound = draw_handler.bounds.left - self.center[0], draw_handler.bounds.right - self.center[0]
+        else:
+            lower_bound, higher_bound = draw_handler.bounds.bottom - self.center[1], draw_handler.bounds.top - self.center[1]
+
+        step = self.labels
+        for i in range(10):
+            # The longest labels are usually the ones at the ends of the axis:
+            labels_from, labels_to = self.get_start_end(step, lower_bound, higher_bound)
+            label_sizes = [draw_handler.get_text_size(self.get_label(n)) for n in (labels_from, labels_to, step)]
+            if self.horizontal:
+                label_size = max(width for width, height in label_sizes)
+            else:
+                label_size = max(height for width, height in label_sizes)
+
+            min_distance = label_size + self.min_labels_distance * draw_handler.antialiasing_coef
+            new_step = self.get_density_step(step, min_distance, draw_handler)
+            if new_step == step:
+                return step
+            step = new_step
+
+        return step
+
     def draw_points(self, draw_handler):
         if not self.points:
             return
 
+        step = self.get_density_step(self.points, self.min_points_distance * draw_handler.antialiasing_coef, draw_handler)
+
         if self.horizontal:
             points_from, points_to = self.get_start_end(
-                    self.points,
+                    step,
                     draw_handler.bounds.left - self.center[0],
                     draw_handler.bounds.right - self.center[0])
         else:
             points_from, points_to = self.get_start_end(
-                    self.points,
+                    step,
                     draw_handler.bounds.bottom - self.center[1],
                     draw_handler.bounds.top - self.center[1])
 
         i = points_from
         while i <= points_to:
             self.draw_point(i, draw_handler)
-            i += self.points
+            i += step
 
     def draw_point(self, i, draw_handler):
         if self.horizontal:
@@ -175,21 +251,37 @@ class Axis(mod_main.CoordinateSystemElement):
             for i, label in self.labels.items():
                 self.draw_label(i, draw_handler, label=label)
         else:
+            step = self.get_labels_step(draw_handler)
+
             if self.horizontal:
                 labels_from, labels_to = self.get_start_end(
-                        self.labels,
+                        step,
                         draw_handler.bounds.left - self.center[0],
                         draw_handler.bounds.right - self.center[0])
             else:
                 labels_from, labels_to = self.get_start_end(
-                        self.labels,
+                        step,
                         draw_handler.bounds.bottom - self.center[1],
                         draw_handler.bounds.top - self.center[1])
 
             i = labels_from
             while i <= labels_to:
                 self.draw_label(i, draw_handler)
-                i += self.labels
+                i += step
+
+    def get_label(self, i):
+        if i == int(i):
+            i = int(i)
+
+        if self.labels_decorator:
+            label = str(self.labels_decorator(i))
+        else:
+            label = str(i)
+
+        if self.labels_suffix:
+            label += self.labels_suffix
+
+        return label
 
     def draw_label(self, i, draw_handler, label=None):
         if i == 0:
@@ -201,13 +293,7 @@ class Axis(mod_main.CoordinateSystemElement):
         if label:
             label = str(label)
         else:
-            if self.labels_decorator:
-                label = str(self.labels_decorator(i))
-            else:
-                label = str(i)
-
-            if self.labels_suffix:
-                label += self.labels_suffix
+            label = self.get_label(i)
 
         x, y = self.get_point(i)
         x, y = x + self.center[0], y + self.center[1]
@@ -251,10 +337,13 @@ class Axis(mod_main.CoordinateSystemElement):
 
 class Point(mod_main.CoordinateSystemElement):
 
-    style = None
-    label_position = None
-    position = None
-    color = None
+    __slots__ = (
+        'style',
+        'label',
+        'label_position',
+        'position',
+        'color',
+    )
 
     def __init__(self, position, label=None, label_position=None, style=None,
             color=None, transparency_mask=None):
@@ -280,17 +369,115 @@ class Point(mod_main.CoordinateSystemElement):
     def reload_bounds(self):
         self.bounds.update(point=self.position)
 
+    def needs_antialiasing(self):
+        return self.style in ('x', 'o')
+
+    def get_image_box(self, draw_handler):
+        margin = 3
+        if self.label:
+            label_width, label_height = draw_handler.get_text_size(self.label)
+            margin += 4 + max(label_width, label_height) / float(draw_handler.antialiasing_coef)
+        return self.get_bounds_image_box(self.position[0], self.position[0], self.position[1], self.position[1],
+                                         margin, draw_handler)
+
     def process_image(self, draw_handler):
         draw_handler.draw_point(self.position[0], self.position[1], style=self.style,
                 color = self.color, label = self.label, label_position = self.label_position)
 
+class Points(mod_main.CoordinateSystemElement):
+    """
+    Many points with the same style and color. Positions are kept in two (x and y) columns, and
+    markers drawn from a cached mask (see PILHandler.draw_markers()), so this is much faster (and
+    uses much less memory) than one Point element per point.
+    """
+
+    __slots__ = (
+        'xs',
+        'ys',
+
+        # Sparse {index: label} dictionary:
+        'labels',
+        'label_position',
+
+        'style',
+        'color',
+    )
+
+    def __init__(self, xs, ys, labels=None, label_position=None, style=None, color=None, transparency_mask=None):
+        """
+        xs, ys: coordinates columns (lists, array.array or NumPy arrays)
+        labels: None, {index: label} dictionary or a sequence of labels (None for points without
+        label), same length as xs
+        """
+        mod_main.CoordinateSystemElement.__init__(self, transparency_mask=transparency_mask)
+
+        self.xs = mod_utils.to_column(xs)
+        self.ys = mod_utils.to_column(ys)
+
+        if len(self.xs) != len(self.ys):
+            raise Exception('xs ({0}) and ys ({1}) must have the same length'.format(len(self.xs), len(self.ys)))
+
+        if style not in (None, '.', '+', 'x', 'o', ' '):
+            raise Exception('Invalid style: {0}, valid: ".", "x", "+", "o" and " "'.format(style))
+
+        if label_position:
+            if not len(label_position) == 2:
+                raise Exception('Invalid label position {0}'.format(label_position))
+        else:
+            label_position = mod_main.CENTER_DOWN
+
+        if labels is None:
+            labels = {}
+        elif not isinstance(labels, dict):
+            labels = dict((index, label) for index, label in enumerate(labels) if label)
+
+        self.labels = dict((index, str(label)) for index, label in labels.items())
+        self.label_position = label_position
+        self.style = style if style else '+'
+        self.color = self.get_color(color if color else mod_main.DEFAULT_POINT_COLOR)
+
+        self.reload_bounds()
+
+    def reload_bounds(self):
+        if not len(self.xs):
+            return
+
+        x_min, x_max = mod_utils.column_min_max(self.xs)
+        y_min, y_max = mod_utils.column_min_max(self.ys)
+        self.bounds.update(x=x_min, y=y_min)
+        self.bounds.update(x=x_max, y=y_max)
+
+    def needs_antialiasing(self):
+        return self.style in ('x', 'o')
+
+    def get_image_box(self, draw_handler):
+        if self.labels or not self.bounds.is_set():
+            return None
+        return self.get_bounds_image_box(self.bounds.left, self.bounds.right, self.bounds.bottom, self.bounds.top,
+                                         3, draw_handler)
+
+    def process_image(self, draw_handler):
+        color = self.get_color_with_transparency(self.color)
+
+        draw_handler.draw_markers(self.xs, self.ys, color, style=self.style)
+
+        for index in sorted(self.labels):
+            draw_handler.draw_text(self.xs[index], self.ys[index], self.labels[index], color,
+                                   label_position=self.label_position)
+
 class Grid(mod_main.CoordinateSystemElement):
 
-    horizontal = None
-    vertical = None
-    color = None
+    __slots__ = (
+        'horizontal',
+        'vertical',
+        'color',
+
+        # Minimal distance (in pixels, before antialiasing) between grid lines. If lines would be
+        # denser, a bigger "nice" multiple of the grid step is used:
+        'min_distance',
+    )
 
-    def __init__(self, horizontal, vertical, color=None, transparency_mask=None):
+    def __init__(self, horizontal, vertical, color=None, transparency_mask=None, min_distance=None):
         mod_main.CoordinateSystemElement.__init__(self, transparency_mask=transparency_mask)
 
         if not horizontal and not vertical:
@@ -299,6 +486,7 @@ class Grid(mod_main.CoordinateSystemElement):
         self.horizontal = float(horizontal) if horizontal else None
         self.vertical = float(vertical) if vertical else None
         self.color = self.get_color(color if color else mod_main.DEFAULT_GRID_COLOR)
+        self.min_distance = min_distance if min_distance != None else 3
 
         #Bounds are not important for axes:
         #self.reload_bounds()
@@ -307,32 +495,47 @@ class Grid(mod_main.CoordinateSystemElement):
         # not important
         pass
 
+    def get_lines(self, step, pixels_per_unit, lower_bound, higher_bound, antialiasing_coef):
+        """ Positions of all visible grid lines (except the one on 0, where the axis is) """
+        step_pixels = step * pixels_per_unit
+        min_distance = self.min_distance * antialiasing_coef
+        if step_pixels < min_distance:
+            step = step * mod_utils.get_nice_step(min_distance / float(step_pixels))
+
+        result = []
+        i = int(mod_math.ceil(lower_bound / step))
+        end = int(mod_math.floor(higher_bound / step))
+        while i <= end:
+            position = i * step
+            if i != 0 and position != lower_bound and position != higher_bound:
+                result.append(position)
+            i += 1
+
+        return result
+
     def process_image(self, draw_handler):
-        if self.vertical:
-            axe_from_point = 0, draw_handler.bounds.bottom
-            axe_to_point = 0, draw_handler.bounds.top
-            i = mod_math.floor(draw_handler.bounds.left / self.vertical)
-            while i < mod_math.ceil(draw_handler.bounds.right):
-                x, y = i, 0
-                if i != 0 and i != draw_handler.bounds.left and i != draw_handler.bounds.right:
-                    draw_handler.draw_line(x, axe_from_point[1], x, axe_to_point[1], self.get_color_with_transparency(self.color))
-                i += self.vertical
+        vertical_lines, horizontal_lines = [], []
 
+        if self.vertical:
+            vertical_lines = self.get_lines(self.vertical, abs(draw_handler.transform.x_scale),
+                    draw_handler.bounds.left, draw_handler.bounds.right, draw_handler.antialiasing_coef)
         if self.horizontal:
-            axe_from_point = draw_handler.bounds.left, 0
-            axe_to_point = draw_handler.bounds.right, 0
-            i = mod_math.floor(draw_handler.bounds.bottom / self.horizontal)
-            while i < mod_math.ceil(draw_handler.bounds.top):
-                x, y = 0, i
-                if i != 0 and i != draw_handler.bounds.bottom and i != draw_handler.bounds.top:
-                    draw_handler.draw_line(axe_from_point[0], y, axe_to_point[0], y, self.get_color_with_transparency(self.color))
-                i += self.horizontal
+            horizontal_lines = self.get_lines(self.horizontal, abs(draw_handler.transform.y_scale),
+                    draw_handler.bounds.bottom, draw_handler.bounds.top, draw_handler.antialiasing_coef)
+
+        draw_handler.draw_grid_lines(vertical_lines, horizontal_lines, self.get_color_with_transparency(self.color))
+
+    def get_cache_key(self):
+        return (self.__class__.__name__, self.horizontal, self.vertical, self.color, self.min_distance,
+                self.transparency_mask)
 
 class Line(mod_main.CoordinateSystemElement):
 
-    start = None
-    end = None
-    color = None
+    __slots__ = (
+        'start',
+        'end',
+        'color',
+    )
 
     def __init__(self, start, end, color=None, transparency_mask=None):
         mod_main.CoordinateSystemElement.__init__(self, transparency_mask=transparency_mask)
@@ -352,15 +555,25 @@ class Line(mod_main.CoordinateSystemElement):
         self.bounds.update(point=self.start)
         self.bounds.update(point=self.end)
 
+    def needs_antialiasing(self):
+        return self.start[0] != self.end[0] and self.start[1] != self.end[1]
+
+    def get_image_box(self, draw_handler):
+        return self.get_bounds_image_box(min(self.start[0], self.end[0]), max(self.start[0], self.end[0]),
+                                         min(self.start[1], self.end[1]), max(self.start[1], self.end[1]),
+                                         1, draw_handler)
+
     def process_image(self, draw_handler):
         draw_handler.draw_line(self.start[0], self.start[1], self.end[0], self.end[1], self.get_color_with_transparency(self.color))
 
 class Circle(mod_main.CoordinateSystemElement):
 
-    center = None
-    radius = None
-    color = None
-    fill_color = None
+    __slots__ = (
+        'center',
+        'radius',
+        'color',
+        'fill_color',
+    )
 
     def __init__(self, center, radius, color=None, fill_color=None, transparency_mask=None):
         mod_main.CoordinateSystemElement.__init__(self, transparency_mask=transparency_mask)
@@ -385,6 +598,14 @@ class Circle(mod_main.CoordinateSystemElement):
         self.bounds.update(point=(self.center[0], self.center[1] + self.radius))
         self.bounds.update(point=(self.center[0], self.center[1] - self.radius))
 
+    def needs_antialiasing(self):
+        return True
+
+    def get_image_box(self, draw_handler):
+        return self.get_bounds_image_box(self.center[0] - self.radius, self.center[0] + self.radius,
+                                         self.center[1] - self.radius, self.center[1] + self.radius,
+                                         1, draw_handler)
+
     def process_image(self, draw_handler):
         draw_handler.draw_circle(
                 self.center[0],
@@ -1,8 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import collections as mod_collections
+import copy as mod_copy
+import io as mod_io
 import logging as mod_logging
+import math as mod_math
+import multiprocessing as mod_multiprocessing
+import multiprocessing.pool as mod_pool
 import os as mod_os
 import os.path as mod_path
+import pickle as mod_pickle
 
 from PIL import Image as mod_image
 from PIL import ImageDraw as mod_imagedraw
@@ -27,6 +34,42 @@ DEFAULT_POINT_COLOR = (150, 150, 150)
 DEFAULT_GRID_COLOR = (235, 235, 235)
 DEFAULT_ELEMENT_COLOR = (50, 50, 50)
 
+# Supersampling factor used for antialiasing=True:
+DEFAULT_ANTIALIASING_COEF = 2
+
+# Filters for downscaling antialiased images. RESAMPLE_BOX with an integer antialiasing factor uses
+# Image.reduce(), which is much faster than the others:
+RESAMPLE_BOX = 'box'
+RESAMPLE_BILINEAR = 'bilinear'
+RESAMPLE_LANCZOS = 'lanczos'
+
+# Loaded fonts, by (font file location, size):
+FONTS_CACHE = mod_utils.LRUCache(max_size=16)
+
+# Text sizes, by (font file location, size, text):
+TEXT_SIZES_CACHE = mod_utils.LRUCache(max_size=4096)
+
+# Rendered labels (grayscale masks), by (font file location, size, text), see PILHandler.label_bitmaps:
+LABEL_BITMAPS_CACHE = mod_utils.LRUCache(max_size=1024)
+
+# Point markers (grayscale masks), by (style, antialiasing_coef), see PILHandler.draw_markers():
+MARKER_SPRITES_CACHE = mod_utils.LRUCache(max_size=64)
+
+# Pixels (around a redrawn region) used by downscaling filters, see CoordinateSystem.redraw():
+DOWNSCALE_MARGIN = 4
+
+# Lines and polygons are clipped to the image extended by this many (final image) pixels on every
+# side, so that line joins and widths near the border are the same as without clipping:
+CLIP_MARGIN = 8
+
+# Images of static elements, see CoordinateSystem.draw(cache_static_layers=True). Supersampled
+# images can be big, so the cache is limited by the memory used for pixels, too:
+STATIC_LAYERS_CACHE_BYTES = 256 << 20
+STATIC_LAYERS_CACHE = mod_utils.LRUCache(
+        max_size=64,
+        max_bytes=STATIC_LAYERS_CACHE_BYTES,
+        get_bytes=lambda image: image.size[0] * image.size[1] * len(image.getbands()))
+
 # Possible label positions:
 LEFT_UP       = -1, 1
 LEFT_CENTER   = -1, 0
@@ -38,22 +81,32 @@ RIGHT_UP      = 1, 1
 RIGHT_CENTER  = 1, 0
 RIGHT_DOWN    = 1, -1
 
+# Everything needed to draw one image (see CoordinateSystem.get_render_context()). Bounds are
+# computed for this image only, and image_width/image_height are the size of the final (not
+# supersampled) image:
+RenderContext = mod_collections.namedtuple(
+        'RenderContext',
+        ('bounds', 'image_width', 'image_height', 'elements', 'axes', 'antialiasing_coef',
+         'layers_antialiasing_coef', 'resample', 'cache_static_layers', 'label_bitmaps', 'bands'))
+
 class Bounds:
     """
     Bounds for coordinate system and image size. If the user don't explicitly set hiw own bounds, those
     will be resized with each new element.
     """
 
-    image_width = None
-    image_height = None
+    __slots__ = (
+        'image_width',
+        'image_height',
 
-    left = None
-    right = None
-    bottom = None
-    top = None
+        'left',
+        'right',
+        'bottom',
+        'top',
+    )
 
     def __init__(self, left=None, right=None, bottom=None, top=None, image_width=None, image_height=None):
-        self.reset()
+        mod_utils.init_slots(self)
 
         self.left = left
         self.right = right
@@ -81,7 +134,7 @@ class Bounds:
         return self.right - self.left, self.top - self.bottom
 
     def reset(self):
-        self.left_bound, self.right_bound, self.lower_bound, self.upper_bound = None, None, None, None
+        self.left, self.right, self.bottom, self.top = None, None, None, None
 
     def update_to_image_size(self):
         assert self.image_width
@@ -141,7 +194,13 @@ class CoordinateSystem:
 
     resize_bounds = None
 
-    def __init__(self, bounds=None):
+    # Consecutive transparent elements with the same transparency can be drawn on one layer (which is
+    # faster). If None, only elements which don't overlap are merged (so the image is the same as
+    # with one layer per element), if True all are (overlapping parts of those elements are not
+    # blended with each other), if False none:
+    merge_transparent_layers = None
+
+    def __init__(self, bounds=None, merge_transparent_layers=None):
         """ If custom bounds are given, they won't be resized according to new elements. """
         from . import elements as mod_elements
         self.elements = []
@@ -160,6 +219,8 @@ class CoordinateSystem:
             self.bounds = Bounds()
             self.resize_bounds = True
 
+        self.merge_transparent_layers = merge_transparent_layers
+
         # By default, axes are on:
         self.x_axis = mod_elements.Axis(horizontal=True, points=1)
         self.y_axis = mod_elements.Axis(vertical=True, points=1)
@@ -171,92 +232,546 @@ class CoordinateSystem:
         Note that if you add n default axis, it will remove a previous existing horizontal/vertical axis,
         but the same does not apply for detached axes.
         """
+        self.add_all((element,))
+
+    def add_all(self, elements):
+        """
+        Add all elements from the given iterable. Same as calling add() for every element, but the
+        coordinate system bounds are updated only once, with the combined bounds of all elements.
+        """
         from . import elements as mod_elements
 
-        if not element or not isinstance(element, CoordinateSystemElement):
-            raise Exception('Invalid element: {0}'.format(element))
+        left, right, bottom, top = None, None, None, None
 
-        if isinstance(element, mod_elements.Axis):
-            if element.is_detached():
-                self.elements.append(element)
-            else:
-                if element.is_horizontal():
-                    self.x_axis = element
+        for element in elements:
+            if not element or not isinstance(element, CoordinateSystemElement):
+                raise Exception('Invalid element: {0}'.format(element))
+
+            if isinstance(element, mod_elements.Axis):
+                if element.is_detached():
+                    self.elements.append(element)
                 else:
-                    self.y_axis = element
-        else:
-            element.reload_bounds()
-            self.elements.append(element)
-            self.reload_bounds()
+                    if element.is_horizontal():
+                        self.x_axis = element
+                    else:
+                        self.y_axis = element
+            else:
+                self.elements.append(element)
 
-    def reload_bounds(self):
+                # Elements bounds are needed only if the coordinate system bounds are not fixed:
+                if not self.resize_bounds:
+                    continue
+
+                element.reload_bounds()
+                left, right = mod_utils.min_max(left, right, element.bounds.left, element.bounds.right)
+                bottom, top = mod_utils.min_max(bottom, top, element.bounds.bottom, element.bounds.top)
+
+        # Only the new elements' bounds need to be merged:
+        if self.resize_bounds:
+            self.bounds.update(x=left, y=bottom)
+            self.bounds.update(x=right, y=top)
+
+    def reload_bounds(self, bounds=None, elements=None):
+        """ Update bounds (by default self.bounds) so that all elements (by default self.elements) fit """
         if not self.resize_bounds:
             return
 
-        if not self.elements:
-            self.bounds.left = -1
-            self.bounds.right = 1
-            self.bounds.bottom = -1
-            self.bounds.top = 1
+        bounds = bounds if bounds is not None else self.bounds
+        elements = elements if elements is not None else self.elements
+
+        if not elements:
+            bounds.left = -1
+            bounds.right = 1
+            bounds.bottom = -1
+            bounds.top = 1
             return
 
-        for element in self.elements:
-            self.bounds.update(element.bounds)
+        for element in elements:
+            bounds.update(element.bounds)
 
-        assert self.bounds
+        assert bounds
+
+    def __draw_elements(self, elements, image, draw, draw_handler=None, antialiasing_handler=None, resample=None):
+        """
+        If antialiasing_handler is set, only antialiased elements (see
+        CoordinateSystemElement.is_antialiased()) are drawn with it, on supersampled layers.
+        """
+        # Consecutive elements with the same transparency (and antialiasing) are drawn on one layer:
+        layer_elements = []
+        layer_boxes = []
+        layer_antialiased = False
+        for element in elements:
+            antialiased = bool(antialiasing_handler) and element.is_antialiased()
+            if layer_elements and (layer_elements[0].transparency_mask != element.transparency_mask or
+                                   layer_antialiased != antialiased or
+                                   (element.transparency_mask != 255 and
+                                    not self.__can_merge(element, layer_boxes, draw_handler))):
+                draw_elements(layer_elements, image, draw, draw_handler,
+                              antialiasing_handler=antialiasing_handler if layer_antialiased else None,
+                              resample=resample)
+                layer_elements = []
+                layer_boxes = []
+            layer_elements.append(element)
+            if element.transparency_mask != 255 and self.merge_transparent_layers is None:
+                layer_boxes.append(self.__get_merge_box(element, draw_handler))
+            layer_antialiased = antialiased
+        draw_elements(layer_elements, image, draw, draw_handler,
+                      antialiasing_handler=antialiasing_handler if layer_antialiased else None,
+                      resample=resample)
+
+    def __get_merge_box(self, element, draw_handler):
+        """ Pixel box of element (with the downscaling filter margin), None if unknown """
+        box = element.get_image_box(draw_handler)
+        if box is None:
+            return None
+        return (box[0] - DOWNSCALE_MARGIN, box[1] - DOWNSCALE_MARGIN, box[2] + DOWNSCALE_MARGIN, box[3] + DOWNSCALE_MARGIN)
+
+    def __can_merge(self, element, layer_boxes, draw_handler):
+        """ Can the transparent element be drawn on the layer with elements in layer_boxes """
+        if self.merge_transparent_layers is not None:
+            return bool(self.merge_transparent_layers)
+
+        box = self.__get_merge_box(element, draw_handler)
+        if box is None:
+            return False
+        for layer_box in layer_boxes:
+            if layer_box is None or mod_utils.get_box_intersection(box, layer_box):
+                return False
+        return True
+
+    def __get_layer(self, cache_key, elements, background, box, draw_handler, antialiasing_handler, resample):
+        """
+        Image of the given pixel box with the given (static) elements drawn over the background color.
+        If cache_key is set, the whole image is stored in (or taken from) STATIC_LAYERS_CACHE.
+        """
+        layer = STATIC_LAYERS_CACHE.get(cache_key) if cache_key else None
+
+        if layer is None:
+            layer_box = (0, 0, draw_handler.bounds.image_width, draw_handler.bounds.image_height) if cache_key else box
+            layer = mod_image.new('RGBA', (layer_box[2] - layer_box[0], layer_box[3] - layer_box[1]), background)
+            draw = mod_imagedraw.Draw(layer)
+            draw_handler.update_pil_image_draw(layer, draw, image_offset=layer_box[:2])
+            self.__draw_elements(elements, layer, draw, draw_handler=draw_handler,
+                                 antialiasing_handler=antialiasing_handler, resample=resample)
+            if not cache_key:
+                return layer
+            STATIC_LAYERS_CACHE.put(cache_key, layer)
+
+        return layer.crop(box)
+
+    def __get_draw_state(self, context):
+        """ Everything needed to decide if an image can be redrawn incrementally (see redraw()) """
+        bounds = context.bounds
+        options = (bounds.image_width, bounds.image_height, context.antialiasing_coef,
+                   context.layers_antialiasing_coef, context.resample, bool(context.label_bitmaps),
+                   self.merge_transparent_layers, tuple(id(axis) for axis in context.axes))
+        elements = tuple((id(element), element.get_draw_state()) for element in context.elements)
+        return options, (bounds.left, bounds.right, bounds.bottom, bounds.top), elements
+
+    def __get_dirty_region(self, previous_state, state, draw_handler, context):
+        """
+        Box (in final image pixels) which must be repainted to get from the image drawn with
+        previous_state to the one for state, () if nothing changed, or None if the whole image must
+        be drawn.
+        """
+        antialiasing_coef = context.antialiasing_coef
 
-    def __draw_elements(self, image, draw, draw_handler=None, hide_x_axis=False, hide_y_axis=False):
-        for element in self.elements:
-            draw_handler.update_pil_image_draw(image, draw)
-            element.draw(image=image, draw=draw, draw_handler=draw_handler)
+        if not previous_state or previous_state[0] != state[0]:
+            return None
+        if antialiasing_coef != int(antialiasing_coef) or \
+                context.layers_antialiasing_coef != int(context.layers_antialiasing_coef):
+            return None
 
-        if not hide_x_axis and self.x_axis:
-            self.x_axis.draw(image=image, draw=draw, draw_handler=draw_handler)
+        # Bounds may differ in the last digits when recomputed for the same image size:
+        width, height = context.bounds.get_width_height()
+        tolerances = (width, width, height, height)
+        for previous_bound, bound, tolerance in zip(previous_state[1], state[1], tolerances):
+            if abs(previous_bound - bound) > tolerance * 1e-9:
+                return None
+
+        previous_elements, elements = previous_state[2], state[2]
+        if [item[0] for item in previous_elements] != [item[0] for item in elements]:
+            return None
+
+        box = None
+        for element, previous_item, item in zip(context.elements, previous_elements, elements):
+            if previous_item[1] != item[1]:
+                element_box = element.get_dirty_image_box(draw_handler, previous_item[1])
+                box = mod_utils.get_box_union(box, element_box) if box else element_box
+
+        if not box:
+            # Nothing changed
+            return ()
+
+        return mod_utils.get_box_intersection(
+                (int(mod_math.floor(box[0] / float(antialiasing_coef))), int(mod_math.floor(box[1] / float(antialiasing_coef))),
+                 int(mod_math.ceil(box[2] / float(antialiasing_coef))), int(mod_math.ceil(box[3] / float(antialiasing_coef)))),
+                (0, 0, context.image_width, context.image_height)) or ()
+
+    def append(self, element, item):
+        """ Append one data item to a chart (see append_all()) """
+        self.append_all(element, (item,))
+
+    def append_all(self, element, items):
+        """
+        Append data items to a chart (for example a LineChart) already added to this coordinate system,
+        and update the bounds. Images of this coordinate system can then be updated with redraw().
+        """
+        if element not in self.elements:
+            raise Exception('Element not in coordinate system: {0}'.format(element))
+
+        element.append_all(items)
+
+        if self.resize_bounds and element.bounds.is_set():
+            self.bounds.update(x=element.bounds.left, y=element.bounds.bottom)
+            self.bounds.update(x=element.bounds.right, y=element.bounds.top)
+
+    def get_render_context(self, width, height, axis_units_equal_length=True, hide_x_axis=False, hide_y_axis=False,
+            antialiasing=None, resample=None, selective_antialiasing=False, cache_static_layers=False,
+            label_bitmaps=False, bands=None):
+        """
+        RenderContext with everything needed to draw an image with the given draw() arguments. The
+        coordinate system itself is not changed, so that it can be drawn many times (or concurrently
+        from many threads) with identical results.
+        """
+        antialiasing_coef = get_antialiasing_coef(antialiasing)
+
+        # With selective antialiasing, the image itself is not supersampled, only some layers:
+        layers_antialiasing_coef = 1
+        if selective_antialiasing:
+            layers_antialiasing_coef, antialiasing_coef = antialiasing_coef, 1
 
+        elements = tuple(self.elements)
+
+        bounds = Bounds(image_width=int(width * antialiasing_coef), image_height=int(height * antialiasing_coef))
+        bounds.left, bounds.right, bounds.bottom, bounds.top = \
+                self.bounds.left, self.bounds.right, self.bounds.bottom, self.bounds.top
+
+        if axis_units_equal_length:
+            self.reload_bounds(bounds=bounds, elements=elements)
+
+        if self.resize_bounds:
+            bounds.update_to_image_size()
+
+        axes = []
+        if not hide_x_axis and self.x_axis:
+            axes.append(self.x_axis)
         if not hide_y_axis and self.y_axis:
-            self.y_axis.draw(image=image, draw=draw, draw_handler=draw_handler)
+            axes.append(self.y_axis)
+
+        return RenderContext(bounds, width, height, elements, tuple(axes), antialiasing_coef,
+                             layers_antialiasing_coef, resample, cache_static_layers, label_bitmaps, bands)
 
     def draw(self, width, height, axis_units_equal_length=True, hide_x_axis=False, hide_y_axis=False,
-            antialiasing=None):
-        """ Returns a PIL image """
+            antialiasing=None, resample=None, selective_antialiasing=False, cache_static_layers=False,
+            label_bitmaps=False, bands=None):
+        """
+        Returns a PIL image.
+
+        antialiasing: True (same as DEFAULT_ANTIALIASING_COEF) or the supersampling factor (for example
+        1.5, 2, 3 or 4). The image is drawn that many times bigger and then downscaled. The cost grows
+        with the square of the factor.
+        resample: filter used to downscale an antialiased image, RESAMPLE_LANCZOS (default, best
+        quality), RESAMPLE_BILINEAR or RESAMPLE_BOX (fastest, especially with integer factors)
+        selective_antialiasing: if True, the image is drawn in its real size and only antialiased
+        elements (lines, curves, circles, ..., see CoordinateSystemElement.is_antialiased()) are
+        supersampled, each on a layer cropped to its size.
+        cache_static_layers: if True, the background with the static elements added before all
+        others (grids, detached axes) and the x/y axes are taken from (or stored in)
+        STATIC_LAYERS_CACHE, so that only the other elements are drawn. Useful when drawing many
+        images which differ only in data.
+        label_bitmaps: if True, labels are drawn from bitmaps cached in LABEL_BITMAPS_CACHE (faster
+        with many repeated labels, but positioned on whole pixels)
+        bands: if set, the image is split into that many horizontal bands, drawn concurrently by a
+        pool of threads. Useful for big images, since Pillow releases the GIL while drawing and
+        resizing. Lines crossing band borders may be rounded slightly differently.
+
+        Drawing doesn't change the coordinate system (see get_render_context()), it can be drawn
+        concurrently from many threads.
+        """
+        return self.draw_context(self.get_render_context(
+                width, height, axis_units_equal_length, hide_x_axis, hide_y_axis, antialiasing, resample,
+                selective_antialiasing, cache_static_layers, label_bitmaps, bands))
 
-        # Antialiasing works like this. If it is set, the image will be drawn double the size (that's
-        # why antialiasing_coef is 2). Only later it will be resized to one half with PIL's ANTIALIAS
-        # flag:
-        antialiasing_coef = 1
-        if antialiasing:
-            antialiasing_coef = 2
-            width = int(width * antialiasing_coef)
-            height = int(height * antialiasing_coef)
+    def redraw(self, previous_image, axis_units_equal_length=True, hide_x_axis=False, hide_y_axis=False,
+            antialiasing=None, resample=None, selective_antialiasing=False, cache_static_layers=False,
+            label_bitmaps=False, bands=None):
+        """
+        Returns a PIL image, same as draw() (with the size of previous_image), but if previous_image was
+        drawn by this coordinate system with the same options and bounds, only the pixels changed by data
+        appended since then (see append()) are repainted. If the bounds changed, the whole image is drawn.
 
-        self.bounds.image_width = width
-        self.bounds.image_height = height
+        Incremental redrawing works only with integer antialiasing factors. Lines crossing the border of
+        the repainted region may be rounded slightly differently than in a full draw().
+        """
+        width, height = previous_image.size
+        return self.draw_context(self.get_render_context(
+                width, height, axis_units_equal_length, hide_x_axis, hide_y_axis, antialiasing, resample,
+                selective_antialiasing, cache_static_layers, label_bitmaps, bands), previous_image=previous_image)
+
+    def draw_context(self, context, previous_image=None):
+        """ Draw an image for the RenderContext (see get_render_context()) """
+        state = self.__get_draw_state(context)
+
+        # Downscaling filters spread changed pixels to their neighbours and use pixels around them:
+        margin = 0
+        if context.antialiasing_coef != 1 or context.layers_antialiasing_coef != 1:
+            margin = DOWNSCALE_MARGIN
+
+        image_box = (0, 0, context.image_width, context.image_height)
+
+        if previous_image is not None:
+            draw_handler, antialiasing_handler = self.__get_handlers(context)
+            dirty_region = self.__get_dirty_region(previous_image.info.get('cartesius'), state, draw_handler, context)
+            if dirty_region == ():
+                return previous_image.copy()
+            if dirty_region:
+                dirty_region = mod_utils.get_box_intersection(
+                        (dirty_region[0] - margin, dirty_region[1] - margin, dirty_region[2] + margin, dirty_region[3] + margin),
+                        image_box)
+                image = previous_image.copy()
+                image.paste(self.__draw_part(context, dirty_region, margin), dirty_region[:2])
+                image.info['cartesius'] = state
+                return image
+
+        bands = min(context.bands, context.image_height) if context.bands else 1
+        if bands > 1:
+            parts = []
+            for band in range(bands):
+                parts.append((0, context.image_height * band // bands,
+                              context.image_width, context.image_height * (band + 1) // bands))
+
+            pool = mod_pool.ThreadPool(bands)
+            try:
+                part_images = pool.map(lambda part: self.__draw_part(context, part, margin), parts)
+            finally:
+                pool.close()
+                pool.join()
+
+            image = mod_image.new('RGBA', image_box[2:])
+            for part, part_image in zip(parts, part_images):
+                image.paste(part_image, part[:2])
+        else:
+            image = self.__draw_region(context, image_box)
 
-        if axis_units_equal_length:
-            self.reload_bounds()
+        image.info['cartesius'] = state
 
-        image = mod_image.new('RGBA', (width, height), (255, 255, 255, 255))
-        draw = mod_imagedraw.Draw(image)
+        return image
 
-        draw_handler = PILHandler(antialiasing_coef, self.bounds)
+    def __get_handlers(self, context):
+        """ New draw handler and (if layers are antialiased) antialiasing handler for context """
+        bounds = context.bounds
 
-        if self.resize_bounds:
-            self.bounds.update_to_image_size()
+        draw_handler = PILHandler(context.antialiasing_coef, bounds, label_bitmaps=context.label_bitmaps)
+
+        antialiasing_handler = None
+        if context.layers_antialiasing_coef != 1:
+            antialiasing_bounds = Bounds(
+                    left=bounds.left, right=bounds.right, bottom=bounds.bottom, top=bounds.top,
+                    image_width=bounds.image_width * context.layers_antialiasing_coef,
+                    image_height=bounds.image_height * context.layers_antialiasing_coef)
+            antialiasing_handler = PILHandler(context.layers_antialiasing_coef, antialiasing_bounds,
+                                              label_bitmaps=context.label_bitmaps)
 
-        self.__draw_elements(image=image, draw=draw, draw_handler=draw_handler, hide_x_axis=hide_x_axis, hide_y_axis=hide_y_axis)
+        return draw_handler, antialiasing_handler
 
-        if antialiasing:
-            image = image.resize((int(width / antialiasing_coef), int(height / antialiasing_coef)), mod_image.ANTIALIAS)
+    def __draw_part(self, context, part, margin):
+        """
+        Image of the part (box in final image pixels) of the image, drawn with margin more pixels on
+        every side (needed by downscaling filters).
+        """
+        region = mod_utils.get_box_intersection(
+                (part[0] - margin, part[1] - margin, part[2] + margin, part[3] + margin),
+                (0, 0, context.image_width, context.image_height))
+
+        image = self.__draw_region(context, region)
+        if region == part:
+            return image
+
+        return image.crop((part[0] - region[0], part[1] - region[1], part[2] - region[0], part[3] - region[1]))
+
+    def __draw_region(self, context, region):
+        """ Image of the region (box in final image pixels) of the image """
+        bounds = context.bounds
+        antialiasing_coef = context.antialiasing_coef
+        resample = context.resample
+
+        # Every region has its own handlers (they keep the current PIL image and draw):
+        draw_handler, antialiasing_handler = self.__get_handlers(context)
+
+        box = tuple(int(value * antialiasing_coef) for value in region)
+
+        elements, axes = context.elements, context.axes
+
+        # Static elements drawn before all others can be cached with the background:
+        static_count = 0
+        if context.cache_static_layers:
+            while static_count < len(elements) and elements[static_count].get_cache_key() is not None:
+                static_count += 1
+
+        base_cache_key, axes_cache_key = None, None
+        if context.cache_static_layers:
+            draw_key = (bounds.left, bounds.right, bounds.bottom, bounds.top, bounds.image_width, bounds.image_height,
+                        antialiasing_coef, context.layers_antialiasing_coef, resample, bool(context.label_bitmaps),
+                        self.merge_transparent_layers)
+            base_cache_key = draw_key + ('base',) + tuple(element.get_cache_key() for element in elements[:static_count])
+            if all(axis.get_cache_key() is not None for axis in axes):
+                axes_cache_key = draw_key + ('axes',) + tuple(axis.get_cache_key() for axis in axes)
+
+        image = self.__get_layer(base_cache_key, elements[:static_count], (255, 255, 255, 255), box,
+                                 draw_handler, antialiasing_handler, resample)
+        draw = mod_imagedraw.Draw(image)
+        draw_handler.update_pil_image_draw(image, draw, image_offset=box[:2])
+
+        self.__draw_elements(elements[static_count:], image, draw, draw_handler=draw_handler,
+                             antialiasing_handler=antialiasing_handler, resample=resample)
+
+        if axes_cache_key:
+            axes_layer = self.__get_layer(axes_cache_key, axes, (0, 0, 0, 0), box, draw_handler, antialiasing_handler, resample)
+            image.alpha_composite(axes_layer)
+        else:
+            for axis in axes:
+                axis.draw(image=image, draw=draw, draw_handler=draw_handler)
+
+        if antialiasing_coef != 1:
+            image = downscale(image, region[2] - region[0], region[3] - region[1], antialiasing_coef, resample)
 
         return image
 
+def get_font(location, size):
+    """ Font loaded from location (cached in FONTS_CACHE) """
+    key = (location, size)
+
+    result = FONTS_CACHE.get(key)
+    if result is None:
+        result = mod_imagefont.truetype(location, size)
+        FONTS_CACHE.put(key, result)
+
+    return result
+
+def get_pickled(coordinate_system):
+    """
+    Pickled coordinate_system. If some elements can't be pickled, a copy with those elements
+    materialized (see CoordinateSystemElement.materialize(), with fixed bounds only for the
+    visible part) is pickled instead.
+    """
+    try:
+        return mod_pickle.dumps(coordinate_system, mod_pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        pass
+
+    result = mod_copy.copy(coordinate_system)
+    result.elements = []
+    for element in coordinate_system.elements:
+        try:
+            mod_pickle.dumps(element, mod_pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            element = mod_copy.copy(element)
+            element.materialize(bounds=coordinate_system.bounds if not coordinate_system.resize_bounds else None)
+        result.elements.append(element)
+
+    try:
+        return mod_pickle.dumps(result, mod_pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        raise Exception('Coordinate system can not be pickled: {0}'.format(e))
+
+def render(task):
+    """
+    Draw a pickled coordinate system and return the encoded image. Task is a tuple (index, pickled
+    coordinate system, width, height, image format, draw() options), used by render_many().
+    """
+    index, pickled, width, height, image_format, draw_options = task
+
+    coordinate_system = mod_pickle.loads(pickled)
+    image = coordinate_system.draw(width, height, **draw_options)
+
+    output = mod_io.BytesIO()
+    image.save(output, image_format)
+
+    return index, output.getvalue()
+
+def render_many(coordinate_systems, width, height, image_format='PNG', workers=None, ordered=True,
+                chunksize=1, **draw_options):
+    """
+    Draw many coordinate systems in a pool of worker processes. Returns a generator of encoded
+    images (bytes in image_format), in the order of coordinate_systems or, if ordered is False,
+    (index, bytes) tuples as soon as they are drawn.
+
+    workers: number of processes (default: the number of CPUs). With 1, everything is drawn in
+    this process.
+    chunksize: number of coordinate systems sent to a worker at once (bigger is faster with many
+    small images)
+    draw_options: other CoordinateSystem.draw() arguments (antialiasing, hide_x_axis, ...)
+
+    Elements which can't be pickled (Function with a lambda, charts with generator function data)
+    are materialized (on copies) before being sent to workers.
+    """
+    tasks = ((index, get_pickled(coordinate_system), width, height, image_format, draw_options)
+             for index, coordinate_system in enumerate(coordinate_systems))
+
+    if workers == 1:
+        for task in tasks:
+            index, data = render(task)
+            yield data if ordered else (index, data)
+        return
+
+    pool = mod_multiprocessing.Pool(workers)
+    try:
+        if ordered:
+            for index, data in pool.imap(render, tasks, chunksize):
+                yield data
+        else:
+            for index, data in pool.imap_unordered(render, tasks, chunksize):
+                yield index, data
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def get_antialiasing_coef(antialiasing):
+    """ Supersampling factor for the antialiasing argument of CoordinateSystem.draw() """
+    if not antialiasing:
+        return 1
+    if antialiasing is True:
+        return DEFAULT_ANTIALIASING_COEF
+    if not antialiasing >= 1:
+        raise Exception('Invalid antialiasing factor: {0}'.format(antialiasing))
+    if antialiasing == int(antialiasing):
+        return int(antialiasing)
+    return float(antialiasing)
+
+def downscale(image, width, height, antialiasing_coef, resample=None):
+    """ Resize a supersampled image to (width, height) """
+    resample = resample if resample else RESAMPLE_LANCZOS
+
+    if resample == RESAMPLE_BOX:
+        if antialiasing_coef == int(antialiasing_coef) and hasattr(image, 'reduce'):
+            image = image.reduce(int(antialiasing_coef))
+            if image.size == (width, height):
+                return image
+        return image.resize((width, height), mod_image.BOX)
+    elif resample == RESAMPLE_BILINEAR:
+        return image.resize((width, height), mod_image.BILINEAR)
+    elif resample == RESAMPLE_LANCZOS:
+        return image.resize((width, height), mod_image.LANCZOS)
+
+    raise Exception('Invalid resample filter: {0}'.format(resample))
+
 class CoordinateSystemElement:
     """ Abstract class, every subclass should detect bounds and have the code to draw this item """
 
-    bounds = None
-    transparency_mask = None
+    __slots__ = (
+        'bounds',
+        'transparency_mask',
+
+        # Used with selective antialiasing. True or False to force (or disable) antialiasing for this
+        # element, None to decide with needs_antialiasing():
+        'antialiased',
+    )
 
     def __init__(self, transparency_mask=None):
+        mod_utils.init_slots(self)
+
         self.bounds = Bounds()
 
         self.transparency_mask = transparency_mask if transparency_mask else 255
@@ -288,24 +803,130 @@ class CoordinateSystemElement:
 
         return (color[0], color[1], color[2], self.transparency_mask)
 
-    def draw(self, image, draw, draw_handler):
-        """ Draw this element. All custom code must be implemented in process_image() """
+    def get_cache_key(self):
+        """
+        If this element is always drawn the same way (for the same bounds and image size), a hashable
+        value describing it, None otherwise. Elements with a cache key can be drawn on cached static
+        layers.
+        """
+        return None
 
-        if self.transparency_mask == 255:
-            # If no transparency, draw on same PIL draw object:
-            tmp_image, tmp_draw = image, draw
-        else:
-            # If transparency, draw on new PIL's draw object:
-            tmp_image = mod_image.new('RGBA', (draw_handler.bounds.image_width, draw_handler.bounds.image_height))
-            tmp_draw = mod_imagedraw.Draw(tmp_image)
+    def materialize(self, bounds=None):
+        """
+        Replace everything which can't be pickled (lambdas, generator functions) with computed data,
+        so that this element can be drawn in another process (see render_many()). If bounds are
+        given (fixed coordinate system bounds), only the data needed to draw inside them is needed.
+        """
+        pass
 
-        draw_handler.update_pil_image_draw(tmp_image, tmp_draw)
+    def get_draw_state(self):
+        """
+        Hashable value which changes when data is appended to this element (see append_all()), or
+        None for elements which can't change.
+        """
+        return None
 
-        self.process_image(draw_handler)
+    def append_all(self, items):
+        """ Append data items to this element (only for elements with changing data, like charts) """
+        raise Exception('Appending not supported in {0}'.format(self.__class__))
 
-        if tmp_image != image or tmp_draw != draw:
-            # Transparency => paste this PIL's image over the old one:
-            image.paste(tmp_image, mask=tmp_image)
+    def get_dirty_image_box(self, draw_handler, previous_state):
+        """
+        Pixel box (left, top, right, bottom) containing everything changed since this element was
+        drawn with the previous_state draw state (see get_draw_state()). By default the whole image.
+        """
+        return (0, 0, draw_handler.bounds.image_width, draw_handler.bounds.image_height)
+
+    def needs_antialiasing(self):
+        """
+        True if this element draws something which looks better antialiased (i.e. non horizontal
+        or vertical lines, curves, circles, ...)
+        """
+        return False
+
+    def is_antialiased(self):
+        """ Should this element be supersampled when drawing with selective antialiasing """
+        if self.antialiased is not None:
+            return bool(self.antialiased)
+        return self.needs_antialiasing()
+
+    def get_image_box(self, draw_handler):
+        """
+        Pixel box (left, top, right, bottom) containing everything this element draws, or None if
+        unknown (i.e. the whole image). Used to allocate transparency layers only as big as needed.
+        """
+        return None
+
+    def get_bounds_image_box(self, left, right, bottom, top, margin, draw_handler):
+        """ Pixel box for the given cartesius bounds, with margin pixels on every side """
+        x1, y1 = draw_handler.transform.to_image(left, top)
+        x2, y2 = draw_handler.transform.to_image(right, bottom)
+        margin = margin * draw_handler.antialiasing_coef
+        return (int(mod_math.floor(min(x1, x2) - margin)), int(mod_math.floor(min(y1, y2) - margin)),
+                int(mod_math.ceil(max(x1, x2) + margin)) + 1, int(mod_math.ceil(max(y1, y2) + margin)) + 1)
+
+    def draw(self, image, draw, draw_handler):
+        """ Draw this element. All custom code must be implemented in process_image() """
+        draw_elements((self,), image, draw, draw_handler)
+
+def draw_elements(elements, image, draw, draw_handler, antialiasing_handler=None, resample=None):
+    """
+    Draw elements with the same transparency. If transparent, they are drawn on a new layer, cropped
+    to the elements' pixel box, and then pasted over image (so the elements are blended with the
+    image, but not with each other).
+
+    If antialiasing_handler (with a bigger antialiasing_coef than draw_handler) is given, the layer
+    is drawn with it, and downscaled (with the resample filter) before being pasted.
+    """
+    if not elements:
+        return
+
+    # The image may be only a part of the final image:
+    image_offset = draw_handler.image_offset
+
+    if elements[0].transparency_mask == 255 and not antialiasing_handler:
+        # If no transparency, draw on same PIL draw object:
+        draw_handler.update_pil_image_draw(image, draw, image_offset=image_offset)
+        for element in elements:
+            # Elements out of the image (or of the part of the image being drawn) are skipped:
+            element_box = element.get_image_box(draw_handler)
+            if element_box is None or mod_utils.get_box_intersection(element_box, (0, 0) + image.size):
+                element.process_image(draw_handler)
+        return
+
+    image_box = (0, 0) + image.size
+    box = None
+    for element in elements:
+        element_box = element.get_image_box(draw_handler)
+        if element_box is None:
+            box = image_box
+            break
+        box = mod_utils.get_box_union(box, element_box) if box else element_box
+
+    box = mod_utils.get_box_intersection(box, image_box)
+    if not box:
+        # Nothing visible
+        return
+
+    layer_handler = antialiasing_handler if antialiasing_handler else draw_handler
+    coef = layer_handler.antialiasing_coef / float(draw_handler.antialiasing_coef)
+    width, height = box[2] - box[0], box[3] - box[1]
+
+    # If transparency, draw on new PIL's draw object:
+    layer = mod_image.new('RGBA', (int(mod_math.ceil(width * coef)), int(mod_math.ceil(height * coef))))
+    layer_handler.update_pil_image_draw(layer, mod_imagedraw.Draw(layer),
+            image_offset=((box[0] + image_offset[0]) * coef, (box[1] + image_offset[1]) * coef))
+
+    for element in elements:
+        element.process_image(layer_handler)
+
+    if coef != 1:
+        layer = downscale(layer, width, height, coef, resample)
+
+    # Transparency => paste this PIL's image over the old one:
+    image.paste(layer, box[:2], mask=layer)
+
+    draw_handler.update_pil_image_draw(image, draw, image_offset=image_offset)
 
 class PILHandler:
     """
@@ -314,39 +935,108 @@ class PILHandler:
     system bounds, antialiasing_coef, and so on).
     """
 
-    # Those two values may be changed during the lifetime of this object. If transparency
-    # is used then it will happen:
-    pil_image = None
-    pil_draw = None
+    __slots__ = (
+        # Those two values may be changed during the lifetime of this object. If transparency
+        # is used then it will happen:
+        'pil_image',
+        'pil_draw',
 
-    antialiasing_coef = None
+        'antialiasing_coef',
 
-    bounds = None
+        'bounds',
+
+        # Cartesius to image coordinates, computed once per draw (bounds must not change after this
+        # object is created):
+        'transform',
+
+        # Position of pil_image in the final image:
+        'image_offset',
 
-    __font = None
+        # If True, labels are drawn (on whole pixel positions) from bitmaps in LABEL_BITMAPS_CACHE:
+        'label_bitmaps',
+    )
 
-    def __init__(self, antialiasing_coef, bounds):
+    def __init__(self, antialiasing_coef, bounds, label_bitmaps=False):
         assert antialiasing_coef
         assert bounds
 
+        mod_utils.init_slots(self)
+
         self.antialiasing_coef = antialiasing_coef
         self.bounds = bounds
+        self.transform = mod_utils.Transform(bounds)
+        self.image_offset = (0, 0)
+        self.label_bitmaps = label_bitmaps
+
+    def get_font_size(self):
+        return int(DEFAULT_FONT_SIZE * self.antialiasing_coef)
 
     def get_font(self):
         """ Load the font to be used for labels and point names. """
-        if not self.__font:
-            self.__font = mod_imagefont.truetype(DEFAULT_FONT_LOCATION, int(DEFAULT_FONT_SIZE * self.antialiasing_coef))
+        return get_font(DEFAULT_FONT_LOCATION, self.get_font_size())
+
+    def get_text_size(self, text):
+        """ Width and height (in image pixels) of text drawn with the labels font. """
+        key = (DEFAULT_FONT_LOCATION, self.get_font_size(), text)
+
+        result = TEXT_SIZES_CACHE.get(key)
+        if result is None:
+            font = self.get_font()
+            if hasattr(font, 'getbbox'):
+                left, top, right, bottom = font.getbbox(text)
+                result = right, bottom
+            else:
+                result = font.getsize(text)
+            TEXT_SIZES_CACHE.put(key, result)
 
-        return self.__font
+        return result
 
-    def update_pil_image_draw(self, image, draw):
+    def get_label_bitmap(self, text):
+        """ Grayscale image of text (drawn with the labels font), to be used as a mask """
+        key = (DEFAULT_FONT_LOCATION, self.get_font_size(), text)
+
+        result = LABEL_BITMAPS_CACHE.get(key)
+        if result is None:
+            width, height = self.get_text_size(text)
+            result = mod_image.new('L', (max(width, 1), max(height, 1)))
+            mod_imagedraw.Draw(result).text((0, 0), text, 255, self.get_font())
+            LABEL_BITMAPS_CACHE.put(key, result)
+
+        return result
+
+    def update_pil_image_draw(self, image, draw, image_offset=None):
         """
         When drawing the coordinate system for a custom element, the CS will "decide" if to use existing
-        PIL image and draw or set new ones with this method
+        PIL image and draw or set new ones with this method. If the new image is only a part of the
+        final image, image_offset is its (x, y) position there.
         """
         self.pil_image = image
         self.pil_draw = draw
 
+        image_offset = tuple(image_offset) if image_offset else (0, 0)
+        if image_offset != self.image_offset:
+            self.image_offset = image_offset
+            self.transform = mod_utils.Transform(self.bounds, image_offset=image_offset)
+
+    def get_clip_box(self):
+        """
+        Box (in pil_image pixels) outside which lines and polygons are clipped, see CLIP_MARGIN. The
+        box is the same for all parts of the image (see image_offset), so that lines crossing
+        regions or bands are clipped to the same pixels.
+        """
+        margin = CLIP_MARGIN * self.antialiasing_coef
+        if self.bounds.image_width and self.bounds.image_height:
+            image_width, image_height = self.bounds.image_width, self.bounds.image_height
+        else:
+            image_width, image_height = self.pil_image.size
+        offset_x, offset_y = self.image_offset
+        return (-margin - offset_x, -margin - offset_y, image_width + margin - offset_x, image_height + margin - offset_y)
+
+    def is_visible(self, box):
+        """ False if box (in pil_image pixels) is entirely outside the image """
+        image_width, image_height = self.pil_image.size
+        return box[2] >= 0 and box[3] >= 0 and box[0] <= image_width and box[1] <= image_height
+
     def draw_point(self, x, y, color, style='+', label=None, label_position=None):
         """
         Draw single point.
@@ -356,7 +1046,7 @@ class PILHandler:
         label_position: one of the label position constants (CENTER_UP, RIGHT_DOWN, ...). The default
         is set in draw_text()
         """
-        image_x, image_y = mod_utils.cartesius_to_image_coord(x, y, self.bounds)
+        image_x, image_y = self.transform.to_image(x, y)
 
         if label_position:
             assert len(label_position) == 2
@@ -364,6 +1054,10 @@ class PILHandler:
         if not color:
             color = DEFAULT_POINT_COLOR
 
+        delta = 2 * self.antialiasing_coef + 1
+        if not label and not self.is_visible((image_x - delta, image_y - delta, image_x + delta, image_y + delta)):
+            return
+
         if style == '.' or style == None:
             self.pil_draw.point((image_x, image_y), color)
         elif style == 'x':
@@ -390,20 +1084,175 @@ class PILHandler:
         if label:
             self.draw_text(x, y, label, color, label_position=label_position)
 
+    def get_marker_sprite(self, style):
+        """
+        Grayscale mask of a point marker (style as in draw_point()) and the position of its center.
+        The same mask is used for all colors.
+        """
+        key = (style, self.antialiasing_coef)
+
+        result = MARKER_SPRITES_CACHE.get(key)
+        if result is None:
+            delta = 2 * self.antialiasing_coef
+            center = int(mod_math.ceil(delta))
+            sprite = mod_image.new('L', (2 * center + 1, 2 * center + 1))
+            draw = mod_imagedraw.Draw(sprite)
+            if style == 'x':
+                draw.line((center - delta, center - delta, center + delta, center + delta), 255)
+                draw.line((center - delta, center + delta, center + delta, center - delta), 255)
+            elif style == '+':
+                draw.line((center - delta, center, center + delta, center), 255)
+                draw.line((center, center + delta, center, center - delta), 255)
+            elif style == 'o':
+                draw.ellipse((center - delta, center - delta, center + delta, center + delta), fill=None, outline=255)
+            else:
+                draw.point((center, center), 255)
+            result = sprite, center
+            MARKER_SPRITES_CACHE.put(key, result)
+
+        return result
+
+    def draw_markers(self, xs, ys, color, style='+'):
+        """
+        Draw point markers (style as in draw_point(), but without labels) on many points given as x
+        and y columns. Markers are drawn on whole pixel positions, every distinct position once:
+        '.' markers with a single PIL call, the others from a cached mask (see get_marker_sprite()),
+        stamped on all positions of one image sized mask with NumPy (or pasted one by one without
+        NumPy).
+        """
+        if style == ' ' or not len(xs):
+            return
+
+        if not color:
+            color = DEFAULT_POINT_COLOR
+
+        image_xs, image_ys = self.transform.to_image_columns(xs, ys)
+
+        width, height = self.pil_image.size
+        if style == '.' or style == None:
+            positions = mod_utils.get_pixel_positions(image_xs, image_ys, (0, 0, width, height))
+            if positions:
+                self.pil_draw.point(positions, color)
+            return
+
+        sprite, center = self.get_marker_sprite(style)
+        positions = mod_utils.get_pixel_positions(image_xs, image_ys,
+                                                  (-center, -center, width + center, height + center))
+        if not positions:
+            return
+
+        if mod_utils.mod_numpy is not None:
+            numpy = mod_utils.mod_numpy
+            positions = numpy.asarray(positions)
+            mask = numpy.zeros((height, width), dtype=numpy.uint8)
+            for sprite_y, sprite_x in zip(*numpy.nonzero(numpy.asarray(sprite))):
+                mask_xs = positions[:, 0] + (sprite_x - center)
+                mask_ys = positions[:, 1] + (sprite_y - center)
+                inside = (mask_xs >= 0) & (mask_xs < width) & (mask_ys >= 0) & (mask_ys < height)
+                mask[mask_ys[inside], mask_xs[inside]] = 255
+            mask = mod_image.frombuffer('L', (width, height), mask, 'raw', 'L', 0, 1)
+            self.pil_image.paste(color, (0, 0, width, height), mask)
+            return
+
+        for x, y in positions:
+            self.pil_image.paste(color, (x - center, y - center, x + center + 1, y + center + 1), sprite)
+
     def draw_line(self, x1, y1, x2, y2, color):
-        image_x1, image_y1 = mod_utils.cartesius_to_image_coord(x1, y1, self.bounds)
-        image_x2, image_y2 = mod_utils.cartesius_to_image_coord(x2, y2, self.bounds)
+        image_x1, image_y1 = self.transform.to_image(x1, y1)
+        image_x2, image_y2 = self.transform.to_image(x2, y2)
+
+        line = mod_utils.clip_line(image_x1, image_y1, image_x2, image_y2, self.get_clip_box())
+        if line:
+            self.pil_draw.line(line, color)
+
+    def draw_grid_lines(self, xs, ys, color):
+        """
+        Draw full height vertical lines on all xs and full width horizontal lines on all ys. Lines
+        falling on the same pixel column (row) are drawn only once. With NumPy, all lines are set in
+        one image sized mask and pasted at once, otherwise every line is drawn with a PIL call.
+        """
+        image_width, image_height = self.pil_image.size
+
+        image_xs, image_ys = self.transform.to_image_columns(xs, [0] * len(xs))
+        columns = [x for x in sorted(set(int(mod_math.floor(x)) for x in image_xs)) if 0 <= x < image_width]
+
+        image_xs, image_ys = self.transform.to_image_columns([0] * len(ys), ys)
+        rows = [y for y in sorted(set(int(mod_math.floor(y)) for y in image_ys)) if 0 <= y < image_height]
+
+        if not columns and not rows:
+            return
+
+        if mod_utils.mod_numpy is not None:
+            numpy = mod_utils.mod_numpy
+            mask = numpy.zeros((image_height, image_width), dtype=numpy.uint8)
+            mask[:, columns] = 255
+            mask[rows, :] = 255
+            mask = mod_image.frombuffer('L', (image_width, image_height), mask, 'raw', 'L', 0, 1)
+            self.pil_image.paste(color, (0, 0, image_width, image_height), mask)
+            return
+
+        for image_x in columns:
+            self.pil_draw.line((image_x, 0, image_x, image_height), color)
+        for image_y in rows:
+            self.pil_draw.line((0, image_y, image_width, image_y), color)
+
+    def draw_polyline(self, points, color, fill_color=None, base_y=0):
+        """ Draw connected line segments through all points with a single PIL call. """
+        if len(points) < 2:
+            return
+
+        xs, ys = zip(*points)
+        self.draw_polyline_xy(xs, ys, color, fill_color, base_y)
+
+    def draw_polyline_xy(self, xs, ys, color, fill_color=None, base_y=0):
+        """
+        Same as draw_polyline(), but with points given as two (x and y) columns. Parts outside the
+        image are clipped, so the line may be drawn with more than one PIL call.
+
+        If fill_color is set, the area between the line and y=base_y is filled first, as one closed
+        polygon. Unlike with draw_polygon() and draw_line() for every segment (where a segment's
+        fill covers the end of the previous segment's line) the whole line is then on top of the
+        fill, so a few pixels on the line may differ.
+        """
+        if len(xs) < 2:
+            return
+
+        if fill_color:
+            self.draw_polygon_xy(xs, ys, fill_color, base_y=base_y)
+
+        image_xs, image_ys = self.transform.to_image_columns(xs, ys)
+        for part in mod_utils.clip_polyline(image_xs, image_ys, self.get_clip_box()):
+            self.pil_draw.line(part, color)
+
+    def draw_polygon_xy(self, xs, ys, fill_color, base_y=None):
+        """
+        Same as draw_polygon(), but with points given as two (x and y) columns. If base_y is set,
+        the polygon is closed with vertical lines down to y=base_y (i.e. the area under a line).
+        """
+        if not len(xs):
+            return
+
+        image_points = self.transform.to_image_flat(xs, ys)
 
-        self.pil_draw.line((image_x1, image_y1, image_x2, image_y2), color)
+        if base_y != None:
+            start_x, base_image_y = self.transform.to_image(xs[0], base_y)
+            end_x, base_image_y = self.transform.to_image(xs[-1], base_y)
+            image_points = [start_x, base_image_y] + image_points + [end_x, base_image_y]
+
+        image_points = mod_utils.clip_polygon(image_points, self.get_clip_box())
+        if image_points:
+            self.pil_draw.polygon(image_points, fill=fill_color)
 
     def draw_polygon(self, points, fill_color):
         image_points = []
-        for x, y in points:
-            image_coordinates = mod_utils.cartesius_to_image_coord(x, y, self.bounds)
-            image_points.append(image_coordinates)
-        self.pil_draw.polygon(
-            image_points,
-            fill=fill_color)
+        for point in self.transform.to_image_points(points):
+            image_points.extend(point)
+
+        image_points = mod_utils.clip_polygon(image_points, self.get_clip_box())
+        if image_points:
+            self.pil_draw.polygon(
+                image_points,
+                fill=fill_color)
 
     def draw_text(self, x, y, text, color, label_position=None):
         """
@@ -414,11 +1263,9 @@ class PILHandler:
         """
         label_position = label_position if label_position else RIGHT_DOWN
 
-        image_x, image_y = mod_utils.cartesius_to_image_coord(x, y, self.bounds)
+        image_x, image_y = self.transform.to_image(x, y)
 
-        font = self.get_font()
-
-        label_width, label_height = font.getsize(text)
+        label_width, label_height = self.get_text_size(text)
 
         if label_position[0] == -1:
             image_x = image_x - label_width - 4. * self.antialiasing_coef
@@ -434,17 +1281,127 @@ class PILHandler:
         elif label_position[1] == 1:
             image_y = image_y - label_height - 2 * self.antialiasing_coef
 
-        self.pil_draw.text((image_x, image_y), text, color, font)
+        if not self.is_visible((image_x, image_y, image_x + label_width, image_y + label_height)):
+            return
+
+        if self.label_bitmaps:
+            self.pil_draw.bitmap((int(round(image_x)), int(round(image_y))), self.get_label_bitmap(text), color)
+        else:
+            self.pil_draw.text((image_x, image_y), text, color, self.get_font())
+
+    def draw_density(self, xs, ys, colormap, weights=None, log_scale=True, alpha=255):
+        """
+        Draw points (given as x and y columns) as a density raster. Points (or their weights, which
+        must not be negative) are summed per pixel, and every pixel with a positive sum is colored
+        from the colormap (see mod_colors.get_colormap()), from colormap[0] for the smallest sum to
+        colormap[-1] for the biggest, with alpha. If log_scale, colors are mapped from logarithms of
+        sums. The raster is drawn with a single paste, whatever the number of points.
+
+        Colors depend on all sums, so the raster is always computed for the whole image (and only
+        the part in pil_image pasted, see image_offset).
+        """
+        width, height = int(round(self.bounds.image_width)), int(round(self.bounds.image_height))
+        sums = mod_utils.bin_points(mod_utils.Transform(self.bounds), xs, ys, width, height, weights=weights)
+
+        if mod_utils.mod_numpy is not None:
+            numpy = mod_utils.mod_numpy
+            filled = sums > 0
+            if not filled.any():
+                return
+            values = numpy.log1p(sums[filled]) if log_scale else sums[filled]
+            pixels = numpy.zeros((width * height, 4), dtype=numpy.uint8)
+            pixels[filled] = mod_colors.map_colors(values, colormap, alpha=alpha)
+        else:
+            filled = [i for i, value in enumerate(sums) if value > 0]
+            if not filled:
+                return
+            values = [mod_math.log1p(sums[i]) if log_scale else sums[i] for i in filled]
+            pixels = bytearray(4 * width * height)
+            for i, color in zip(filled, mod_colors.map_colors(values, colormap, alpha=alpha)):
+                pixels[4 * i: 4 * i + 4] = bytearray(color)
+
+        raster = mod_image.frombuffer('RGBA', (width, height), pixels, 'raw', 'RGBA', 0, 1)
+
+        offset_x, offset_y = int(round(self.image_offset[0])), int(round(self.image_offset[1]))
+        part = (offset_x, offset_y, offset_x + self.pil_image.size[0], offset_y + self.pil_image.size[1])
+        if part != (0, 0, width, height):
+            raster = raster.crop(part)
+        if self.pil_image.mode == 'RGBA':
+            self.pil_image.alpha_composite(raster)
+        else:
+            self.pil_image.paste(raster, (0, 0), raster)
+
+    def draw_bars(self, starts, ends, values, fill_colors, horizontal=False, aggregation=None):
+        """
+        Draw filled bars from key start to end and from 0 to value (keys are x coordinates, or y if
+        horizontal), fill_colors has one color per bar. Bars are drawn as rectangles, but bars
+        narrower than a pixel falling in the same pixel column (row if horizontal) are drawn as one
+        bar one pixel wide, with the max, min or sum of their values (see mod_utils.AGGREGATION_*)
+        and the color of the bar with that value (of the last bar for sum). If aggregation is None,
+        AGGREGATION_MAX is used.
+        """
+        if not len(starts):
+            return
+
+        aggregation = aggregation if aggregation else mod_utils.AGGREGATION_MAX
+
+        if horizontal:
+            to_image_keys, to_image_values = self.transform.to_image_ys, self.transform.to_image_xs
+            key_size = self.pil_image.size[1]
+        else:
+            to_image_keys, to_image_values = self.transform.to_image_xs, self.transform.to_image_ys
+            key_size = self.pil_image.size[0]
+
+        # Image coordinate of value 0:
+        value_offset = to_image_values((0,))[0]
+
+        def draw_bar(key_start, key_end, image_value, fill_color):
+            if horizontal:
+                box = (min(value_offset, image_value), key_start, max(value_offset, image_value), key_end)
+            else:
+                box = (key_start, min(value_offset, image_value), key_end, max(value_offset, image_value))
+            self.pil_draw.rectangle(box, fill=fill_color)
+
+        if mod_utils.mod_numpy is not None:
+            numpy = mod_utils.mod_numpy
+            image_starts, image_ends = to_image_keys(starts), to_image_keys(ends)
+            values = numpy.asarray(values, dtype=float)
+            narrow = numpy.abs(image_ends - image_starts) < 1
+            columns = numpy.floor((image_starts + image_ends) / 2.).astype(int)
+            narrow_indexes = numpy.flatnonzero(narrow & (columns >= 0) & (columns < key_size))
+            wide_indexes = numpy.flatnonzero(~narrow & (numpy.maximum(image_starts, image_ends) >= 0)
+                                             & (numpy.minimum(image_starts, image_ends) <= key_size))
+            columns, narrow_values = columns[narrow_indexes], values[narrow_indexes]
+            image_starts, image_ends = image_starts.tolist(), image_ends.tolist()
+            values, narrow_indexes, wide_indexes = values.tolist(), narrow_indexes.tolist(), wide_indexes.tolist()
+        else:
+            image_starts, image_ends = to_image_keys(starts), to_image_keys(ends)
+            columns, narrow_values, narrow_indexes, wide_indexes = [], [], [], []
+            for index, (image_start, image_end) in enumerate(zip(image_starts, image_ends)):
+                if abs(image_end - image_start) < 1:
+                    column = int(mod_math.floor((image_start + image_end) / 2.))
+                    if 0 <= column < key_size:
+                        columns.append(column)
+                        narrow_values.append(values[index])
+                        narrow_indexes.append(index)
+                elif max(image_start, image_end) >= 0 and min(image_start, image_end) <= key_size:
+                    wide_indexes.append(index)
+
+        image_values = to_image_values([values[index] for index in wide_indexes])
+        for index, image_value in zip(wide_indexes, image_values):
+            key_start, key_end = sorted((image_starts[index], image_ends[index]))
+            draw_bar(key_start, key_end, image_value, fill_colors[index])
+
+        columns, column_values, indexes = mod_utils.aggregate(columns, narrow_values, aggregation)
+        for column, image_value, index in zip(columns, to_image_values(column_values), indexes):
+            draw_bar(column, column, image_value, fill_colors[narrow_indexes[index]])
 
     def draw_circle(self, x, y, radius, line_color, fill_color):
-        x1, y1 = mod_utils.cartesius_to_image_coord(
-                x = x - radius / 2.,
-                y = y + radius / 2.,
-                bounds = self.bounds)
-        x2, y2 = mod_utils.cartesius_to_image_coord(
-                x = x + radius / 2.,
-                y = y - radius / 2.,
-                bounds = self.bounds)
+        x1, y1 = self.transform.to_image(x - radius / 2., y + radius / 2.)
+        x2, y2 = self.transform.to_image(x + radius / 2., y - radius / 2.)
+
+        if not self.is_visible((min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))):
+            return
 
         self.pil_draw.ellipse(
                 (x1, y1, x2, y2),
@@ -452,14 +1409,11 @@ class PILHandler:
                 outline = line_color)
 
     def draw_pieslice(self, x, y, radius, start_angle, end_angle, fill_color=None, color=None):
-        x1, y1 = mod_utils.cartesius_to_image_coord(
-                x=x - radius,
-                y=y + radius,
-                bounds=self.bounds)
-        x2, y2 = mod_utils.cartesius_to_image_coord(
-                x=x + radius,
-                y=y - radius,
-                bounds=self.bounds)
+        x1, y1 = self.transform.to_image(x - radius, y + radius)
+        x2, y2 = self.transform.to_image(x + radius, y - radius)
+
+        if not self.is_visible((min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))):
+            return
 
         self.pil_draw.pieslice(
                 (int(x1), int(y1), int(x2), int(y2)),
@@ -1,5 +1,16 @@
 # -*- coding: utf-8 -*-
 
+import bisect as mod_bisect
+import array as mod_array
+import math as mod_math
+import collections as mod_collections
+import threading as mod_threading
+
+try:
+    import numpy as mod_numpy
+except ImportError:
+    mod_numpy = None
+
 def cartesius_to_image_coord(x, y, bounds):
     assert bounds.is_set()
     assert bounds.image_width
@@ -15,6 +26,513 @@ def cartesius_to_image_coord(x, y, bounds):
 
     return (x_ratio * bounds.image_width, bounds.image_height - y_ratio * bounds.image_height)
 
+# Names of all __slots__ attributes of a class (and its base classes), see init_slots():
+SLOTS_CACHE = {}
+
+def init_slots(obj):
+    """
+    Set all __slots__ attributes of obj to None. Classes with __slots__ can't have class level
+    None defaults, call this at the start of __init__() instead.
+    """
+    names = SLOTS_CACHE.get(obj.__class__)
+    if names is None:
+        names = []
+        for cls in obj.__class__.__mro__:
+            slots = cls.__dict__.get('__slots__', ())
+            names.extend((slots,) if isinstance(slots, str) else slots)
+        SLOTS_CACHE[obj.__class__] = names
+
+    for name in names:
+        setattr(obj, name, None)
+
+class LRUCache:
+    """
+    Dictionary-like cache which keeps only the max_size most recently used items (and, if max_bytes
+    is set, only as many as fit in max_bytes, with item sizes given by get_bytes(value)). Can be
+    used from many threads.
+    """
+
+    __slots__ = (
+        'max_size',
+        'max_bytes',
+        'get_bytes',
+        'items',
+        'bytes',
+        'lock',
+    )
+
+    def __init__(self, max_size, max_bytes=None, get_bytes=None):
+        assert max_size > 0
+        assert max_bytes is None or get_bytes is not None
+
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.get_bytes = get_bytes
+        self.items = mod_collections.OrderedDict()
+        self.bytes = 0
+        self.lock = mod_threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            value = self.items.pop(key)
+            self.items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.items:
+                self.remove_item(key)
+            self.items[key] = value
+            if self.max_bytes is not None:
+                self.bytes += self.get_bytes(value)
+
+            # An item bigger than max_bytes is not kept, either:
+            while len(self.items) > self.max_size or (self.max_bytes is not None and self.bytes > self.max_bytes):
+                self.remove_item(next(iter(self.items)))
+
+    def remove_item(self, key):
+        value = self.items.pop(key)
+        if self.max_bytes is not None:
+            self.bytes -= self.get_bytes(value)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.bytes = 0
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+class Transform:
+    """
+    Precomputed transformation from cartesius to image coordinates. Computed with the same
+    arithmetic as cartesius_to_image_coord() (so that rounding, and the drawn pixels, are the same),
+    but bounds are checked and converted only once.
+    """
+
+    __slots__ = (
+        'left',
+        'bottom',
+        'width',
+        'height',
+        'image_width',
+        'image_height',
+        'offset_x',
+        'offset_y',
+
+        # Pixels per unit (negative for y, which grows downwards in images):
+        'x_scale',
+        'y_scale',
+    )
+
+    def __init__(self, bounds, image_offset=None):
+        """ image_offset: (x, y) position of the image origin, if drawing on a part of the image """
+        assert bounds.is_set()
+        assert bounds.image_width
+        assert bounds.image_height
+
+        self.left = float(bounds.left)
+        self.bottom = float(bounds.bottom)
+        self.width = float(bounds.right - bounds.left)
+        self.height = float(bounds.top - bounds.bottom)
+        self.image_width = bounds.image_width
+        self.image_height = bounds.image_height
+        self.offset_x, self.offset_y = image_offset if image_offset else (0, 0)
+
+        self.x_scale = self.image_width / self.width
+        self.y_scale = -self.image_height / self.height
+
+    def to_image(self, x, y):
+        """ Scalar fast path. """
+        return ((x - self.left) / self.width * self.image_width - self.offset_x,
+                self.image_height - (y - self.bottom) / self.height * self.image_height - self.offset_y)
+
+    def to_image_points(self, points):
+        """ Converts a sequence of (x, y) points, returns a list of (x, y) tuples. """
+        left, bottom, width, height = self.left, self.bottom, self.width, self.height
+        image_width, image_height, offset_x, offset_y = self.image_width, self.image_height, self.offset_x, self.offset_y
+        return [((x - left) / width * image_width - offset_x,
+                 image_height - (y - bottom) / height * image_height - offset_y) for x, y in points]
+
+    def to_image_columns(self, xs, ys):
+        """
+        Converts whole columns of x and y coordinates. Returns two NumPy arrays if NumPy is
+        available, array.array('d') objects otherwise.
+        """
+        return self.to_image_xs(xs), self.to_image_ys(ys)
+
+    def to_image_xs(self, xs):
+        """ Converts a column of x coordinates (see to_image_columns()) """
+        if mod_numpy is not None:
+            return (mod_numpy.asarray(xs, dtype=float) - self.left) / self.width * self.image_width - self.offset_x
+
+        left, width, image_width, offset_x = self.left, self.width, self.image_width, self.offset_x
+        return mod_array.array('d', [(x - left) / width * image_width - offset_x for x in xs])
+
+    def to_image_ys(self, ys):
+        """ Converts a column of y coordinates (see to_image_columns()) """
+        if mod_numpy is not None:
+            return self.image_height - (mod_numpy.asarray(ys, dtype=float) - self.bottom) / self.height * self.image_height - self.offset_y
+
+        bottom, height, image_height, offset_y = self.bottom, self.height, self.image_height, self.offset_y
+        return mod_array.array('d', [image_height - (y - bottom) / height * image_height - offset_y for y in ys])
+
+    def to_image_flat(self, xs, ys):
+        """ Converts columns to a flat [x0, y0, x1, y1, ...] list, as accepted by PIL. """
+        image_xs, image_ys = self.to_image_columns(xs, ys)
+
+        return interleave(image_xs, image_ys)
+
+def interleave(xs, ys):
+    """ Flat [x0, y0, x1, y1, ...] list from x and y columns """
+    if mod_numpy is not None and isinstance(xs, mod_numpy.ndarray):
+        return mod_numpy.column_stack((xs, ys)).ravel().tolist()
+
+    result = [None] * (2 * len(xs))
+    result[0::2] = xs
+    result[1::2] = ys
+    return result
+
+def is_buffer(data):
+    """ True for NumPy arrays, memoryviews and array.array objects """
+    if mod_numpy is not None and isinstance(data, mod_numpy.ndarray):
+        return True
+    return isinstance(data, (memoryview, mod_array.array))
+
+def to_column(data):
+    """
+    Returns data as a numeric column without copying it, if possible. NumPy arrays, array('d')
+    objects and 'd' memoryviews are returned as they are, other buffers are wrapped in a NumPy
+    array (if available). Everything else is copied into an array.array('d').
+    """
+    if mod_numpy is not None:
+        if isinstance(data, mod_numpy.ndarray):
+            return data
+        if isinstance(data, (memoryview, mod_array.array)):
+            return mod_numpy.asarray(data)
+    if isinstance(data, mod_array.array) and data.typecode == 'd':
+        return data
+    if isinstance(data, memoryview) and data.format == 'd' and data.ndim == 1:
+        return data
+    return mod_array.array('d', data)
+
+def to_columns(data, columns_count):
+    """
+    Splits a buffer of interleaved values (x0, y0, x1, y1, ... or a NumPy array with shape
+    (n, columns_count)) into columns_count columns. With NumPy the columns are views on the original
+    data.
+    """
+    if mod_numpy is not None:
+        array = mod_numpy.asarray(data)
+        if array.ndim == 1:
+            array = array.reshape(-1, columns_count)
+        if array.ndim != 2 or array.shape[1] != columns_count:
+            raise Exception('Invalid data shape: {0}'.format(array.shape))
+        return [array[:, i] for i in range(columns_count)]
+
+    if isinstance(data, memoryview):
+        data = data.cast('B').cast(data.format) if data.ndim != 1 else data
+    if len(data) % columns_count:
+        raise Exception('Invalid data length: {0}'.format(len(data)))
+    return [mod_array.array('d', data[i::columns_count]) for i in range(columns_count)]
+
+def column_min_max(column):
+    """ (min, max) of a numeric column, None if the column is empty """
+    if not len(column):
+        return None, None
+    if mod_numpy is not None and isinstance(column, mod_numpy.ndarray):
+        return float(column.min()), float(column.max())
+    return min(column), max(column)
+
+def column_sum(column):
+    if mod_numpy is not None and isinstance(column, mod_numpy.ndarray):
+        return float(column.sum())
+    return sum(column)
+
+def take(column, indexes):
+    """ Column with only the elements on the given indexes """
+    if mod_numpy is not None and isinstance(column, mod_numpy.ndarray):
+        return column[mod_numpy.asarray(indexes, dtype=int)]
+    return mod_array.array('d', [column[i] for i in indexes])
+
+def get_visible_range(keys, left, right):
+    """
+    (start, end) indexes of the sorted keys within [left, right], with one more point on each side
+    (so that lines leaving the image are still drawn to its edges).
+    """
+    if mod_numpy is not None and isinstance(keys, mod_numpy.ndarray):
+        start = int(mod_numpy.searchsorted(keys, left, side='left'))
+        end = int(mod_numpy.searchsorted(keys, right, side='right'))
+    else:
+        start = mod_bisect.bisect_left(keys, left)
+        end = mod_bisect.bisect_right(keys, right)
+    return max(start - 1, 0), min(end + 1, len(keys))
+
+# Points binned (see bin_points()) at once, to limit the memory used for image coordinates:
+BINNING_BLOCK_SIZE = 1 << 20
+
+def bin_points(transform, xs, ys, width, height, weights=None):
+    """
+    Sums of weights (or counts, if no weights) of the points falling in every pixel of a width x height
+    image, as a flat (row by row) NumPy array (array('d') without NumPy). Points out of the image are
+    ignored.
+    """
+    if mod_numpy is not None:
+        result = mod_numpy.zeros(width * height)
+        for start in range(0, len(xs), BINNING_BLOCK_SIZE):
+            end = start + BINNING_BLOCK_SIZE
+            image_xs, image_ys = transform.to_image_columns(xs[start:end], ys[start:end])
+            image_xs, image_ys = mod_numpy.floor(image_xs), mod_numpy.floor(image_ys)
+            inside = (image_xs >= 0) & (image_xs < width) & (image_ys >= 0) & (image_ys < height)
+            indexes = (image_ys[inside] * width + image_xs[inside]).astype(int)
+            block_weights = None
+            if weights is not None:
+                block_weights = mod_numpy.asarray(weights[start:end], dtype=float)[inside]
+            result += mod_numpy.bincount(indexes, weights=block_weights, minlength=width * height)
+        return result
+
+    result = mod_array.array('d', [0]) * (width * height)
+    for i in range(len(xs)):
+        image_x, image_y = transform.to_image(xs[i], ys[i])
+        image_x, image_y = int(mod_math.floor(image_x)), int(mod_math.floor(image_y))
+        if 0 <= image_x < width and 0 <= image_y < height:
+            result[image_y * width + image_x] += weights[i] if weights is not None else 1
+    return result
+
+def get_pixel_positions(xs, ys, box):
+    """
+    Distinct whole pixel positions (xs and ys truncated, as PIL does with drawing coordinates) inside
+    box (left, top, right, bottom), as a list of (x, y) tuples.
+    """
+    if mod_numpy is not None:
+        xs = mod_numpy.trunc(mod_numpy.asarray(xs, dtype=float))
+        ys = mod_numpy.trunc(mod_numpy.asarray(ys, dtype=float))
+        inside = (xs >= box[0]) & (xs < box[2]) & (ys >= box[1]) & (ys < box[3])
+        xs, ys = xs[inside].astype(int) - box[0], ys[inside].astype(int) - box[1]
+        width = box[2] - box[0]
+        indexes = mod_numpy.unique(ys * width + xs)
+        return list(zip((indexes % width + box[0]).tolist(), (indexes // width + box[1]).tolist()))
+
+    result = set()
+    for x, y in zip(xs, ys):
+        x, y = int(x), int(y)
+        if box[0] <= x < box[2] and box[1] <= y < box[3]:
+            result.add((x, y))
+    return sorted(result)
+
+# Modes of aggregate():
+AGGREGATION_MAX = 'max'
+AGGREGATION_MIN = 'min'
+AGGREGATION_SUM = 'sum'
+
+def aggregate(groups, values, aggregation):
+    """
+    Aggregates values with the same (integer) group. Returns three lists: distinct groups (sorted),
+    their aggregated values (max, min or sum, see AGGREGATION_*) and, for every group, the index of
+    the value chosen (for AGGREGATION_SUM the last value in the group).
+    """
+    if aggregation not in (AGGREGATION_MAX, AGGREGATION_MIN, AGGREGATION_SUM):
+        raise Exception('Invalid aggregation: {0}'.format(aggregation))
+
+    if not len(groups):
+        return [], [], []
+
+    if mod_numpy is not None:
+        groups = mod_numpy.asarray(groups)
+        values = mod_numpy.asarray(values, dtype=float)
+        if aggregation == AGGREGATION_SUM:
+            order = mod_numpy.argsort(groups, kind='stable')
+        else:
+            order = mod_numpy.lexsort((values, groups))
+        sorted_groups = groups[order]
+        starts = mod_numpy.flatnonzero(mod_numpy.diff(sorted_groups)) + 1
+        firsts = mod_numpy.concatenate(([0], starts))
+        lasts = mod_numpy.concatenate((starts - 1, [len(order) - 1]))
+
+        if aggregation == AGGREGATION_SUM:
+            indexes = order[lasts]
+            result_values = mod_numpy.add.reduceat(values[order], firsts)
+        else:
+            indexes = order[lasts] if aggregation == AGGREGATION_MAX else order[firsts]
+            result_values = values[indexes]
+        return sorted_groups[firsts].tolist(), result_values.tolist(), indexes.tolist()
+
+    result = {}
+    for index, (group, value) in enumerate(zip(groups, values)):
+        if group not in result:
+            result[group] = [value, index]
+        elif aggregation == AGGREGATION_SUM:
+            result[group][0] += value
+            result[group][1] = index
+        elif (value >= result[group][0]) if aggregation == AGGREGATION_MAX else (value < result[group][0]):
+            result[group] = [value, index]
+
+    result_groups = sorted(result)
+    return result_groups, [result[group][0] for group in result_groups], [result[group][1] for group in result_groups]
+
+def get_box_intersection(box_1, box_2):
+    """ Intersection of two (left, top, right, bottom) pixel boxes, None if empty """
+    left, top = max(box_1[0], box_2[0]), max(box_1[1], box_2[1])
+    right, bottom = min(box_1[2], box_2[2]), min(box_1[3], box_2[3])
+    if left >= right or top >= bottom:
+        return None
+    return left, top, right, bottom
+
+def get_box_union(box_1, box_2):
+    return min(box_1[0], box_2[0]), min(box_1[1], box_2[1]), max(box_1[2], box_2[2]), max(box_1[3], box_2[3])
+
+# Cohen-Sutherland outcodes (position of a point relative to a box):
+OUTCODE_LEFT = 1
+OUTCODE_RIGHT = 2
+OUTCODE_TOP = 4
+OUTCODE_BOTTOM = 8
+
+def get_outcode(x, y, box):
+    """ Cohen-Sutherland outcode of (x, y) for box (left, top, right, bottom), 0 if inside """
+    code = 0
+    if x < box[0]:
+        code |= OUTCODE_LEFT
+    elif x > box[2]:
+        code |= OUTCODE_RIGHT
+    if y < box[1]:
+        code |= OUTCODE_TOP
+    elif y > box[3]:
+        code |= OUTCODE_BOTTOM
+    return code
+
+def clip_line(x1, y1, x2, y2, box):
+    """
+    Cohen-Sutherland line clipping. Returns the part of the segment inside box (left, top, right,
+    bottom) as a (x1, y1, x2, y2) tuple, or None if it is not visible.
+    """
+    code1, code2 = get_outcode(x1, y1, box), get_outcode(x2, y2, box)
+
+    while True:
+        if not code1 | code2:
+            return x1, y1, x2, y2
+        if code1 & code2:
+            return None
+
+        code = code1 if code1 else code2
+        if code & OUTCODE_TOP:
+            x, y = x1 + (x2 - x1) * (box[1] - y1) / (y2 - y1), box[1]
+        elif code & OUTCODE_BOTTOM:
+            x, y = x1 + (x2 - x1) * (box[3] - y1) / (y2 - y1), box[3]
+        elif code & OUTCODE_LEFT:
+            x, y = box[0], y1 + (y2 - y1) * (box[0] - x1) / (x2 - x1)
+        else:
+            x, y = box[2], y1 + (y2 - y1) * (box[2] - x1) / (x2 - x1)
+
+        if code == code1:
+            x1, y1 = x, y
+            code1 = get_outcode(x1, y1, box)
+        else:
+            x2, y2 = x, y
+            code2 = get_outcode(x2, y2, box)
+
+def is_inside(xs, ys, box):
+    """ True if all points (given as x and y columns) are inside box """
+    x_min, x_max = column_min_max(xs)
+    y_min, y_max = column_min_max(ys)
+    return box[0] <= x_min and x_max <= box[2] and box[1] <= y_min and y_max <= box[3]
+
+def clip_polyline(xs, ys, box):
+    """
+    Visible parts of the polyline through points given as x and y columns, clipped to box (left,
+    top, right, bottom). Returns a list of flat [x0, y0, x1, y1, ...] lists, one for every
+    connected visible part. Segments entirely on one side of the box are rejected without
+    clipping (with NumPy, all at once).
+    """
+    if len(xs) < 2:
+        return []
+
+    if is_inside(xs, ys, box):
+        return [interleave(xs, ys)]
+
+    if mod_numpy is not None:
+        xs, ys = mod_numpy.asarray(xs, dtype=float), mod_numpy.asarray(ys, dtype=float)
+        codes = (xs < box[0]) * OUTCODE_LEFT | (xs > box[2]) * OUTCODE_RIGHT | \
+                (ys < box[1]) * OUTCODE_TOP | (ys > box[3]) * OUTCODE_BOTTOM
+        segments = mod_numpy.nonzero((codes[:-1] & codes[1:]) == 0)[0].tolist()
+    else:
+        codes = [get_outcode(x, y, box) for x, y in zip(xs, ys)]
+        segments = [i for i in range(len(codes) - 1) if not codes[i] & codes[i + 1]]
+
+    result = []
+    run, previous = None, None
+    for i in segments:
+        if codes[i] or codes[i + 1]:
+            segment = clip_line(float(xs[i]), float(ys[i]), float(xs[i + 1]), float(ys[i + 1]), box)
+            if segment is None:
+                run = None
+                continue
+        else:
+            segment = float(xs[i]), float(ys[i]), float(xs[i + 1]), float(ys[i + 1])
+
+        # A new part starts if the previous segment wasn't visible or this one enters the box:
+        if run is None or codes[i] or previous != i - 1:
+            run = [segment[0], segment[1]]
+            result.append(run)
+        run.extend(segment[2:])
+        previous = i
+
+        # ...and ends if it leaves the box:
+        if codes[i + 1]:
+            run = None
+
+    return result
+
+def clip_polygon(points, box):
+    """
+    Sutherland-Hodgman polygon clipping. Points is a flat [x0, y0, x1, y1, ...] list, the result is
+    the flat list of the polygon clipped to box (left, top, right, bottom), empty if not visible.
+    """
+    xs, ys = points[0::2], points[1::2]
+    if not xs or is_inside(xs, ys, box):
+        return points
+
+    if mod_numpy is not None:
+        # A vertex with an outcode bit shared by both neighbours is in a run of vertices outside the
+        # same box edge, only the first and last vertex of such a run change the clipped polygon:
+        xs, ys = mod_numpy.asarray(xs, dtype=float), mod_numpy.asarray(ys, dtype=float)
+        codes = (xs < box[0]) * OUTCODE_LEFT | (xs > box[2]) * OUTCODE_RIGHT | \
+                (ys < box[1]) * OUTCODE_TOP | (ys > box[3]) * OUTCODE_BOTTOM
+        keep = (mod_numpy.roll(codes, 1) & codes & mod_numpy.roll(codes, -1)) == 0
+        xs, ys = xs[keep].tolist(), ys[keep].tolist()
+
+    vertices = list(zip(xs, ys))
+    # (coordinate index, box value, True if inside is greater than the value) for every box edge:
+    for coordinate, value, greater in ((0, box[0], True), (0, box[2], False), (1, box[1], True), (1, box[3], False)):
+        if not vertices:
+            break
+
+        clipped = []
+        previous = vertices[-1]
+        previous_inside = (previous[coordinate] >= value) == greater or previous[coordinate] == value
+        for vertex in vertices:
+            inside = (vertex[coordinate] >= value) == greater or vertex[coordinate] == value
+            if inside != previous_inside:
+                ratio = (value - previous[coordinate]) / float(vertex[coordinate] - previous[coordinate])
+                if coordinate == 0:
+                    clipped.append((value, previous[1] + (vertex[1] - previous[1]) * ratio))
+                else:
+                    clipped.append((previous[0] + (vertex[0] - previous[0]) * ratio, value))
+            if inside:
+                clipped.append(vertex)
+            previous, previous_inside = vertex, inside
+        vertices = clipped
+
+    result = []
+    for vertex in vertices:
+        result.extend(vertex)
+    return result
+
 def min_max(*n):
     if not n:
         return None
@@ -31,3 +549,14 @@ def min_max(*n):
     return min_result, max_result
 
 
+def get_nice_step(min_step):
+    """ Returns the smallest "nice" number (1, 2 or 5 times a power of 10) not smaller than min_step """
+    assert min_step > 0
+
+    exponent = mod_math.floor(mod_math.log10(min_step))
+    for nice in (1, 2, 5, 10):
+        step = nice * 10 ** exponent
+        if step >= min_step:
+            return step
+
+    return 10 * 10 ** exponent
@@ -14,9 +14,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io as mod_io
 import logging as mod_logging
+import math as mod_math
+import pickle as mod_pickle
+import threading as mod_threading
 import unittest as mod_unittest
 import cartesius as mod_cartesius
+import cartesius.main as mod_main
+import cartesius.charts as mod_charts
+import cartesius.colors as mod_colors
+import cartesius.elements as mod_elements
+import cartesius.utils as mod_utils
+
+from PIL import ImageChops as mod_imagechops
+from PIL import ImageDraw as mod_imagedraw
 
 mod_logging.basicConfig(level=mod_logging.DEBUG, format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
 
@@ -145,6 +157,812 @@ class Tests(mod_unittest.TestCase):
         self.assertEquals(line.bounds.bottom, 2)
         self.assertEquals(line.bounds.top, 4)
 
+    def test_decimate_min_max(self):
+        keys = [i / 10. for i in range(100)]
+        values = [(i * 7) % 13 for i in range(100)]
+
+        indexes = mod_charts.decimate_min_max(keys, values, 0, 10, 5)
+
+        self.assertEqual(indexes, sorted(indexes))
+        self.assertTrue(len(indexes) <= 4 * 5)
+        self.assertEqual(indexes[0], 0)
+        self.assertEqual(indexes[-1], 99)
+        for column in range(5):
+            column_indexes = [i for i in range(100) if int(keys[i] / 2) == column]
+            kept = [i for i in indexes if i in column_indexes]
+            self.assertEqual(max(values[i] for i in kept), max(values[i] for i in column_indexes))
+            self.assertEqual(min(values[i] for i in kept), min(values[i] for i in column_indexes))
+
+    def test_decimate_lttb(self):
+        keys = list(range(1000))
+        values = [0] * 1000
+        values[500] = 100
+
+        indexes = mod_charts.decimate_lttb(keys, values, 50)
+
+        self.assertEqual(len(indexes), 50)
+        self.assertEqual(indexes[0], 0)
+        self.assertEqual(indexes[-1], 999)
+        self.assertTrue(500 in indexes)
+
+    @mod_unittest.skipIf(mod_utils.mod_numpy is None, 'NumPy not installed')
+    def test_decimate_numpy(self):
+        numpy = mod_utils.mod_numpy
+
+        keys = [i / 10. for i in range(1000)]
+        values = [(i * 7) % 13 for i in range(1000)]
+
+        self.assertEqual(mod_charts.decimate_min_max(numpy.array(keys), numpy.array(values), 0, 100, 30),
+                         mod_charts.decimate_min_max(keys, values, 0, 100, 30))
+        self.assertEqual(mod_charts.decimate_lttb(numpy.array(keys), numpy.array(values), 50),
+                         mod_charts.decimate_lttb(keys, values, 50))
+
+    def test_decimate_zoomed(self):
+        keys = [i / 100. for i in range(300000)]
+        values = [mod_math.sin(key) for key in keys]
+        bounds = mod_main.Bounds(left=0, right=1000, bottom=-1.5, top=1.5, image_width=800, image_height=100)
+        draw_handler = mod_main.PILHandler(1, bounds)
+
+        for decimation in (mod_charts.DECIMATION_LTTB, mod_charts.DECIMATION_MIN_MAX):
+            line_chart = mod_charts.LineChart(mod_charts.ChartSeries(keys, values), decimation=decimation)
+            indexes = line_chart.get_decimated_indexes(keys, values, [], draw_handler)
+
+            visible = [i for i in indexes if 0 <= keys[i] <= 1000]
+            self.assertTrue(len(visible) > 1000)
+            self.assertEqual(indexes[0], 0)
+            # Only one point after the visible range:
+            self.assertEqual(indexes[-1], 100001)
+            self.assertTrue(indexes[-2] <= 100000)
+
+    def test_transform(self):
+        bounds = mod_main.Bounds(left=-1, right=3, bottom=-2, top=2, image_width=100, image_height=50)
+        transform = mod_utils.Transform(bounds)
+
+        points = [(0, 0), (-1, -2), (3, 2), (0.5, -1.5)]
+        expected = [mod_utils.cartesius_to_image_coord(x, y, bounds) for x, y in points]
+
+        for (x, y), (expected_x, expected_y) in zip(points, expected):
+            image_x, image_y = transform.to_image(x, y)
+            self.assertAlmostEqual(image_x, expected_x)
+            self.assertAlmostEqual(image_y, expected_y)
+
+        for (image_x, image_y), (expected_x, expected_y) in zip(transform.to_image_points(points), expected):
+            self.assertAlmostEqual(image_x, expected_x)
+            self.assertAlmostEqual(image_y, expected_y)
+
+        flat = transform.to_image_flat([x for x, y in points], [y for x, y in points])
+        self.assertEqual(len(flat), 2 * len(points))
+        for i, (expected_x, expected_y) in enumerate(expected):
+            self.assertAlmostEqual(flat[2 * i], expected_x)
+            self.assertAlmostEqual(flat[2 * i + 1], expected_y)
+
+    def test_transform_rounding(self):
+        """ Transform computes exactly the same image coordinates as cartesius_to_image_coord() """
+        for left, right, bottom, top, width, height in ((-2.5, 2.5, -2.5, 2.5, 150, 150),
+                                                        (-1, 3, -2, 2, 100, 50),
+                                                        (0.1, 7.3, -0.7, 1.9, 333, 217)):
+            bounds = mod_main.Bounds(left=left, right=right, bottom=bottom, top=top, image_width=width, image_height=height)
+            transform = mod_utils.Transform(bounds)
+
+            xs = [left + (right - left) * i / 997. for i in range(998)]
+            ys = [bottom + (top - bottom) * i / 997. for i in range(998)]
+            expected = [mod_utils.cartesius_to_image_coord(x, y, bounds) for x, y in zip(xs, ys)]
+
+            self.assertEqual([transform.to_image(x, y) for x, y in zip(xs, ys)], expected)
+            self.assertEqual(transform.to_image_points(list(zip(xs, ys))), expected)
+            for numpy in (mod_utils.mod_numpy, None):
+                original_numpy, mod_utils.mod_numpy = mod_utils.mod_numpy, numpy
+                try:
+                    image_xs, image_ys = transform.to_image_columns(xs, ys)
+                    self.assertEqual(list(zip(image_xs.tolist(), image_ys.tolist())), expected)
+                finally:
+                    mod_utils.mod_numpy = original_numpy
+
+    def test_nice_step(self):
+        self.assertEqual(mod_utils.get_nice_step(1), 1)
+        self.assertEqual(mod_utils.get_nice_step(1.5), 2)
+        self.assertEqual(mod_utils.get_nice_step(3), 5)
+        self.assertEqual(mod_utils.get_nice_step(7), 10)
+        self.assertEqual(mod_utils.get_nice_step(12000), 20000)
+        self.assertAlmostEqual(mod_utils.get_nice_step(0.03), 0.05)
+
+    def test_axis_density_step(self):
+        bounds = mod_main.Bounds(left=0, right=10000000, bottom=-1, top=1, image_width=1000, image_height=100)
+        draw_handler = mod_main.PILHandler(1, bounds)
+        axis = mod_elements.Axis(horizontal=True, points=1)
+
+        step = axis.get_density_step(axis.points, 5, draw_handler)
+
+        self.assertEqual(step, 50000)
+        self.assertEqual(axis.get_density_step(100000, 5, draw_handler), 100000)
+
+    def test_grid_lines(self):
+        grid = mod_elements.Grid(1, 1)
+
+        self.assertEqual(grid.get_lines(1, 100, -2.5, 2.5, 1), [-2, -1, 1, 2])
+        self.assertEqual(grid.get_lines(1, 10, -3, 3, 1), [-2, -1, 1, 2])
+
+        lines = grid.get_lines(1, 0.0001, 0, 10000000, 1)
+        self.assertEqual(len(lines), 199)
+        self.assertEqual(lines[0], 50000)
+
+    def test_grid_drawing(self):
+        """ Grid lines set in one mask (with NumPy) are the same as lines drawn one by one """
+        images = []
+        for numpy in (mod_utils.mod_numpy, None):
+            original_numpy, mod_utils.mod_numpy = mod_utils.mod_numpy, numpy
+            try:
+                for transparency_mask in (None, 100):
+                    coordinate_system = mod_main.CoordinateSystem(bounds=(-10.3, 10, -7, 7.5))
+                    coordinate_system.add(mod_elements.Grid(1, 0.5, color=(0, 0, 255), transparency_mask=transparency_mask))
+                    images.append(coordinate_system.draw(200, 150).tobytes())
+            finally:
+                mod_utils.mod_numpy = original_numpy
+
+        self.assertEqual(images[:2], images[2:])
+
+    def test_add_all_bounds(self):
+        points = [mod_elements.Point((i, i * i - 10)) for i in range(-3, 5)]
+
+        coordinate_system_1 = mod_main.CoordinateSystem()
+        for point in points:
+            coordinate_system_1.add(point)
+
+        coordinate_system_2 = mod_main.CoordinateSystem()
+        coordinate_system_2.add_all(points)
+
+        for coordinate_system in (coordinate_system_1, coordinate_system_2):
+            self.assertEqual(len(coordinate_system.elements), len(points))
+            self.assertEqual(coordinate_system.bounds.left, -3)
+            self.assertEqual(coordinate_system.bounds.right, 4)
+            self.assertEqual(coordinate_system.bounds.bottom, -10)
+            self.assertEqual(coordinate_system.bounds.top, 6)
+
+    def test_chart_series(self):
+        series = mod_charts.ChartSeries([1, 2, 3], [4, 5, 6])
+        series.append(4, 7, label='last', color=(255, 0, 0))
+
+        self.assertEqual(len(series), 4)
+        self.assertEqual(series[0], mod_charts.data(1, 4))
+        self.assertEqual(series[3], mod_charts.data(4, 7, label='last', color=(255, 0, 0)))
+        self.assertEqual(list(series), [series[i] for i in range(4)])
+        self.assertTrue(series.has_colors())
+
+        line_chart = mod_charts.LineChart(series)
+        self.assertEqual(line_chart.bounds.left, 1)
+        self.assertEqual(line_chart.bounds.right, 4)
+        self.assertEqual(line_chart.bounds.bottom, 4)
+        self.assertEqual(line_chart.bounds.top, 7)
+
+        bar_chart = mod_charts.BarChart(vertical=True, data=series, width=0.5)
+        self.assertEqual(bar_chart.bounds.right, 4.5)
+
+    def test_chart_series_from_data(self):
+        data = [mod_charts.data(1, 2, size=3), mod_charts.data(2, 3, label='x', fill_color=(1, 2, 3))]
+        series = mod_charts.ChartSeries.from_data(data)
+
+        self.assertEqual(list(series), data)
+
+    def test_pie_chart_series_labels(self):
+        texts = []
+        original_draw_text = mod_main.PILHandler.draw_text
+        def draw_text(draw_handler, x, y, text, *args, **kwargs):
+            texts.append(text)
+            return original_draw_text(draw_handler, x, y, text, *args, **kwargs)
+
+        series = mod_charts.ChartSeries([1, 2, 2.5], [3, 2, 1])
+        series.labels[1] = 'two'
+        coordinate_system = mod_main.CoordinateSystem()
+        coordinate_system.add(mod_charts.PieChart(series))
+
+        mod_main.PILHandler.draw_text = draw_text
+        try:
+            coordinate_system.draw(100, 100, hide_x_axis=True, hide_y_axis=True)
+        finally:
+            mod_main.PILHandler.draw_text = original_draw_text
+
+        self.assertEqual(texts, ['1', 'two', '2.5'])
+
+    def test_series_from_buffers(self):
+        import array as mod_array
+
+        series = mod_charts.get_series(mod_array.array('d', [1, 10, 2, 20, 3, 30]))
+        self.assertEqual(list(series.keys), [1, 2, 3])
+        self.assertEqual(list(series.values), [10, 20, 30])
+
+        keys, values = mod_array.array('d', [1, 2]), mod_array.array('d', [5, 6])
+        series = mod_charts.get_series((memoryview(keys), memoryview(values)))
+        self.assertEqual(series[1], mod_charts.data(2, 6))
+
+        self.assertEqual(mod_charts.get_series([mod_charts.data(1, 2), mod_charts.data(2, 3)]), None)
+
+    @mod_unittest.skipIf(mod_utils.mod_numpy is None, 'NumPy not installed')
+    def test_series_from_numpy(self):
+        numpy = mod_utils.mod_numpy
+        data = numpy.array([[1., 10.], [2., 20.], [3., 30.]])
+
+        series = mod_charts.get_series(data)
+        data[0, 1] = -10
+
+        # Columns are views on the original array:
+        self.assertEqual(series.values[0], -10)
+
+        line_chart = mod_charts.LineChart(data)
+        self.assertEqual(line_chart.bounds.bottom, -10)
+        self.assertEqual(line_chart.bounds.top, 30)
+
+    def test_function_adaptive(self):
+        function = mod_charts.Function(lambda x: abs(x) ** 0.5, start=-1, end=1, adaptive=True)
+
+        xs, ys = function.compute_adaptive(-1, 1, 10, 100)
+
+        self.assertEqual(xs, sorted(xs))
+        self.assertEqual(xs[0], -1)
+        self.assertEqual(xs[-1], 1)
+        self.assertTrue(len(xs) > 11)
+        # The samples are denser around the (sharp) minimum:
+        self.assertTrue(len([x for x in xs if abs(x) < 0.2]) > len([x for x in xs if x > 0.6]))
+
+        # Initial samples are on a grid with step 2**-3, and a line needs no refinement:
+        line = mod_charts.Function(lambda x: 2 * x, start=-1, end=1, adaptive=True)
+        xs, ys = line.compute_adaptive(-1, 1, 10, 100)
+        self.assertEqual(xs, [-1 + i * 0.125 for i in range(17)])
+
+    @mod_unittest.skipIf(mod_utils.mod_numpy is None, 'NumPy not installed')
+    def test_function_vectorized(self):
+        function = mod_charts.Function(lambda xs: xs * xs, start=0, end=1, step=0.25, vectorized=True)
+        function.compute()
+
+        self.assertEqual(list(function.xs), [0, 0.25, 0.5, 0.75])
+        self.assertEqual(list(function.ys), [0, 0.0625, 0.25, 0.5625])
+
+    def test_function_lazy_evaluation(self):
+        calls = []
+        def function(x):
+            calls.append(x)
+            return x
+
+        function_element = mod_charts.Function(function, start=-100, end=100, step=0.5)
+        self.assertEqual(calls, [])
+
+        coordinate_system = mod_main.CoordinateSystem(bounds=(-1, 1, -1, 1))
+        coordinate_system.add(function_element)
+        coordinate_system.draw(50, 50)
+
+        # Only the visible block(s) are evaluated:
+        self.assertTrue(0 < len(calls) <= mod_charts.FUNCTION_BLOCK_SIZE)
+
+        # ...and reused when drawn again:
+        calls_count = len(calls)
+        coordinate_system.draw(100, 100)
+        self.assertEqual(len(calls), calls_count)
+
+    def test_polylines(self):
+        """
+        Charts drawn as polylines look as if every segment was drawn separately, except that with
+        fill the line is always on top of it
+        """
+        def draw_segments(element, points, fill_color, draw_handler):
+            for (x1, y1, _), (x2, y2, color) in zip(points[:-1], points[1:]):
+                if fill_color:
+                    draw_handler.draw_polygon([(x1, 0), (x1, y1), (x2, y2), (x2, 0)],
+                                              fill_color=element.get_color_with_transparency(fill_color))
+                draw_handler.draw_line(x1, y1, x2, y2, element.get_color_with_transparency(color))
+
+        class SegmentsLineChart(mod_charts.LineChart):
+            def process_image(self, draw_handler):
+                points = [(point.key, point.value, point.color if point.color else self.color)
+                          for point in self.get_points(draw_handler)]
+                draw_segments(self, points, self.fill_color, draw_handler)
+
+        class SegmentsFunction(mod_charts.Function):
+            def process_image(self, draw_handler):
+                xs, ys = self.get_samples(draw_handler)
+                draw_segments(self, [(x, y, self.color) for x, y in zip(xs, ys)], self.fill_color, draw_handler)
+
+        keys = [i / 2. for i in range(-20, 21)]
+        values = [mod_math.sin(key) * 4 for key in keys]
+        items = [mod_charts.data(key, value, color=(255, 0, 0) if key > 3 else None) for key, value in zip(keys, values)]
+
+        for fill_color in (None, (200, 200, 255)):
+            for transparency_mask in (None, 100):
+                images = []
+                for line_chart, function in (
+                        (mod_charts.LineChart, mod_charts.Function),
+                        (SegmentsLineChart, SegmentsFunction)):
+                    coordinate_system = mod_main.CoordinateSystem()
+                    coordinate_system.add(line_chart(items, color=(0, 0, 255), fill_color=fill_color,
+                                                     transparency_mask=transparency_mask))
+                    coordinate_system.add(line_chart(mod_charts.ChartSeries(keys, [value + 2 for value in values]),
+                                                     color=(0, 0, 255), fill_color=fill_color,
+                                                     transparency_mask=transparency_mask))
+                    coordinate_system.add(function(lambda x: mod_math.cos(x) * 3, start=-9, end=9, step=0.05,
+                                                   color=(0, 255, 0), fill_color=fill_color,
+                                                   transparency_mask=transparency_mask))
+                    images.append(coordinate_system.draw(200, 150, antialiasing=not fill_color))
+
+                if not fill_color:
+                    self.assertEqual(images[0].tobytes(), images[1].tobytes())
+                elif not transparency_mask:
+                    # Only line pixels covered by the next segment's fill differ:
+                    polyline_pixels, segments_pixels = images[0].load(), images[1].load()
+                    for x in range(200):
+                        for y in range(150):
+                            if polyline_pixels[x, y] != segments_pixels[x, y]:
+                                self.assertTrue(polyline_pixels[x, y][:3] in ((0, 0, 255), (255, 0, 0), (0, 255, 0)))
+                                self.assertEqual(segments_pixels[x, y][:3], fill_color)
+
+    def test_polyline_calls(self):
+        """ Every run of segments with the same colors is drawn with one draw_polyline call """
+        calls = []
+        original_draw_polyline_xy = mod_main.PILHandler.draw_polyline_xy
+        def draw_polyline_xy(draw_handler, xs, ys, *args, **kwargs):
+            calls.append(len(xs))
+            return original_draw_polyline_xy(draw_handler, xs, ys, *args, **kwargs)
+
+        items = [mod_charts.data(i, i % 3, color=(255, 0, 0) if 10 <= i < 20 else None) for i in range(30)]
+        for fill_color in (None, (200, 200, 255)):
+            coordinate_system = mod_main.CoordinateSystem()
+            coordinate_system.add(mod_charts.LineChart(items, fill_color=fill_color))
+            coordinate_system.add(mod_charts.LineChart(mod_charts.ChartSeries(range(30), range(30)), fill_color=fill_color))
+            coordinate_system.add(mod_charts.Function(mod_math.sin, start=0, end=30, fill_color=fill_color))
+
+            mod_main.PILHandler.draw_polyline_xy = draw_polyline_xy
+            try:
+                del calls[:]
+                coordinate_system.draw(100, 100)
+            finally:
+                mod_main.PILHandler.draw_polyline_xy = original_draw_polyline_xy
+
+            # Three color runs, the series and the function:
+            self.assertEqual(sorted(calls[:3]), [10, 11, 11])
+            self.assertEqual(len(calls), 5)
+
+    def test_polyline_pil_calls(self):
+        """ A filled function is drawn with one PIL polygon and one PIL line """
+        calls = []
+        original_polygon, original_line = mod_imagedraw.ImageDraw.polygon, mod_imagedraw.ImageDraw.line
+        def polygon(draw, *args, **kwargs):
+            calls.append('polygon')
+            return original_polygon(draw, *args, **kwargs)
+        def line(draw, *args, **kwargs):
+            calls.append('line')
+            return original_line(draw, *args, **kwargs)
+
+        coordinate_system = mod_main.CoordinateSystem(bounds=(-1, 11, -2, 2))
+        coordinate_system.add(mod_charts.Function(mod_math.sin, start=0, end=10, step=0.001, fill_color=(200, 200, 255)))
+
+        mod_imagedraw.ImageDraw.polygon, mod_imagedraw.ImageDraw.line = polygon, line
+        try:
+            coordinate_system.draw(200, 100, hide_x_axis=True, hide_y_axis=True)
+        finally:
+            mod_imagedraw.ImageDraw.polygon, mod_imagedraw.ImageDraw.line = original_polygon, original_line
+
+        self.assertEqual(sorted(calls), ['line', 'polygon'])
+
+    def test_transparent_layers(self):
+        coordinate_system = mod_main.CoordinateSystem(bounds=(-10, 10, -10, 10))
+        circle = mod_elements.Circle((5, 5), 1, color=(0, 0, 0), fill_color=(255, 0, 0), transparency_mask=100)
+        coordinate_system.add(circle)
+        coordinate_system.add(mod_elements.Line((20, 20), (30, 30), transparency_mask=100))
+
+        draw_handler = mod_main.PILHandler(1, mod_main.Bounds(-10, 10, -10, 10, image_width=100, image_height=100))
+        self.assertEqual(circle.get_image_box(draw_handler), (69, 19, 82, 32))
+
+        image = coordinate_system.draw(100, 100, hide_x_axis=True, hide_y_axis=True)
+
+        red, green, blue, alpha = image.getpixel((75, 25))
+        self.assertTrue(red == 255 and 150 < green < 255 and green == blue)
+        self.assertEqual(image.getpixel((10, 90)), (255, 255, 255, 255))
+
+    def test_overlapping_transparent_elements(self):
+        """ Overlapping translucent elements are blended with each other (unless layers are merged) """
+        def draw(merge_transparent_layers):
+            coordinate_system = mod_main.CoordinateSystem(bounds=(-10, 10, -10, 10),
+                                                          merge_transparent_layers=merge_transparent_layers)
+            for x in (-2, 2):
+                coordinate_system.add(mod_elements.Circle((x, 0), 8, color=(255, 0, 0), fill_color=(255, 0, 0),
+                                                          transparency_mask=128))
+            # Doesn't overlap with the circles, can be merged with them:
+            coordinate_system.add(mod_elements.Line((-9, 9), (9, 9), color=(255, 0, 0), transparency_mask=128))
+            return coordinate_system.draw(100, 100, hide_x_axis=True, hide_y_axis=True)
+
+        image = draw(None)
+        once = image.getpixel((30, 50))
+        twice = image.getpixel((50, 50))
+        self.assertEqual(once[:3], (255, 127, 127))
+        self.assertEqual(twice[:3], (255, 63, 63))
+        self.assertEqual(image.tobytes(), draw(False).tobytes())
+
+        # Merged layers, no blending between the circles:
+        self.assertEqual(draw(True).getpixel((50, 50)), once)
+
+    def test_antialiasing_factors(self):
+        self.assertEqual(mod_main.get_antialiasing_coef(None), 1)
+        self.assertEqual(mod_main.get_antialiasing_coef(True), mod_main.DEFAULT_ANTIALIASING_COEF)
+        self.assertEqual(mod_main.get_antialiasing_coef(3.0), 3)
+        self.assertEqual(mod_main.get_antialiasing_coef(1.5), 1.5)
+
+        coordinate_system = mod_main.CoordinateSystem()
+        coordinate_system.add(mod_elements.Line((0, 0), (1, 1)))
+
+        for antialiasing in (1.5, 2, 3, 4):
+            for resample in (mod_main.RESAMPLE_BOX, mod_main.RESAMPLE_BILINEAR, mod_main.RESAMPLE_LANCZOS):
+                image = coordinate_system.draw(101, 51, antialiasing=antialiasing, resample=resample)
+                self.assertEqual(image.size, (101, 51))
+
+    def test_selective_antialiasing(self):
+        self.assertTrue(mod_elements.Line((0, 0), (1, 1)).is_antialiased())
+        self.assertFalse(mod_elements.Line((0, 0), (0, 1)).is_antialiased())
+        self.assertFalse(mod_elements.Grid(1, 1).is_antialiased())
+
+        grid = mod_elements.Grid(1, 1)
+        grid.antialiased = True
+        self.assertTrue(grid.is_antialiased())
+
+        coordinate_system = mod_main.CoordinateSystem(bounds=(-5, 5, -5, 5))
+        coordinate_system.add(mod_elements.Grid(1, 1, color=(0, 0, 0)))
+        coordinate_system.add(mod_elements.Line((-5, -5), (5, 3), color=(0, 0, 0)))
+
+        image = coordinate_system.draw(100, 100, antialiasing=True, selective_antialiasing=True,
+                                       hide_x_axis=True, hide_y_axis=True)
+
+        self.assertEqual(image.size, (100, 100))
+        colors = set(color for count, color in image.getcolors())
+        # Grid lines are not antialiased:
+        self.assertEqual(image.getpixel((10, 5)), (0, 0, 0, 255))
+        # ...but the line is:
+        self.assertTrue(len(colors) > 2)
+
+    def test_static_layers_cache(self):
+        def get_coordinate_system(k):
+            coordinate_system = mod_main.CoordinateSystem(bounds=(-5, 5, -5, 5))
+            coordinate_system.add(mod_elements.Grid(1, 1))
+            coordinate_system.add(mod_elements.Axis(horizontal=True, labels=1, points=1))
+            coordinate_system.add(mod_elements.Axis(vertical=True, labels=2, points=1))
+            coordinate_system.add(mod_elements.Line((-5, -5), (5, k), color=(0, 0, 255)))
+            return coordinate_system
+
+        mod_main.STATIC_LAYERS_CACHE.clear()
+
+        for antialiasing in (None, True):
+            for k in (3, 4):
+                image = get_coordinate_system(k).draw(200, 100, antialiasing=antialiasing)
+                cached_image = get_coordinate_system(k).draw(200, 100, antialiasing=antialiasing,
+                                                             cache_static_layers=True)
+                self.assertEqual(image.tobytes(), cached_image.tobytes())
+
+        # Background with the grid and the axes layer, for both antialiasing options:
+        self.assertEqual(len(mod_main.STATIC_LAYERS_CACHE), 4)
+
+        # Cached layers are limited by size, too (only one 200x100 RGBA layer fits):
+        original_max_bytes, mod_main.STATIC_LAYERS_CACHE.max_bytes = mod_main.STATIC_LAYERS_CACHE.max_bytes, 200 * 100 * 4
+        try:
+            mod_main.STATIC_LAYERS_CACHE.clear()
+            get_coordinate_system(3).draw(200, 100, cache_static_layers=True)
+            self.assertEqual(len(mod_main.STATIC_LAYERS_CACHE), 1)
+            self.assertEqual(mod_main.STATIC_LAYERS_CACHE.bytes, 200 * 100 * 4)
+
+            # Supersampled layers don't fit at all:
+            get_coordinate_system(3).draw(200, 100, antialiasing=True, cache_static_layers=True)
+            self.assertEqual(len(mod_main.STATIC_LAYERS_CACHE), 0)
+        finally:
+            mod_main.STATIC_LAYERS_CACHE.max_bytes = original_max_bytes
+            mod_main.STATIC_LAYERS_CACHE.clear()
+
+        cache = mod_utils.LRUCache(max_size=10, max_bytes=10, get_bytes=len)
+        for key, value in (('a', 'xxxx'), ('b', 'xxxx'), ('c', 'xxxx'), ('b', 'xx')):
+            cache.put(key, value)
+        self.assertEqual(list(cache.items), ['c', 'b'])
+        self.assertEqual(cache.bytes, 6)
+
+        self.assertEqual(mod_elements.Grid(1, 1).get_cache_key(), mod_elements.Grid(1, 1).get_cache_key())
+        self.assertNotEqual(mod_elements.Grid(1, 1).get_cache_key(), mod_elements.Grid(1, 2).get_cache_key())
+        self.assertEqual(mod_elements.Line((0, 0), (1, 1)).get_cache_key(), None)
+
+    def test_incremental_redraw(self):
+        def get_coordinate_system(count, bounds=(0, 100, -2, 2)):
+            coordinate_system = mod_main.CoordinateSystem(bounds=bounds)
+            line_chart = mod_charts.LineChart(
+                    data=[mod_charts.data(x, mod_math.sin(x / 5.)) for x in range(count)], color=(0, 0, 255))
+            coordinate_system.add(line_chart)
+            return coordinate_system, line_chart
+
+        coordinate_system, line_chart = get_coordinate_system(40)
+        image = coordinate_system.draw(400, 200)
+
+        # Nothing changed => same image:
+        self.assertEqual(coordinate_system.redraw(image).tobytes(), image.tobytes())
+
+        coordinate_system.append_all(line_chart, [mod_charts.data(x, mod_math.sin(x / 5.)) for x in range(40, 45)])
+        self.assertEqual(line_chart.get_draw_state(), 45)
+        # From the last previous point (x=39):
+        draw_handler = mod_main.PILHandler(1, coordinate_system.get_render_context(400, 200).bounds)
+        self.assertEqual(line_chart.get_dirty_image_box(draw_handler, 40)[0], 155)
+
+        redrawn_image = coordinate_system.redraw(image)
+        expected_image = get_coordinate_system(45)[0].draw(400, 200)
+        self.assertEqual(redrawn_image.tobytes(), expected_image.tobytes())
+
+        # Only the new segments were repainted:
+        difference = mod_imagechops.difference(image.convert('RGB'), redrawn_image.convert('RGB'))
+        self.assertTrue(difference.getbbox()[0] >= 155)
+
+        # New bounds => full draw:
+        coordinate_system, line_chart = get_coordinate_system(40, bounds=None)
+        image = coordinate_system.draw(400, 200)
+        coordinate_system.append(line_chart, mod_charts.data(200, 10))
+        self.assertEqual(coordinate_system.redraw(image).tobytes(), coordinate_system.draw(400, 200).tobytes())
+
+    def test_render_many(self):
+        def get_coordinate_system(k):
+            def generator():
+                for x in range(10):
+                    yield mod_charts.data(x, (x * k) % 3)
+
+            coordinate_system = mod_main.CoordinateSystem()
+            # Neither the lambda nor the generator function can be pickled:
+            coordinate_system.add(mod_charts.Function(lambda x: mod_math.sin(x * k), start=-3, end=3, step=0.05))
+            coordinate_system.add(mod_charts.LineChart(data=generator, color=(255, 0, 0)))
+            return coordinate_system
+
+        def encode(image):
+            output = mod_io.BytesIO()
+            image.save(output, 'PNG')
+            return output.getvalue()
+
+        coordinate_systems = [get_coordinate_system(k) for k in range(1, 5)]
+        expected = [encode(get_coordinate_system(k).draw(200, 100)) for k in range(1, 5)]
+
+        self.assertEqual(list(mod_main.render_many(coordinate_systems, 200, 100, workers=2)), expected)
+        self.assertEqual(sorted(mod_main.render_many(coordinate_systems, 200, 100, workers=2, ordered=False)),
+                         list(enumerate(expected)))
+
+        # Only copies were materialized:
+        self.assertTrue(coordinate_systems[0].elements[0].function is not None)
+
+    def test_pickled_function_with_fixed_bounds(self):
+        calls = []
+        def function(x):
+            calls.append(x)
+            return mod_math.sin(x)
+
+        coordinate_system = mod_main.CoordinateSystem(bounds=(-2, 2, -2, 2))
+        coordinate_system.add(mod_charts.Function(function, start=-100000, end=100000, step=0.01, cache=False))
+
+        pickled = mod_main.get_pickled(coordinate_system)
+
+        # Only the visible block(s) are computed, and only visible samples (and one more on each
+        # side) pickled:
+        self.assertTrue(0 < len(calls) <= 2 * mod_charts.FUNCTION_BLOCK_SIZE)
+        unpickled = mod_pickle.loads(pickled)
+        self.assertEqual(len(unpickled.elements[0].xs), 403)
+        self.assertEqual(unpickled.draw(100, 100).tobytes(), coordinate_system.draw(100, 100).tobytes())
+
+    def test_font_and_text_caches(self):
+        bounds = mod_main.Bounds(left=-5, right=5, bottom=-5, top=5, image_width=100, image_height=100)
+        draw_handler = mod_main.PILHandler(1, bounds)
+
+        # Fonts are loaded once per process:
+        self.assertTrue(draw_handler.get_font() is mod_main.PILHandler(1, bounds).get_font())
+        self.assertFalse(draw_handler.get_font() is mod_main.PILHandler(2, bounds).get_font())
+
+        size = draw_handler.get_text_size('123')
+        self.assertEqual(mod_main.TEXT_SIZES_CACHE.get((mod_main.DEFAULT_FONT_LOCATION, 10, '123')), size)
+
+        # A label drawn from a bitmap is the same as text drawn on a whole pixel position:
+        image = mod_main.mod_image.new('RGBA', (100, 100), (255, 255, 255, 255))
+        draw = mod_main.mod_imagedraw.Draw(image)
+        draw.text((14, 22), '123', (0, 0, 0, 255), draw_handler.get_font())
+
+        bitmap_image = mod_main.mod_image.new('RGBA', (100, 100), (255, 255, 255, 255))
+        draw_handler.label_bitmaps = True
+        draw_handler.update_pil_image_draw(bitmap_image, mod_main.mod_imagedraw.Draw(bitmap_image))
+        x, y = draw_handler.transform.to_image(-4, 3)
+        draw_handler.draw_text(-4, 3, '123', (0, 0, 0, 255), mod_main.RIGHT_DOWN)
+
+        self.assertEqual((x + 4, y + 2), (14, 22))
+        self.assertEqual(image.tobytes(), bitmap_image.tobytes())
+
+    def test_concurrent_draw(self):
+        coordinate_system = mod_main.CoordinateSystem()
+        coordinate_system.add(mod_elements.Grid(1, 1))
+        coordinate_system.add(mod_charts.LineChart(
+                data=[mod_charts.data(x, (x * 7) % 5) for x in range(10)], color=(0, 0, 255)))
+
+        sizes = ((100, 80), (400, 300), (800, 200))
+        expected = [coordinate_system.draw(width, height).tobytes() for width, height in sizes]
+
+        # Drawing doesn't change the coordinate system:
+        self.assertEqual(coordinate_system.bounds.image_width, None)
+        self.assertEqual((coordinate_system.bounds.left, coordinate_system.bounds.right), (0, 9))
+        self.assertEqual([coordinate_system.draw(width, height).tobytes() for width, height in sizes], expected)
+
+        results = {}
+        def draw(index):
+            width, height = sizes[index % len(sizes)]
+            results[index] = coordinate_system.draw(width, height).tobytes()
+
+        threads = [mod_threading.Thread(target=draw, args=(index,)) for index in range(12)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for index in range(12):
+            self.assertEqual(results[index], expected[index % len(sizes)])
+
+    def test_bands(self):
+        coordinate_system = mod_main.CoordinateSystem(bounds=(-5, 5, -5, 5))
+        coordinate_system.add(mod_elements.Grid(1, 1))
+        coordinate_system.add(mod_elements.Line((-5, -4), (5, 3), color=(0, 0, 255)))
+        coordinate_system.add(mod_elements.Circle((1, 1), 3, color=(255, 0, 0), transparency_mask=100))
+
+        for antialiasing in (None, True):
+            image = coordinate_system.draw(300, 200, antialiasing=antialiasing)
+            banded_image = coordinate_system.draw(300, 200, antialiasing=antialiasing, bands=4)
+
+            self.assertEqual(banded_image.size, (300, 200))
+            self.assertEqual(image.tobytes(), banded_image.tobytes())
+
+    def test_clipping(self):
+        box = (0, 0, 10, 10)
+
+        self.assertEqual(mod_utils.clip_line(1, 1, 5, 5, box), (1, 1, 5, 5))
+        self.assertEqual(mod_utils.clip_line(-5, 5, 15, 5, box), (0, 5, 10, 5))
+        self.assertEqual(mod_utils.clip_line(-10, 0, 10, 20, box), (0, 10, 0, 10))
+        self.assertEqual(mod_utils.clip_line(-5, -5, 20, -1, box), None)
+        self.assertEqual(mod_utils.clip_line(-5, 11, 5, 21, box), None)
+
+        # Inside, leaving, outside, entering and leaving again:
+        xs = [1, 5, 15, 20, 5, -5]
+        ys = [1, 5, 5, 20, 5, 5]
+        self.assertEqual(mod_utils.clip_polyline(xs, ys, box),
+                         [[1, 1, 5, 5, 10, 5], [10, 10, 5, 5, 0, 5]])
+        self.assertEqual(mod_utils.clip_polyline([1, 2], [1, 2], box), [[1, 1, 2, 2]])
+        self.assertEqual(mod_utils.clip_polyline([-1, -2, -3], [1, 2, 3], box), [])
+
+        self.assertEqual(mod_utils.clip_polygon([1, 1, 5, 1, 5, 5], box), [1, 1, 5, 1, 5, 5])
+        self.assertEqual(mod_utils.clip_polygon([-10, -10, -5, -10, -5, -5], box), [])
+        clipped = mod_utils.clip_polygon([-10, 5, 5, -10, 20, 5, 20, 20, 15, 30, -5, 30], box)
+        self.assertEqual(sorted(set(zip(clipped[0::2], clipped[1::2]))),
+                         [(0, 0), (0, 10), (10, 0), (10, 10)])
+
+    def test_clipped_drawing(self):
+        """ Lines far outside the image are clipped, the visible part is drawn as without clipping """
+        images = []
+        for far in (20, 1e9):
+            coordinate_system = mod_main.CoordinateSystem(bounds=(-5, 5, -5, 5))
+            coordinate_system.add(mod_elements.Line((-4, -4), (far, far), color=(0, 0, 255)))
+            coordinate_system.add(mod_charts.LineChart(data=mod_charts.ChartSeries([-far, 0, far], [-far, 4, -4]),
+                                                       color=(255, 0, 0), fill_color=(0, 255, 0)))
+            images.append(coordinate_system.draw(200, 200))
+
+        self.assertEqual(images[0].getpixel((100, 100)), images[1].getpixel((100, 100)))
+        self.assertEqual(images[0].getpixel((150, 150)), images[1].getpixel((150, 150)))
+
+    def test_scatter_chart(self):
+        keys = [0.5, 0.5, 0.5, 1.5, 2.5, 2.5, 100]
+        values = [0.5, 0.5, 0.5, 0.5, 1.5, 1.5, 100]
+        scatter_chart = mod_charts.ScatterChart(mod_charts.ChartSeries(keys, values),
+                                                colors=((255, 0, 0), (0, 0, 255)), log_scale=False)
+
+        coordinate_system = mod_main.CoordinateSystem(bounds=(0, 4, 0, 4))
+        coordinate_system.add(scatter_chart)
+        image = coordinate_system.draw(4, 4, axis_units_equal_length=False, hide_x_axis=True, hide_y_axis=True)
+
+        self.assertEqual(image.getpixel((0, 3))[:3], (0, 0, 255))
+        self.assertEqual(image.getpixel((1, 3))[:3], (255, 0, 0))
+        self.assertEqual(image.getpixel((2, 2))[:3], (127, 0, 128))
+        self.assertEqual(image.getpixel((3, 0))[:3], (255, 255, 255))
+
+        # Colors depend on the whole image, not only on the band:
+        coordinate_system.add(mod_elements.Axis(horizontal=True))
+        image = coordinate_system.draw(40, 40)
+        self.assertEqual(image.tobytes(), coordinate_system.draw(40, 40, bands=3).tobytes())
+
+    def test_points(self):
+        xs = [-4.3, -1.1, 0.25, 0.25, 2.7, 3.9, 40]
+        ys = [1.3, -2.6, 0.5, 0.5, 4.1, -3.3, 40]
+
+        for style in ('.', '+'):
+            points_image, point_image = None, None
+            for single_points in (False, True):
+                coordinate_system = mod_main.CoordinateSystem(bounds=(-5, 5, -5, 5))
+                if single_points:
+                    for x, y in zip(xs, ys):
+                        coordinate_system.add(mod_elements.Point((x, y), style=style, color=(255, 0, 0)))
+                    point_image = coordinate_system.draw(100, 100)
+                else:
+                    coordinate_system.add(mod_elements.Points(xs, ys, style=style, color=(255, 0, 0)))
+                    points_image = coordinate_system.draw(100, 100)
+
+            self.assertEqual(points_image.tobytes(), point_image.tobytes())
+
+        points = mod_elements.Points(xs, ys, labels=['a', None, 'b'])
+        self.assertEqual(points.labels, {0: 'a', 2: 'b'})
+        self.assertEqual(points.bounds.right, 40)
+
+        with self.assertRaises(Exception):
+            mod_elements.Points(xs, ys, style='?')
+
+    def test_slots(self):
+        point = mod_elements.Point((1, 2), label='a', style='x')
+
+        self.assertFalse(hasattr(point, '__dict__'))
+        self.assertFalse(hasattr(point.bounds, '__dict__'))
+        self.assertFalse(hasattr(mod_utils.LRUCache(1), '__dict__'))
+        bounds = mod_main.Bounds(left=-1, right=1, bottom=-1, top=1, image_width=10, image_height=10)
+        self.assertFalse(hasattr(mod_utils.Transform(bounds), '__dict__'))
+        self.assertEqual(point.antialiased, None)
+
+        copied = mod_pickle.loads(mod_pickle.dumps(point))
+        self.assertEqual((copied.position, copied.label, copied.style), ((1, 2), 'a', 'x'))
+        self.assertEqual((copied.bounds.left, copied.bounds.top), (1, 2))
+
+        # Subclasses without __slots__ work as before:
+        class CustomPoint(mod_elements.Point):
+            size = None
+
+        custom_point = CustomPoint((1, 2))
+        custom_point.size = 3
+        self.assertEqual((custom_point.position, custom_point.size), ((1, 2), 3))
+
+    def test_aggregate(self):
+        groups, values = [3, 1, 3, 1, 2], [5, 2, 7, -1, 4]
+
+        self.assertEqual(mod_utils.aggregate(groups, values, mod_utils.AGGREGATION_MAX), ([1, 2, 3], [2, 4, 7], [1, 4, 2]))
+        self.assertEqual(mod_utils.aggregate(groups, values, mod_utils.AGGREGATION_MIN), ([1, 2, 3], [-1, 4, 5], [3, 4, 0]))
+        self.assertEqual(mod_utils.aggregate(groups, values, mod_utils.AGGREGATION_SUM), ([1, 2, 3], [1, 4, 12], [3, 4, 2]))
+
+    def test_aggregated_bar_chart(self):
+        data = [mod_charts.data(x, (x % 5) - 1, label='a' if x == 2 else None) for x in range(-5, 5)]
+
+        # Bars wider than a pixel are drawn as before:
+        images = []
+        for aggregation in (None, mod_utils.AGGREGATION_MAX):
+            coordinate_system = mod_main.CoordinateSystem(bounds=(-6, 6, -3, 5))
+            coordinate_system.add(mod_charts.BarChart(vertical=True, data=data, width=0.8, color=(0, 0, 0),
+                                                      aggregation=aggregation))
+            images.append(coordinate_system.draw(120, 80))
+        self.assertEqual(images[0].tobytes(), images[1].tobytes())
+
+        # 100 bars in every pixel column, values 0..99:
+        keys = [i / 100. for i in range(1000)]
+        values = [i % 100 for i in range(1000)]
+        for aggregation, top in ((mod_utils.AGGREGATION_MAX, 99), (mod_utils.AGGREGATION_MIN, 0),
+                                 (mod_utils.AGGREGATION_SUM, 4950)):
+            coordinate_system = mod_main.CoordinateSystem(bounds=(0, 10, 0, 10000))
+            coordinate_system.add(mod_charts.BarChart(vertical=True, data=mod_charts.ChartSeries(keys, values),
+                                                      width=0.01, color=(0, 0, 0), aggregation=aggregation))
+            image = coordinate_system.draw(10, 10000, axis_units_equal_length=False, hide_x_axis=True, hide_y_axis=True)
+            column = [image.getpixel((5, y)) for y in range(10000)]
+            filled = [y for y, color in enumerate(column) if color[:3] != (255, 255, 255)]
+            # From y=0 (just below the image) to y=top:
+            self.assertEqual(len(filled), top)
+
+    def test_colormaps(self):
+        colormap = mod_colors.get_colormap(((0, 0, 0), (255, 0, 0), (255, 255, 255)))
+
+        self.assertEqual(len(colormap), mod_colors.COLORMAP_SIZE)
+        self.assertEqual(colormap[0], (0, 0, 0))
+        self.assertEqual(colormap[-1], (255, 255, 255))
+        self.assertEqual(colormap[128], (255, 0, 0))
+        self.assertTrue(mod_colors.get_colormap(((0, 0, 0), (255, 0, 0), (255, 255, 255))) is colormap)
+        self.assertEqual(len(mod_colors.get_colormap(mod_colors.DEFAULT_COLORS, 10)), 10)
+
+        for numpy in (mod_utils.mod_numpy, None):
+            original_numpy, mod_utils.mod_numpy = mod_utils.mod_numpy, numpy
+            try:
+                colors = mod_colors.map_colors([0, 5, 10, 20], colormap, max_value=10)
+                self.assertEqual([tuple(color) for color in colors],
+                                 [(0, 0, 0), (255, 0, 0), (255, 255, 255), (255, 255, 255)])
+
+                colors = mod_colors.map_colors([3, 3], colormap, alpha=100)
+                self.assertEqual([tuple(color) for color in colors], [(255, 255, 255, 100)] * 2)
+            finally:
+                mod_utils.mod_numpy = original_numpy
+
 if __name__ == '__main__':
     mod_unittest.main()
 